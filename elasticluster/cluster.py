@@ -17,17 +17,23 @@
 #
 __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
+from abc import ABCMeta, abstractmethod
+import errno
+import fcntl
 import json
 import operator
 import os
+import shutil
 import signal
 import socket
+import tempfile
+import thread
 import time
 
-import paramiko
-
 from elasticluster import log
 from elasticluster.exceptions import TimeoutError, ClusterNotFound, NodeNotFound
+from elasticluster.exceptions import ImageError, ClusterLockTimeout
+from elasticluster.helpers import matches_any
 
 
 class Cluster(object):
@@ -50,6 +56,9 @@ class Cluster(object):
         self.nodes = dict((k, []) for k in nodes)
         self.ssh_to = extra.get('ssh_to')
         self.extra = extra.copy()
+        # images baked from configured nodes, by node type; see `bake`
+        self.images = {}
+        self._checked_images = {}
         # initialize nodes
         for cls in nodes:
             for i in range(nodes[cls]):
@@ -60,13 +69,105 @@ class Cluster(object):
         Adds a new node, but doesn't start the instance on the cloud.
         Returns the created node instance
         """
-        name = "%s%03d" % (node_type, len(self.nodes[node_type])+1) 
+        if not name:
+            name = "%s%03d" % (node_type, len(self.nodes[node_type])+1)
 
         node = self._configurator.create_node(self.template, node_type,
                                               self._cloud_provider, name)
+        image = self._get_baked_image(node_type)
+        if image:
+            # the node starts configured, except for what depends on
+            # the other nodes of the cluster; it only counts as
+            # configured once the setup has run on it
+            node.image = image['image_id']
+            node.baked_from = image['fingerprint']
         self.nodes[node_type].append(node)
         return node
 
+    def restore_node(self, record):
+        """
+        Adds a node from a `record` saved by `ClusterStorage`, and
+        returns it.
+        """
+        node = self._configurator.create_node(
+            self.template, record['type'], self._cloud_provider,
+            record['name'])
+        node.instance_id = record['instance_id']
+        node.ip_public = record['ip_public']
+        node.ip_private = record['ip_private']
+        node.setup_state = record.get('setup_state')
+        node.baked_from = record.get('baked_from')
+        self.nodes.setdefault(record['type'], []).append(node)
+        return node
+
+    def _get_baked_image(self, node_type):
+        """
+        Returns the image baked for `node_type`, if any and if it
+        still matches the configuration of the setup provider.
+        """
+        if node_type not in self.images:
+            return None
+        if node_type not in self._checked_images:
+            image = self.images[node_type]
+            fingerprint = self._setup_provider.get_fingerprint(node_type)
+            if fingerprint and fingerprint == image['fingerprint']:
+                self._checked_images[node_type] = image
+            else:
+                log.warning(
+                    "Not using image `%s` baked for %s nodes: the setup "
+                    "configuration has changed since. Run `elasticluster "
+                    "bake %s %s` to create an up to date image.",
+                    image['image_id'], node_type, self.name, node_type)
+                self._checked_images[node_type] = None
+        return self._checked_images[node_type]
+
+    def bake(self, node_type, image_name=None, reboot=True):
+        """
+        Creates a private image from a configured node of type
+        `node_type`. Nodes of this type added later to the cluster
+        start from this image, so that only the setup which depends
+        on the rest of the cluster has to run on them. The image is
+        ignored as soon as the setup configuration of `node_type`
+        changes.
+
+        Returns the id of the new image.
+        """
+        fingerprint = self._setup_provider.get_fingerprint(node_type)
+        if not fingerprint:
+            raise ImageError("The setup provider cannot tell the "
+                             "configuration of %s nodes." % node_type)
+        configured = [node for node in self.nodes.get(node_type, [])
+                      if node.setup_state
+                      and not node.setup_state.get('failed')
+                      and node.setup_state.get('playbook') == fingerprint]
+        if not configured:
+            raise NodeNotFound(
+                "No %s node with an up to date configuration found. Please "
+                "run `elasticluster setup %s` first." % (node_type, self.name))
+        node = configured[0]
+
+        if not image_name:
+            image_name = "%s-%s-%s" % (self.name, node_type,
+                                       time.strftime('%Y%m%d%H%M%S'))
+        log.info("Creating image `%s` from node %s.", image_name, node.name)
+        image_id = self._cloud_provider.create_image(
+            node.instance_id, image_name, reboot=reboot)
+
+        old_image = self.images.get(node_type)
+        if old_image:
+            log.warning("Image `%s` previously baked for %s nodes is no "
+                        "longer used and can be deleted.",
+                        old_image['image_id'], node_type)
+        self.images[node_type] = {
+            'image_id': image_id,
+            'image_name': image_name,
+            'fingerprint': fingerprint,
+            'created': time.time(),
+        }
+        self._checked_images.pop(node_type, None)
+        self._storage.dump_cluster(self)
+        return image_id
+
     def remove_node(self, node):
         """
         Removes a node from the cluster, but does not stop it.
@@ -86,47 +187,55 @@ class Cluster(object):
         the cluster storage.
         """
 
-        # start every node
-
-        # ANTONIO: I don't think it's correct to stop all the nodes if
-        # something goes wrong here.
-        for node in self.get_all_nodes():
-            if node.is_alive():
-                log.info("Not starting node %s which is "
-                         "already up&running.", node.name)
-            else:
-                node.start()
-
-        # dump the cluster here, so we don't loose any knowledge about nodes
-        self._storage.dump_cluster(self)
-
         # check if all nodes are running, stop all nodes if the
         # timeout is reached
         def timeout_handler(signum, frame):
             raise TimeoutError("problems occured while starting the nodes, "
                                "timeout `%i`", Cluster.startup_timeout)
 
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(Cluster.startup_timeout)
-
-        try:
-            starting_nodes = self.get_all_nodes()
-            while starting_nodes:
-                starting_nodes = [n for n in starting_nodes
-                                  if not n.is_alive()]
-                if starting_nodes:
-                    time.sleep(5)
-        except TimeoutError as timeout:
-            log.error(timeout.message)
-            log.error("timeout error occured: "
-                      "stopping all nodes")
-            self.stop()
+        # start every node; the setup provider may need the nodes of
+        # some types to be running before the others can be started
+        for phase in self._get_startup_phases():
+            phase_nodes = [node for node in self.get_all_nodes()
+                           if node.type in phase]
+
+            # ANTONIO: I don't think it's correct to stop all the nodes if
+            # something goes wrong here.
+            for node in phase_nodes:
+                if node.is_alive():
+                    log.info("Not starting node %s which is "
+                             "already up&running.", node.name)
+                else:
+                    self._setup_provider.prepare_node(self, node)
+                    node.start()
+
+            # dump the cluster here, so we don't loose any knowledge
+            # about nodes
+            self._storage.dump_cluster(self)
 
-        signal.alarm(0)
+            signal.signal(signal.SIGALRM, timeout_handler)
+            signal.alarm(Cluster.startup_timeout)
 
-        # If we reached this point, we should have IP addresses for
-        # the nodes, so update the storage file again.
-        self._storage.dump_cluster(self)
+            try:
+                starting_nodes = phase_nodes
+                while starting_nodes:
+                    starting_nodes = [n for n in starting_nodes
+                                      if not n.is_alive()]
+                    if starting_nodes:
+                        time.sleep(5)
+            except TimeoutError as timeout:
+                log.error(timeout.message)
+                log.error("timeout error occured: "
+                          "stopping all nodes")
+                self.stop()
+                signal.alarm(0)
+                break
+
+            signal.alarm(0)
+
+            # If we reached this point, we should have IP addresses for
+            # the nodes, so update the storage file again.
+            self._storage.dump_cluster(self)
 
         # Try to connect to each node. Run the setup action only when
         # we successfully connect to all of them.
@@ -151,6 +260,19 @@ class Cluster(object):
 
         signal.alarm(0)
 
+    def _get_startup_phases(self):
+        """
+        Returns the list of node types to start, grouped in the
+        order required by the setup provider.
+        """
+        phases = [list(phase) for phase
+                  in self._setup_provider.startup_phases(self)]
+        started = set(sum(phases, []))
+        remaining = [cls for cls in sorted(self.nodes) if cls not in started]
+        if remaining:
+            phases.append(remaining)
+        return phases
+
     def get_all_nodes(self):
         """
         Returns a list of all the nodes of the cluster.
@@ -176,6 +298,9 @@ class Cluster(object):
                           "already be down.", node.instance_id)
         if not self.get_all_nodes():
             log.debug("Removing cluster %s.", self.name)
+            for image in self.images.values():
+                log.warning("Image `%s` baked from cluster %s is not "
+                            "deleted.", image['image_id'], self.name)
             self._setup_provider.cleanup()
             self._storage.delete_cluster(self.name)
         elif not force:
@@ -218,10 +343,21 @@ class Cluster(object):
         raise NodeNotFound("Unable to find a valid frontend: "
                            "cluster has no nodes!")
 
-    def setup(self):
+    def setup(self, incremental=False, force=False, retry_failed=False):
+        """
+        Configures the cluster through the setup provider. If
+        `incremental` is `True` only nodes which have not been
+        configured yet get the full setup; if `force` is `True` all
+        nodes are set up again, even if they are already configured;
+        if `retry_failed` is `True` only the nodes where the previous
+        setup failed are configured (see
+        `AbstractSetupProvider.setup_cluster`).
+        """
         try:
             # setup the cluster using the setup provider
-            ret = self._setup_provider.setup_cluster(self)
+            ret = self._setup_provider.setup_cluster(
+                self, incremental=incremental, force=force,
+                retry_failed=retry_failed)
         except Exception, e:
             log.error(
                 "the setup provider was not able to setup the cluster, "
@@ -235,8 +371,20 @@ class Cluster(object):
                 "`elasticluster setup %s` and/or check your configuration",
                 self.name, self.name)
 
+        # save the setup state of the nodes
+        self._storage.dump_cluster(self)
+
         return ret
 
+    def get_data_dir(self):
+        """
+        Returns the path to a directory where setup providers and
+        commands can keep auxiliary data about this cluster (setup
+        profiles, caches...). The directory is removed together with
+        the cluster storage.
+        """
+        return self._storage.get_cluster_data_dir(self.name)
+
     def update(self):
         for node in self.get_all_nodes():
             node.update_ips()
@@ -269,6 +417,11 @@ class Node(object):
         self.instance_id = None
         self.ip_public = None
         self.ip_private = None
+        # opaque information stored by the setup provider
+        self.setup_state = None
+        # fingerprint of the setup of the baked image the node was
+        # started from, if any (see `Cluster.bake`)
+        self.baked_from = None
 
     def start(self):
         """
@@ -313,11 +466,15 @@ class Node(object):
 
         return running
 
-    def connect(self):
+    def connect(self, timeout=None):
         """
         Connect to the node via ssh and returns a paramiko.SSHClient
-        object, or None if we are unable to connect.
+        object, or None if we are unable to connect within `timeout`
+        seconds.
         """
+        # imported here, as most commands never connect to the nodes
+        import paramiko
+
         ssh = paramiko.SSHClient()
         ssh.load_system_host_keys()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -327,7 +484,8 @@ class Node(object):
             ssh.connect(self.ip_public,
                         username=self.image_user,
                         allow_agent=True,
-                        key_filename=self.user_key_private)
+                        key_filename=self.user_key_private,
+                        timeout=timeout)
             log.debug("Connection to %s succeded!", self.ip_public)
             return ssh
         except socket.error, ex:
@@ -339,11 +497,13 @@ class Node(object):
 
         return None
 
-    def update_ips(self):
+    def update_ips(self, force=False):
         """
-        Updates the ips of the node through the cloud provider.
+        Updates the ips of the node through the cloud provider. Unless
+        `force` is `True`, the cloud provider is only asked if an
+        address is missing.
         """
-        if not self.ip_private or not self.ip_public:
+        if force or not self.ip_private or not self.ip_public:
             private, public = self._cloud_provider.get_ips(self.instance_id)
             self.ip_public = public
             self.ip_private = private
@@ -364,38 +524,189 @@ instance flavor: %s""" % (self.name, self.ip_public, self.ip_private,
                           self.instance_id, self.flavor)
 
 
-class ClusterStorage(object):
+#: name of the database of `SqliteClusterStorage` in the storage directory
+SQLITE_DATABASE_FILENAME = 'clusters.sqlite'
+
+
+def get_setup_summary(setup_state):
+    """
+    Returns `configured`, `setup failed` or `not configured`
+    depending on the `setup_state` of a node.
+    """
+    if not setup_state:
+        return 'not configured'
+    if setup_state.get('failed'):
+        return 'setup failed'
+    return 'configured'
+
+
+def get_cluster_state(setup_summaries):
+    """
+    Returns the state of a cluster, given the set of the setup
+    summaries of its nodes: it is `configured` only if all its nodes
+    are.
+    """
+    for state in ['setup failed', 'not configured', 'configured']:
+        if state in setup_summaries:
+            return state
+    return 'not configured'
+
+
+def _upgrade_record(db):
+    """
+    Converts a cluster record saved by early versions, with one list
+    of nodes per type, to the current format.
+    """
+    if 'nodes' not in db:
+        db['nodes'] = []
+        for node_type in ['frontend', 'compute']:
+            for record in db.pop(node_type, []):
+                record['type'] = node_type
+                db['nodes'].append(record)
+    return db
+
+
+class AbstractClusterStorage(object):
     """
-    Handles the storage to save information about all the clusters
-    managed by this tool.
+    Defines the contract of the storages used to save information
+    about all the clusters managed by this tool.
+
+    Clusters are saved as records: dictionaries with keys `name`,
+    `template`, `cloud`, `images` and `nodes`, the latter a list of
+    dictionaries with keys `instance_id`, `name`, `type`,
+    `ip_public`, `ip_private`, `setup_state` and `baked_from`.
     """
+    __metaclass__ = ABCMeta
 
     def __init__(self, storage_dir):
         self._storage_dir = storage_dir
 
+    @abstractmethod
+    def dump_cluster(self, cluster):
+        """
+        Saves `cluster`, to load it later on.
+        """
+        pass
+
+    @abstractmethod
+    def load_cluster(self, cluster_name):
+        """
+        Returns the record of the cluster with the given name.
+        Raises `ClusterNotFound` if there is no such cluster.
+        """
+        pass
+
+    @abstractmethod
+    def delete_cluster(self, cluster_name):
+        """
+        Deletes the storage of a cluster.
+        """
+        pass
+
+    @abstractmethod
+    def get_cluster_summaries(self):
+        """
+        Returns a dictionary mapping the name of each stored cluster
+        to its summary, a dictionary with keys `template`, `cloud`,
+        `nodes` (number of nodes of each type), `state` (`configured`,
+        `setup failed` or `not configured`), `created` and `updated`
+        (as seconds since the epoch).
+        """
+        pass
+
+    def get_stored_clusters(self):
+        """
+        Returns a list of all stored clusters.
+        """
+        return self.get_cluster_summaries().keys()
+
+    def iter_nodes(self, cluster_name, types=None, names=None):
+        """
+        Yields the records of the nodes of cluster `cluster_name`, one
+        at a time, in the order they were added. If given, `types`
+        and `names` are lists of shell-style patterns: only the nodes
+        whose type matches one of `types` and whose name matches one
+        of `names` are returned.
+        """
+        for node in self.load_cluster(cluster_name)['nodes']:
+            if matches_any(node['type'], types) \
+                    and matches_any(node['name'], names):
+                yield node
+
+    def lock_cluster(self, cluster_name, exclusive=False, timeout=None):
+        """
+        Returns a context manager holding an advisory lock on cluster
+        `cluster_name`, shared by default. Commands changing a cluster
+        should hold an exclusive lock from the moment they load it
+        until they have saved it, so that they do not overwrite the
+        changes of other commands.
+
+        Raises `ClusterLockTimeout` if the lock cannot be taken within
+        `timeout` seconds.
+        """
+        if not os.path.exists(self._storage_dir):
+            os.makedirs(self._storage_dir)
+        return _FileLock(
+            os.path.join(self._storage_dir, '.%s.lock' % cluster_name),
+            exclusive=exclusive, timeout=timeout,
+            what="cluster `%s`" % cluster_name)
+
+    def get_cluster_data_dir(self, cluster_name):
+        """
+        Returns the path to the data directory of the given cluster,
+        creating it if needed.
+        """
+        data_dir = os.path.join(self._storage_dir, cluster_name + '.d')
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        return data_dir
+
+    def _delete_data_dir(self, cluster_name):
+        data_dir = os.path.join(self._storage_dir, cluster_name + '.d')
+        if os.path.isdir(data_dir):
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    @staticmethod
+    def _get_record(cluster):
+        return {
+            "name": cluster.name, "template": cluster.template,
+            "cloud": cluster._cloud, "images": cluster.images,
+            "nodes": [
+                {'instance_id': node.instance_id,
+                 'name': node.name,
+                 'type': node.type,
+                 'ip_public': node.ip_public,
+                 'ip_private': node.ip_private,
+                 'setup_state': node.setup_state,
+                 'baked_from': node.baked_from}
+                for node in cluster.get_all_nodes()],
+        }
+
+
+class ClusterStorage(AbstractClusterStorage):
+    """
+    Saves each cluster to a JSON file in the storage directory.
+
+    The storage directory also holds an index with a short summary of
+    every cluster (see `get_cluster_summaries`), so that clusters can
+    be listed without reading all their files.
+    """
+
+    #: name of the index file in the storage directory
+    index_filename = '.index.json'
+
     def dump_cluster(self, cluster):
         """
         Saves the information of the cluster to disk in json format to
         load it later on.
         """
-        db = {"name": cluster.name, "template": cluster.template}
+        db = self._get_record(cluster)
         for cls in cluster.nodes:
             db[cls + '_nodes'] = len(cluster.nodes[cls])
-        db["nodes"] = [
-            {'instance_id': node.instance_id,
-             'name': node.name,
-             'type': node.type,
-             'ip_public': node.ip_public,
-             'ip_private': node.ip_private} for node in cluster.get_all_nodes()]
-
-        db_json = json.dumps(db)
 
         db_path = self._get_json_path(cluster.name)
-        self._clear_storage(db_path)
-
-        f = open(db_path, 'w')
-        f.write(unicode(db_json))
-        f.close()
+        self._write_file(db_path, json.dumps(db))
+        self._update_index(cluster.name, self._summarize(db))
 
     def load_cluster(self, cluster_name):
         """
@@ -411,7 +722,7 @@ class ClusterStorage(object):
 
         information = json.loads(db_json)
 
-        return information
+        return _upgrade_record(information)
 
     def delete_cluster(self, cluster_name):
         """
@@ -419,21 +730,123 @@ class ClusterStorage(object):
         """
         db_file = self._get_json_path(cluster_name)
         self._clear_storage(db_file)
+        self._update_index(cluster_name, None)
+        self._delete_data_dir(cluster_name)
+
+    def get_cluster_summaries(self):
+        """
+        Summaries are read from the index; if it is missing, it is
+        built again from the cluster files.
+        """
+        index = self._read_index()
+        if index is None:
+            with self._lock_index():
+                index = self._read_index()
+                if index is None:
+                    index = self._build_index()
+                    self._write_index(index)
+        return index
+
+    @staticmethod
+    def _summarize(db, created=None):
+        nodes = dict()
+        states = set()
+        for node in db.get('nodes', []):
+            nodes[node['type']] = nodes.get(node['type'], 0) + 1
+            states.add(get_setup_summary(node.get('setup_state')))
+        state = get_cluster_state(states)
+        now = time.time()
+        return {'template': db.get('template'), 'cloud': db.get('cloud'),
+                'nodes': nodes, 'state': state,
+                'created': created or now, 'updated': now}
+
+    def _get_index_path(self):
+        if not os.path.exists(self._storage_dir):
+            os.makedirs(self._storage_dir)
+        return os.path.join(self._storage_dir, self.index_filename)
 
-    def get_stored_clusters(self):
+    def _read_index(self):
+        try:
+            with open(self._get_index_path()) as fd:
+                return json.load(fd)['clusters']
+        except (IOError, ValueError, KeyError), ex:
+            if os.path.exists(self._get_index_path()):
+                log.warning("Ignoring invalid storage index: %s", ex)
+            return None
+
+    def _write_index(self, index):
+        self._write_file(self._get_index_path(),
+                         json.dumps({'clusters': index}))
+
+    def _build_index(self):
         """
-        Returns a list of all stored clusters.
+        Returns the summaries of all the cluster files in the storage
+        directory.
         """
-        allfiles = os.listdir(self._storage_dir)
-        db_files = []
-        for fname in allfiles:
+        index = dict()
+        for fname in os.listdir(self._storage_dir):
             fpath = os.path.join(self._storage_dir, fname)
+            if fname.startswith('.'):
+                # hidden files are not clusters, e.g. the index itself
+                continue
             if fname.endswith('.json') and os.path.isfile(fpath):
-                db_files.append(fname[:-5])
+                try:
+                    summary = self._summarize(
+                        self.load_cluster(fname[:-5]),
+                        created=os.path.getmtime(fpath))
+                except ValueError, ex:
+                    log.warning("Ignoring invalid storage file %s: %s",
+                                fpath, ex)
+                    continue
+                summary['updated'] = summary['created']
+                index[fname[:-5]] = summary
+            elif fname.endswith('.d') and os.path.isdir(fpath):
+                # cluster data directory, see `get_cluster_data_dir`
+                continue
             else:
                 log.warning("Ignoring invalid storage file %s", fpath)
+        return index
+
+    def _update_index(self, cluster_name, summary):
+        """
+        Sets the summary of cluster `cluster_name` in the index, or
+        removes it if `summary` is `None`.
+        """
+        with self._lock_index():
+            index = self._read_index()
+            if index is None:
+                # the cluster file is already saved, or removed
+                index = self._build_index()
+            elif summary is None:
+                index.pop(cluster_name, None)
+            else:
+                if cluster_name in index:
+                    summary['created'] = index[cluster_name]['created']
+                index[cluster_name] = summary
+            self._write_index(index)
 
-        return db_files
+    def _lock_index(self):
+        """
+        Returns a context manager holding an exclusive lock on the
+        index, so that concurrent updates are not lost.
+        """
+        return _FileLock(self._get_index_path() + '.lock',
+                         what="the storage index")
+
+    @staticmethod
+    def _write_file(path, data):
+        """
+        Replaces the contents of file `path` with `data` at once:
+        readers get either the old or the new contents, never part of
+        them.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as stream:
+            stream.write(data)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
 
     def _get_json_path(self, cluster_name):
         """
@@ -449,3 +862,96 @@ class ClusterStorage(object):
         """
         if os.path.exists(db_path):
             os.unlink(db_path)
+
+
+class _FileLock(object):
+    """
+    Context manager holding a `flock` on file `path`: exclusive if
+    `exclusive` is `True`, shared otherwise. If the lock cannot be
+    taken within `timeout` seconds, `ClusterLockTimeout` is raised.
+
+    Locks are reentrant within a thread. Asking for an exclusive lock
+    while holding a shared one converts it to exclusive until the
+    inner block ends; as `flock` conversions are not atomic, another
+    command may change the locked data in between.
+    """
+
+    #: locks held by this process, by thread id and path: the open
+    #: file, whether the lock is exclusive and how many times it is held
+    _held = dict()
+
+    def __init__(self, path, exclusive=True, timeout=None, what=None):
+        self._path = path
+        self._exclusive = exclusive
+        self._timeout = timeout
+        self._what = what or path
+        self._key = None
+        self._upgraded = False
+
+    def __enter__(self):
+        self._key = (thread.get_ident(), self._path)
+        held = _FileLock._held.get(self._key)
+        if held is not None:
+            if self._exclusive and not held['exclusive']:
+                try:
+                    self._lock(held['fd'], exclusive=True)
+                except:
+                    # a failed conversion loses the shared lock too
+                    fcntl.flock(held['fd'], fcntl.LOCK_SH)
+                    raise
+                held['exclusive'] = self._upgraded = True
+            held['count'] += 1
+            return self
+
+        fd = open(self._path, 'a')
+        try:
+            self._lock(fd, self._exclusive)
+        except:
+            fd.close()
+            raise
+        _FileLock._held[self._key] = {
+            'fd': fd, 'exclusive': self._exclusive, 'count': 1}
+        return self
+
+    def _lock(self, fd, exclusive):
+        kind = 'exclusive' if exclusive else 'shared'
+        start = time.time()
+        delay = 0.05
+        while True:
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_EX if exclusive
+                                 else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+                break
+            except IOError, ex:
+                if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            waited = time.time() - start
+            if self._timeout is not None and waited >= self._timeout:
+                raise ClusterLockTimeout(
+                    "%s is in use by another elasticluster command: gave "
+                    "up waiting for it after %d seconds."
+                    % (self._what, waited))
+            if delay == 0.05:
+                log.info("Waiting for %s, in use by another elasticluster "
+                         "command...", self._what)
+            time.sleep(delay)
+            delay = min(1.0, delay * 2)
+
+        waited = time.time() - start
+        if waited >= 0.05:
+            log.info("Got %s lock on %s after waiting %.1f seconds.",
+                     kind, self._what, waited)
+        else:
+            log.debug("Got %s lock on %s.", kind, self._what)
+
+    def __exit__(self, *exc_info):
+        held = _FileLock._held[self._key]
+        held['count'] -= 1
+        if held['count'] > 0:
+            if self._upgraded:
+                fcntl.flock(held['fd'], fcntl.LOCK_SH)
+                held['exclusive'] = self._upgraded = False
+            return
+        del _FileLock._held[self._key]
+        fcntl.flock(held['fd'], fcntl.LOCK_UN)
+        held['fd'].close()
@@ -18,32 +18,78 @@
 
 __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
+from collections import namedtuple
 import ConfigParser
 import os
 import sys
 
 from elasticluster import log
-from elasticluster.providers.ec2_boto import BotoCloudProvider
-from elasticluster.providers.gce import GoogleCloudProvider
-from elasticluster.providers.ansible_provider import AnsibleSetupProvider
-from elasticluster.helpers import Singleton
-from elasticluster.cluster import Node, ClusterStorage
+from elasticluster.helpers import Singleton, import_object
+from elasticluster.cluster import Node, ClusterStorage, \
+    SQLITE_DATABASE_FILENAME
 from elasticluster.exceptions import ConfigurationError, ClusterNotFound
 from elasticluster.cluster import Cluster
 
 
+#: Resolved and validated configuration shared by all the nodes of one
+#: type in a cluster template.
+NodeTemplate = namedtuple('NodeTemplate', [
+    'user_key_public', 'user_key_private', 'user_key_name', 'image_user',
+    'security_group', 'image_id', 'flavor', 'image_userdata'])
+
+
 class Configurator(object):
     """
     Responsible to create instances, which need information from the
     configuration file.
     """
 
+    # Providers are given as import paths, and only imported when
+    # used: provider modules pull in large libraries (boto, Ansible,
+    # ...) which most commands do not need. Providers not listed
+    # here are looked up in the `elasticluster.cloud_providers` and
+    # `elasticluster.setup_providers` entry point groups.
     cloud_providers_map = {
-        "ec2_boto": BotoCloudProvider,
-        "google":   GoogleCloudProvider,
+        "ec2_boto": "elasticluster.providers.ec2_boto.BotoCloudProvider",
+        "google":   "elasticluster.providers.gce.GoogleCloudProvider",
     }
 
-    setup_providers_map = {"ansible": AnsibleSetupProvider, }
+    setup_providers_map = {
+        "ansible":
+            "elasticluster.providers.ansible_provider.AnsibleSetupProvider",
+        "ansible-pull":
+            "elasticluster.providers.ansible_pull.AnsiblePullSetupProvider",
+        "shell": "elasticluster.providers.shell_provider.ShellSetupProvider",
+    }
+
+    #: `NodeTemplate` and configuration generation, by (cluster
+    #: template, node type); see `get_node_template`
+    _node_templates = {}
+
+    @staticmethod
+    def get_provider_class(providers_map, entry_point_group, name):
+        """
+        Returns the provider class registered as `name` in
+        `providers_map` or, failing that, as an entry point in
+        `entry_point_group`; returns `None` if there is none.
+        """
+        if not name:
+            return None
+        provider = providers_map.get(name)
+        if provider is None:
+            # `pkg_resources` is slow to import: only use it for
+            # providers which are not built in
+            import pkg_resources
+            for entry_point in pkg_resources.iter_entry_points(
+                    entry_point_group, name):
+                provider = entry_point.load()
+                break
+            else:
+                return None
+        if isinstance(provider, basestring):
+            provider = import_object(provider)
+        providers_map[name] = provider
+        return provider
 
     def create_cloud_provider(self, cloud_name):
         """
@@ -57,9 +103,15 @@ class Configurator(object):
                 "Missing `provider` configuration option in configuration "
                 "file.")
 
-        provider = Configurator.cloud_providers_map[config["provider"]]
+        provider = self.get_provider_class(
+            Configurator.cloud_providers_map, 'elasticluster.cloud_providers',
+            config['provider'])
 
-        if config['provider'] == 'ec2_boto':
+        if provider is None:
+            raise ConfigurationError(
+                "Invalid value `%s` for cloud `provider` in configuration "
+                "file." % config['provider'])
+        elif config['provider'] == 'ec2_boto':
             args = dict()
             # required parameters. They may be found also in the
             # program environment.
@@ -78,6 +130,7 @@ class Configurator(object):
                         % (param, cloud_name, PARAM))
             return provider(**args)
         elif config['provider'] == 'google':
+            args = dict()
             # required parameters
             for param in ['client_id', 'client_secret', 'project_id']:
                 if param not in config:
@@ -93,16 +146,18 @@ class Configurator(object):
                     args[param] = config[param]
             # create the provider
             return provider(**args)
+        else:
+            # plugin providers get all the options of their section
+            args = dict(config)
+            del args['provider']
+            return provider(**args)
 
-        else:  # Invalid `provider`
-            raise ConfigurationError(
-                "Invalid value `%s` for cloud `provider` in configuration "
-                "file." % config['provider'])
-
-    def create_cluster(self, cluster_template, **extra_args):
+    def create_cluster(self, cluster_template, with_nodes=True,
+                       **extra_args):
         """
         Creates a cluster with the needed information from the
-        configuration.
+        configuration. If `with_nodes` is `False`, the cluster has
+        no nodes yet.
         """
         try:
             config = Configuration.Instance().read_cluster_section(
@@ -122,7 +177,8 @@ class Configurator(object):
                     "Invalid configuration for cluster `%s`: "
                     "missing configuration key `%s`." % (config['name'], key))
 
-        nodes = dict((k[:-6],int(config[k])) for k in config if k.endswith('_nodes'))
+        nodes = dict((k[:-6], int(config[k]) if with_nodes else 0)
+                     for k in config if k.endswith('_nodes'))
 
         return Cluster(cluster_template,
                        config.pop('name'),
@@ -137,24 +193,59 @@ class Configurator(object):
                               # does not looks right
 
     def load_cluster(self, cluster_name):
+        """
+        Loads a cluster saved by `ClusterStorage`: the `Cluster` is
+        created from its template, and its nodes straight from the
+        saved records.
+        """
         storage = self.create_cluster_storage()
         information = storage.load_cluster(cluster_name)
 
-        cluster = Configurator().create_cluster(
-            information['template'], name=information['name'])
+        cluster = self.create_cluster(
+            information['template'], with_nodes=False,
+            name=information['name'])
+        for record in information['nodes']:
+            cluster.restore_node(record)
 
-        # Clear cluster nodes.
-        cluster.nodes = dict((k, []) for k in cluster.nodes)
-        for dnode in information['nodes']:
-            if dnode['type'] not in cluster.nodes:
-                cluster.nodes[dnode['type']] = []
-            node = cluster.add_node(dnode['type'], name=dnode['name'])
-            node.instance_id = dnode['instance_id']
-            node.ip_public = dnode['ip_public']
-            node.ip_private = dnode['ip_private']
+        # only nodes added from now on start from baked images
+        cluster.images = information.get('images', {})
 
         return cluster
 
+    def get_node_template(self, cluster_name, node_type):
+        """
+        Returns the `NodeTemplate` of nodes of type `node_type` in
+        cluster template `cluster_name`. Templates are computed once
+        and shared by all the nodes of the same type, until the
+        configuration file changes.
+        """
+        configuration = Configuration.Instance()
+        generation = configuration.generation
+        key = (cluster_name, node_type)
+        cached = Configurator._node_templates.get(key)
+        if cached and cached[0] == generation:
+            return cached[1]
+
+        config = configuration.read_node_section(cluster_name, node_type)
+        for key_name in ['user_key_private', 'user_key_name', 'image_user',
+                         'security_group', 'image_id', 'flavor']:
+            if key_name not in config:
+                raise ConfigurationError(
+                    "Invalid configuration for %s nodes in cluster `%s`: "
+                    "missing configuration key `%s`." % (
+                        node_type, cluster_name, key_name))
+        template = NodeTemplate(
+            user_key_public=config['user_key_public'],
+            user_key_private=config['user_key_private'],
+            user_key_name=config['user_key_name'],
+            image_user=config['image_user'],
+            security_group=config['security_group'],
+            image_id=config['image_id'],
+            flavor=config['flavor'],
+            image_userdata=config.get('image_userdata', ''))
+        Configurator._node_templates[key] = (generation, template)
+        return template
+
     def create_node(self, cluster_name, node_type, cloud_provider, name):
         """
         Creates a node with the needed information from the
@@ -162,40 +253,39 @@ class Configurator(object):
         its type (e.g. a frontend node could differ from a compute
         node).
         """
-        config = Configuration.Instance().read_node_section(
-            cluster_name, node_type)
-
-        for key in ['user_key_private', 'user_key_name', 'image_user',
-                    'security_group', 'image_id', 'flavor']:
-            if key not in config:
-                raise ConfigurationError(
-                    "Invalid configuration for node `%s` in cluster `%s`: "
-                    "missing configuration key `%s`." % (
-                        name, cluster_name, key))
-
-        return Node(name, node_type, cloud_provider, config['user_key_public'],
-                    config["user_key_private"], config['user_key_name'],
-                    config['image_user'], config['security_group'],
-                    config['image_id'], config['flavor'],
-                    image_userdata=config.get('image_userdata', ''))
+        template = self.get_node_template(cluster_name, node_type)
+        return Node(name, node_type, cloud_provider, template.user_key_public,
+                    template.user_key_private, template.user_key_name,
+                    template.image_user, template.security_group,
+                    template.image_id, template.flavor,
+                    image_userdata=template.image_userdata)
 
     def create_cluster_storage(self):
         """
-        Creates the storage to manage clusters.
+        Creates the storage to manage clusters: the SQLite database
+        in the storage directory if there is one (see `elasticluster
+        migrate-storage`), JSON files otherwise.
         """
-        return ClusterStorage(Configuration.Instance().storage_path)
+        storage_path = Configuration.Instance().storage_path
+        if os.path.exists(os.path.join(storage_path,
+                                       SQLITE_DATABASE_FILENAME)):
+            # imported here, to load `sqlite3` only if needed
+            from elasticluster.sqlite_storage import SqliteClusterStorage
+            return SqliteClusterStorage(storage_path)
+        return ClusterStorage(storage_path)
 
     def create_setup_provider(self, setup_provider_name, cluster_name):
         config = Configuration.Instance().read_setup_section(
             setup_provider_name, cluster_name)
 
-        if config.get('provider') not in Configurator.setup_providers_map:
+        provider = self.get_provider_class(
+            Configurator.setup_providers_map, 'elasticluster.setup_providers',
+            config.get('provider'))
+        if provider is None:
             raise ConfigurationError(
                 "Invalid value `%s` for `setup_provider` in configuration "
                 "file." % config.get('provider'))
 
-        provider = Configurator.setup_providers_map[config['provider']]
-
         return provider(
             config.pop('user_key_private'), config.pop('image_user'),
             config.pop('image_user_sudo'), config.pop('image_sudo'),
@@ -259,15 +349,50 @@ class Configuration(object):
         self.storage_path = None
 
         self._config = QuotelessConfigParser(self.config_defaults)
+        # (path, mtime, size) of the file parsed into `_config`
+        self._config_key = None
+        # incremented every time the file is parsed
+        self._generation = 0
+
+    def _get_config(self):
+        """
+        Returns the parsed configuration file. The file is only parsed
+        again if its modification time or size changed, or if
+        `file_path` points to a different file, since the last call.
+        """
+        if self.file_path is None:
+            return self._config
+        try:
+            stat = os.stat(self.file_path)
+            key = (self.file_path, stat.st_mtime, stat.st_size)
+        except OSError:
+            key = (self.file_path, None, None)
+        if key != self._config_key:
+            log.debug("Reading configuration file `%s`", self.file_path)
+            config = QuotelessConfigParser(self.config_defaults)
+            config.read(self.file_path)
+            self._config = config
+            self._config_key = key
+            self._generation += 1
+        return self._config
+
+    @property
+    def generation(self):
+        """
+        A number which changes every time the configuration file is
+        parsed again, e.g. to invalidate values derived from it.
+        """
+        self._get_config()
+        return self._generation
 
     def _read_section(self, name):
         """
         Reads a section from the configuration file and returns a
         dictionary with its content
         """
-        self._config.read(self.file_path)
-        if self._config.has_section(name):
-            return dict(self._config.items(name))
+        config = self._get_config()
+        if config.has_section(name):
+            return dict(config.items(name))
         else:
             raise ConfigParser.NoSectionError("section %s not found in "
                                               "configuration file" % name)
@@ -297,8 +422,9 @@ class Configuration(object):
 
         # merge configuration parts from the cluster and
         # compute/frontend section
-        if self._config.has_section(config_name_general):
-            if self._config.has_section(config_name_specific):
+        parser = self._get_config()
+        if parser.has_section(config_name_general):
+            if parser.has_section(config_name_specific):
                 config = dict(self.read_cluster_section(cluster_name).items() +
                               self._read_section(config_name_specific).items())
             else:
@@ -360,9 +486,8 @@ class Configuration(object):
         Return the list of cluster templates that are defined in the
         configuration file.
         """
-        self._config.read(self.file_path)
         templates = []
-        for section in self._config.sections():
+        for section in self._get_config().sections():
             if section.startswith('cluster/'):
                 templates.append(section.split('/')[1])
         return templates
@@ -0,0 +1,466 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Long-running elasticluster server, and its client.
+
+The daemon listens on a UNIX socket in the storage directory. Clients
+send one JSON object per line, and get back a stream of JSON objects,
+one per line:
+
+- `{"action": "run", "argv": [...], "config": PATH, "storage": PATH,
+  "detach": BOOL}` runs an elasticluster command line as a new job;
+  the answer is `{"job": ID}`, then (unless detached) `{"output":
+  TEXT}` messages and a final `{"exit": CODE}`.
+- `{"action": "attach", "job": ID}` streams the output of a job, from
+  its beginning, and its exit code.
+- `{"action": "jobs"}` returns `{"jobs": [...]}`.
+
+Errors are reported as `{"error": MESSAGE}`; if `"fallback"` is true,
+the client should run the command itself.
+
+Every job runs in a child process forked from the daemon, so it
+starts with the libraries, the parsed configuration and the node
+templates already loaded, while jobs can't interfere with each other.
+"""
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# stdlib imports
+import argparse
+import codecs
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import traceback
+
+# local imports
+from elasticluster import log
+from elasticluster.conf import Configuration, Configurator
+
+
+#: name of the daemon socket in the storage directory
+SOCKET_FILENAME = '.daemon.sock'
+
+#: number of finished jobs kept for `elasticluster jobs` and `attach`
+MAX_FINISHED_JOBS = 100
+
+
+def get_socket_path(storage_path):
+    return os.path.join(storage_path, SOCKET_FILENAME)
+
+
+def _send(stream, message):
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+
+def _receive(stream):
+    for line in stream:
+        yield json.loads(line)
+
+
+class Job(object):
+    """
+    A command line run by the daemon, with all its output.
+    """
+
+    def __init__(self, job_id, argv):
+        self.id = job_id
+        self.argv = argv
+        self.pid = None
+        self.started = time.time()
+        self.ended = None
+        self.exit_code = None
+        self._output = []
+        self._cond = threading.Condition()
+
+    def append(self, text):
+        with self._cond:
+            self._output.append(text)
+            self._cond.notify_all()
+
+    def finish(self, exit_code):
+        with self._cond:
+            self.exit_code = exit_code
+            self.ended = time.time()
+            self._cond.notify_all()
+
+    def follow(self):
+        """
+        Yields the output of the job from its beginning, waiting for
+        more until the job ends.
+        """
+        position = 0
+        while True:
+            with self._cond:
+                while position >= len(self._output) and self.ended is None:
+                    self._cond.wait(1.0)
+                chunks = self._output[position:]
+                position = len(self._output)
+                done = self.ended is not None
+            for chunk in chunks:
+                yield chunk
+            if done:
+                return
+
+    def summary(self):
+        return {'job': self.id, 'argv': self.argv, 'pid': self.pid,
+                'started': self.started, 'ended': self.ended,
+                'exit': self.exit_code}
+
+
+def _build_parser(params):
+    """
+    Returns a parser for the command lines which can be run by the
+    daemon, storing their values into `params`.
+    """
+    # imported here, since `subcommands` uses this module
+    from elasticluster.subcommands import CommandParser, Start, Stop, \
+        ResizeCluster, ListClusters, ListNodes, SetupCluster
+
+    parser = argparse.ArgumentParser(prog='elasticluster')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-s', '--storage')
+    parser.add_argument('-c', '--config')
+    parser.add_argument('--lock-timeout', type=int, default=600)
+    parser.add_argument('--detach', action='store_true', default=False)
+    parser.add_argument('--no-daemon', action='store_true', default=False)
+    subparsers = parser.add_subparsers(parser_class=CommandParser)
+    for command in [Start, Stop, ResizeCluster, ListClusters, ListNodes,
+                    SetupCluster]:
+        command(params).setup(subparsers)
+    return parser
+
+
+def run_command_line(argv):
+    """
+    Runs elasticluster command line `argv` in this process and returns
+    its exit code.
+    """
+    params = argparse.Namespace()
+    try:
+        _build_parser(params).parse_args(argv, namespace=params)
+        log.setLevel(max(1, logging.WARNING - 10 * max(0, params.verbose)))
+        params.func.pre_run()
+        return params.func() or 0
+    except SystemExit, ex:
+        if ex.code is None:
+            return 0
+        if not isinstance(ex.code, int):
+            sys.stderr.write(str(ex.code) + '\n')
+            return 1
+        return ex.code
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            for request in _receive(self.rfile):
+                self.server.daemon.handle(request, self.wfile)
+                break
+        except (IOError, socket.error, ValueError), ex:
+            log.debug("Client connection closed: %s", ex)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """
+    Serves elasticluster commands over a UNIX socket in the storage
+    directory.
+    """
+
+    def __init__(self, config_path, storage_path):
+        self.config_path = os.path.abspath(config_path)
+        self.storage_path = os.path.abspath(storage_path)
+        self.socket_path = get_socket_path(self.storage_path)
+        self.jobs = dict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._server = None
+
+    def warm_up(self):
+        """
+        Parses the configuration, imports the providers used by the
+        cluster templates and resolves their node templates, so that
+        jobs don't have to.
+        """
+        configuration = Configuration.Instance()
+        configurator = Configurator()
+        for template in configuration.list_cluster_templates():
+            try:
+                config = configuration.read_cluster_section(template)
+                cloud = configuration.read_cloud_section(config['cloud'])
+                Configurator.get_provider_class(
+                    Configurator.cloud_providers_map,
+                    'elasticluster.cloud_providers', cloud.get('provider'))
+                setup = configuration.read_setup_section(
+                    config['setup_provider'], template)
+                Configurator.get_provider_class(
+                    Configurator.setup_providers_map,
+                    'elasticluster.setup_providers', setup.get('provider'))
+                for key in config:
+                    if key.endswith('_nodes'):
+                        configurator.get_node_template(template, key[:-6])
+            except Exception, ex:
+                log.debug("Not preloading cluster template `%s`: %s",
+                          template, ex)
+        try:
+            import paramiko
+        except ImportError:
+            pass
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                # left over by a daemon which did not exit cleanly
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError("A daemon is already listening on `%s`."
+                                   % self.socket_path)
+            finally:
+                probe.close()
+
+        self.warm_up()
+        umask = os.umask(0077)
+        try:
+            self._server = _Server(self.socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon = self
+        log.warning("elasticluster daemon listening on `%s`.",
+                    self.socket_path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+    def handle(self, request, stream):
+        action = request.get('action')
+        if action == 'run':
+            if os.path.abspath(request.get('config', '')) != \
+                    self.config_path or \
+                    os.path.abspath(request.get('storage', '')) != \
+                    self.storage_path:
+                _send(stream, {'error': "the daemon uses a different "
+                               "configuration file or storage directory",
+                               'fallback': True})
+                return
+            job = self.start_job(request['argv'])
+            _send(stream, {'job': job.id})
+            if not request.get('detach'):
+                self._stream_job(job, stream)
+        elif action == 'attach':
+            job = self.jobs.get(request.get('job'))
+            if job is None:
+                _send(stream, {'error': "no such job: %s"
+                               % request.get('job')})
+                return
+            self._stream_job(job, stream)
+        elif action == 'jobs':
+            with self._lock:
+                jobs = [job.summary() for job in self.jobs.values()]
+            _send(stream, {'jobs': sorted(jobs, key=lambda j: j['job'])})
+        else:
+            _send(stream, {'error': "unknown action `%s`" % action})
+
+    def _stream_job(self, job, stream):
+        for text in job.follow():
+            _send(stream, {'output': text})
+        _send(stream, {'exit': job.exit_code})
+
+    def start_job(self, argv):
+        """
+        Runs `argv` in a child process, and returns the new `Job`.
+        """
+        with self._lock:
+            job = Job(self._next_id, argv)
+            self._next_id += 1
+            self.jobs[job.id] = job
+            finished = sorted((j for j in self.jobs.values() if j.ended),
+                              key=lambda j: j.ended)
+            for old in finished[:-MAX_FINISHED_JOBS]:
+                del self.jobs[old.id]
+
+        read_fd, write_fd = os.pipe()
+        # make sure no other thread holds the logging locks while
+        # forking, or the child could deadlock on them
+        logging._acquireLock()
+        for handler in logging.root.handlers:
+            handler.acquire()
+        try:
+            pid = os.fork()
+        finally:
+            for handler in logging.root.handlers:
+                handler.release()
+            logging._releaseLock()
+
+        if pid == 0:
+            # child: run the command with its output sent to the pipe
+            exit_code = 1
+            try:
+                os.close(read_fd)
+                self._server.socket.close()
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, 0)
+                os.dup2(write_fd, 1)
+                os.dup2(write_fd, 2)
+                sys.stdout = os.fdopen(1, 'w', 0)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                exit_code = run_command_line(argv)
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+
+        os.close(write_fd)
+        job.pid = pid
+        log.info("Job %d (pid %d): elasticluster %s", job.id, pid,
+                 str.join(' ', argv))
+        reader = threading.Thread(target=self._collect, args=(job, read_fd))
+        reader.daemon = True
+        reader.start()
+        return job
+
+    def _collect(self, job, read_fd):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = os.read(read_fd, 65536)
+            if not data:
+                break
+            job.append(decoder.decode(data))
+        os.close(read_fd)
+        _, status = os.waitpid(job.pid, 0)
+        if os.WIFEXITED(status):
+            job.finish(os.WEXITSTATUS(status))
+        else:
+            job.finish(128 + os.WTERMSIG(status))
+        log.info("Job %d finished with exit code %d.", job.id, job.exit_code)
+
+
+def _connect(storage_path):
+    """
+    Returns a file object connected to the daemon serving
+    `storage_path`, or `None` if no daemon is running.
+    """
+    path = get_socket_path(storage_path)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, ex:
+        log.debug("Not using daemon socket `%s`: %s", path, ex)
+        sock.close()
+        return None
+    return sock.makefile('rw', 0)
+
+
+def _print_job(stream, job_id):
+    """
+    Prints the output streamed by the daemon for job `job_id`, and
+    returns its exit code.
+    """
+    try:
+        for message in _receive(stream):
+            if 'output' in message:
+                sys.stdout.write(message['output'].encode('utf-8'))
+                sys.stdout.flush()
+            elif 'exit' in message:
+                return message['exit']
+            elif 'error' in message:
+                log.error("elasticluster daemon: %s", message['error'])
+                return 1
+    except KeyboardInterrupt:
+        sys.stderr.write(
+            "\nJob %d keeps running in the daemon: run `elasticluster "
+            "attach %d` to follow it again.\n" % (job_id, job_id))
+        return 1
+    log.error("Lost connection to the elasticluster daemon.")
+    return 1
+
+
+def forward(config_path, storage_path, argv, detach=False):
+    """
+    Runs command line `argv` through the daemon, if one is running,
+    and returns its exit code; returns `None` if the command has to
+    be run locally.
+    """
+    stream = _connect(storage_path)
+    if stream is None:
+        return None
+    _send(stream, {'action': 'run', 'argv': argv,
+                   'config': os.path.abspath(config_path),
+                   'storage': os.path.abspath(storage_path),
+                   'detach': detach})
+    message = next(_receive(stream), {})
+    if 'error' in message:
+        log.warning("Not using the elasticluster daemon: %s",
+                    message['error'])
+        return None
+    job_id = message['job']
+    if detach:
+        print("Started job %d: run `elasticluster attach %d` to follow "
+              "it." % (job_id, job_id))
+        return 0
+    return _print_job(stream, job_id)
+
+
+def attach(storage_path, job_id):
+    """
+    Prints the output of job `job_id` of the daemon, and returns its
+    exit code.
+    """
+    stream = _connect(storage_path)
+    if stream is None:
+        log.error("No elasticluster daemon is running.")
+        return 1
+    _send(stream, {'action': 'attach', 'job': job_id})
+    return _print_job(stream, job_id)
+
+
+def list_jobs(storage_path):
+    """
+    Returns the summaries of the jobs of the daemon, or `None` if no
+    daemon is running.
+    """
+    stream = _connect(storage_path)
+    if stream is None:
+        return None
+    _send(stream, {'action': 'jobs'})
+    return next(_receive(stream), {}).get('jobs', [])
@@ -38,6 +38,10 @@ class TimeoutError(Exception):
     pass
 
 
+class ClusterLockTimeout(TimeoutError):
+    pass
+
+
 class ClusterNotFound(Exception):
     pass
 
@@ -17,6 +17,11 @@
 #
 __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
+# stdlib imports
+from fnmatch import fnmatchcase
+import hashlib
+import os
+
 
 class Singleton(object):
     """
@@ -57,3 +62,67 @@ class Singleton(object):
 
     def __instancecheck__(self, inst):
         return isinstance(inst, self._decorated)
+
+
+def import_object(path):
+    """
+    Imports and returns the object at the dotted `path`, e.g.
+    `elasticluster.providers.ec2_boto.BotoCloudProvider`.
+    """
+    module_name, _, name = path.rpartition('.')
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+
+def parse_bool(value):
+    """
+    Converts a configuration value into a boolean. Values are
+    compared case-insensitively against the usual INI-style spellings
+    of truth (`yes`, `true`, `on`, `1`); anything else is `False`.
+    """
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return False
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
+
+
+def matches_any(value, patterns):
+    """
+    Returns `True` if `value` matches any of the shell-style
+    `patterns`, or if `patterns` is empty.
+    """
+    if not patterns:
+        return True
+    for pattern in patterns:
+        if fnmatchcase(value, pattern):
+            return True
+    return False
+
+
+def fingerprint(paths, *values):
+    """
+    Returns a hex SHA1 digest of the names and contents of all the
+    files found in `paths` (files or directory trees), and of the
+    additional `values`.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.isdir(path):
+            files = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                files.extend(os.path.join(dirpath, fname)
+                             for fname in filenames
+                             if not fname.startswith('.')
+                             and not fname.endswith(('.pyc', '.retry')))
+        else:
+            files = [path]
+        for fpath in sorted(files):
+            digest.update(os.path.relpath(fpath, path) + '\0')
+            with open(fpath, 'rb') as fd:
+                for block in iter(lambda: fd.read(65536), ''):
+                    digest.update(block)
+    for value in values:
+        digest.update(str(value) + '\0')
+    return digest.hexdigest()
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Ansible inventories of clusters.
+"""
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# stdlib imports
+import os
+import re
+
+
+#: name of the hosts file in an inventory directory
+HOSTS_FILENAME = 'hosts'
+
+_NUMBERED_RE = re.compile(r'^(?P<prefix>.*?)(?P<number>\d+)$')
+
+
+def compress_names(names):
+    """
+    Returns a list of Ansible host patterns matching exactly the host
+    `names`, using range syntax for runs of consecutive numbers:
+    `compute001`, `compute002`, `compute003` become `compute[001:003]`.
+    """
+    runs = dict()
+    patterns = []
+    for name in names:
+        match = _NUMBERED_RE.match(name)
+        if not match or '[' in name:
+            patterns.append(name)
+            continue
+        # Ansible zero-pads a range to the length of its start only
+        # if it starts with `0`: grouping numbers by their width
+        # gives correct padding in all cases
+        digits = match.group('number')
+        runs.setdefault((match.group('prefix'), len(digits)),
+                        []).append(int(digits))
+
+    for (prefix, width), numbers in runs.items():
+        numbers.sort()
+        start = end = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number == end + 1:
+                end = number
+                continue
+            if number == end:
+                continue
+            if start == end:
+                patterns.append('%s%0*d' % (prefix, width, start))
+            else:
+                patterns.append('%s[%0*d:%0*d]' % (prefix, width, start,
+                                                   width, end))
+            start = end = number
+    return sorted(patterns)
+
+
+def write_inventory(path, nodes, groups, address='ip_public'):
+    """
+    Writes into directory `path` an inventory for `nodes`: a `hosts`
+    file listing, for each group, the names of the nodes whose type
+    maps to that group in `groups`, and one `host_vars` file per node
+    setting the IP found in its `address` attribute.
+
+    Returns the path of the `hosts` file, or `None` if no node
+    belongs to any group.
+    """
+    members = dict()
+    host_vars = os.path.join(path, 'host_vars')
+    for node in nodes:
+        if node.type not in groups:
+            continue
+        if not members:
+            os.makedirs(host_vars)
+        for group in groups[node.type]:
+            members.setdefault(group, []).append(node.name)
+        with open(os.path.join(host_vars, node.name), 'w') as fd:
+            fd.write("ansible_ssh_host: %s\n" % getattr(node, address))
+
+    if not members:
+        return None
+    hosts = os.path.join(path, HOSTS_FILENAME)
+    with open(hosts, 'w') as fd:
+        for group in sorted(members):
+            fd.write("\n[%s]\n" % group)
+            for pattern in compress_names(members[group]):
+                fd.write(pattern + "\n")
+    return hosts
+
+
+def dynamic_inventory(nodes, groups, address='ip_public', host_vars=None):
+    """
+    Returns the inventory of `nodes` (node records, as saved by
+    `ClusterStorage`) as a dictionary in the format expected from
+    Ansible's dynamic inventory scripts called with `--list`,
+    including the `_meta` section with the variables of each host.
+    Variables in `host_vars` are set on every host.
+    """
+    inventory = dict()
+    hostvars = dict()
+    for node in nodes:
+        if node['type'] not in groups:
+            continue
+        for group in groups[node['type']]:
+            inventory.setdefault(group, {'hosts': []})['hosts'].append(
+                node['name'])
+        hostvars[node['name']] = dict(host_vars or {},
+                                      ansible_ssh_host=node[address])
+    for group in inventory.values():
+        group['hosts'].sort()
+    inventory['_meta'] = {'hostvars': hostvars}
+    return inventory
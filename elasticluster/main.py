@@ -29,14 +29,21 @@ import cli.app
 # Elasticluster imports
 from elasticluster import log
 from elasticluster.subcommands import Start, SetupCluster
+from elasticluster.subcommands import BakeImage
+from elasticluster.subcommands import Inventory
+from elasticluster.subcommands import ExecCommand
+from elasticluster.subcommands import Scatter
 from elasticluster.subcommands import Stop
-from elasticluster.subcommands import AbstractCommand
+from elasticluster.subcommands import AbstractCommand, CommandParser
 from elasticluster.subcommands import ListClusters
 from elasticluster.subcommands import ListNodes
 from elasticluster.subcommands import ListTemplates
 from elasticluster.subcommands import ResizeCluster
 from elasticluster.subcommands import SshFrontend
 from elasticluster.subcommands import SftpFrontend
+from elasticluster.subcommands import MigrateStorage
+from elasticluster.subcommands import RunDaemon, ListJobs, AttachJob
+from elasticluster import daemon
 from elasticluster.conf import Configuration
 
 
@@ -61,9 +68,17 @@ class ElasticCloud(cli.app.CommandLineApp):
                     ListNodes(self.params),
                     ListTemplates(self.params),
                     SetupCluster(self.params),
+                    BakeImage(self.params),
+                    Inventory(self.params),
+                    ExecCommand(self.params),
+                    Scatter(self.params),
                     ResizeCluster(self.params),
                     SshFrontend(self.params),
                     SftpFrontend(self.params),
+                    MigrateStorage(self.params),
+                    RunDaemon(self.params),
+                    ListJobs(self.params),
+                    AttachJob(self.params),
                     ]
 
         # global parameters
@@ -77,10 +92,22 @@ class ElasticCloud(cli.app.CommandLineApp):
                        help="Path to the configuration file. Default: `%s`" %
                        self.default_configuration_file,
                        default=self.default_configuration_file)
+        self.add_param('--lock-timeout', metavar='SECONDS', type=int,
+                       default=600,
+                       help="Give up if another elasticluster command "
+                       "keeps the cluster locked for longer than this. "
+                       "Default: %(default)s")
+        self.add_param('--detach', action='store_true', default=False,
+                       help="If `elasticluster daemon` runs the command, "
+                       "do not wait for it to finish; use `elasticluster "
+                       "attach` to follow it later.")
+        self.add_param('--no-daemon', action='store_true', default=False,
+                       help="Run the command in this process, even if "
+                       "`elasticluster daemon` is running.")
 
         # to parse subcommands
         self.subparsers = self.argparser.add_subparsers(
-            title="COMMANDS",
+            title="COMMANDS", parser_class=CommandParser,
             help="Available commands. Run `elasticluster cmd --help` "
             "to have information on command `cmd`.")
 
@@ -146,6 +173,15 @@ class ElasticCloud(cli.app.CommandLineApp):
             print "please specify a valid configuration file"
             sys.exit(1)
 
+        # let the daemon run the command, if there is one
+        if not self.params.no_daemon and \
+                self.params.func.can_run_in_daemon():
+            exit_code = daemon.forward(self.params.config,
+                                       self.params.storage, sys.argv[1:],
+                                       detach=self.params.detach)
+            if exit_code is not None:
+                return exit_code
+
         # call the subcommand function (ususally execute)
         return self.params.func()
 
@@ -21,6 +21,9 @@ __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 # stdlib imports
 from abc import ABCMeta, abstractmethod
 
+# local imports
+from elasticluster.exceptions import InstanceError
+
 
 class AbstractCloudProvider:
     """
@@ -52,6 +55,37 @@ class AbstractCloudProvider:
         """
         pass
 
+    def get_instance_states(self, instance_ids):
+        """
+        Returns a dictionary mapping each of the given instance ids
+        to the state of the instance on the cloud (e.g., `running`),
+        or to `None` if the instance cannot be found.
+
+        This implementation asks about one instance at a time:
+        providers should override it to ask the cloud about all the
+        instances at once.
+        """
+        states = dict()
+        for instance_id in instance_ids:
+            try:
+                if self.is_instance_running(instance_id):
+                    states[instance_id] = 'running'
+                else:
+                    states[instance_id] = 'not running'
+            except InstanceError:
+                states[instance_id] = None
+        return states
+
+    def create_image(self, instance_id, image_name, reboot=True):
+        """
+        Creates a private image from the disk of the given instance
+        and returns its id once it is available. If `reboot` is
+        `True` the instance may be rebooted to get a consistent
+        filesystem.
+        """
+        raise NotImplementedError(
+            "This cloud provider does not support creating images.")
+
 
 class AbstractSetupProvider:
     """
@@ -60,7 +94,8 @@ class AbstractSetupProvider:
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def setup_cluster(self, cluster):
+    def setup_cluster(self, cluster, incremental=False, force=False,
+                      retry_failed=False):
         """
         Setup a cluster. `cluster` must be a
         `elasticluster.cluster.Cluster` class.
@@ -68,6 +103,17 @@ class AbstractSetupProvider:
         This method *must* be idempotent, i.e. it should always be
         safe calling it multiple times..
 
+        If `incremental` is `True`, the provider may restrict the
+        full setup to nodes which were never configured (e.g., after
+        the cluster has been resized) and only refresh the
+        configuration of the others. The provider records what it
+        applied to each node in the node's `setup_state` attribute,
+        which is saved in the cluster storage, and skips the nodes
+        which are already configured unless `force` is `True`.
+
+        If `retry_failed` is `True`, only the nodes on which the last
+        setup failed are configured.
+
         :return: `True` if the cluster is correctly configured, even
                   if the method didn't actually do anything.
 
@@ -75,6 +121,32 @@ class AbstractSetupProvider:
         """
         pass
 
+    def startup_phases(self, cluster):
+        """
+        Returns a list of lists of node types: all the nodes of the
+        types in one list are started, and running, before the nodes
+        of the next list are started. By default, all nodes are
+        started at once.
+        """
+        return [sorted(cluster.nodes)]
+
+    def prepare_node(self, cluster, node):
+        """
+        Called right before `node` is started on the cloud, e.g. to
+        set its `image_userdata`. By default, does nothing.
+        """
+        pass
+
+    def get_fingerprint(self, node_type):
+        """
+        Returns a string identifying the configuration applied to
+        nodes of type `node_type`, which changes whenever the setup
+        would change them, or `None` if the provider cannot tell.
+        Images baked from configured nodes are only used as long as
+        the fingerprint does not change.
+        """
+        return None
+
     @abstractmethod
     def cleanup(self):
         """
@@ -18,12 +18,21 @@
 __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
 # system imports
+import json
 import logging
+import multiprocessing
 import os
+import pipes
+import re
+import shutil
+import tarfile
 import tempfile
+import time
 
 # external imports
 from ansible.playbook import PlayBook
+import ansible.playbook
+import ansible.cache
 import ansible.constants as ansible_constants
 from ansible.errors import AnsibleError
 import ansible.callbacks
@@ -32,10 +41,63 @@ from ansible.callbacks import call_callback_module
 
 # local imports
 from elasticluster.providers import AbstractSetupProvider
+from elasticluster.providers.profiling import SetupProfile
 from elasticluster.cluster import Node
+from elasticluster.exceptions import ConfigurationError
+from elasticluster.helpers import fingerprint, parse_bool
+from elasticluster.inventory import write_inventory
 import elasticluster
 
 
+#: SSH options given by the user (through `ANSIBLE_SSH_ARGS` or
+#: `ansible.cfg`), which are kept in front of our own
+_USER_SSH_ARGS = ansible_constants.ANSIBLE_SSH_ARGS
+
+
+def _exec(ssh, cmd):
+    """
+    Runs `cmd` through the paramiko `ssh` connection and returns its
+    exit code and output.
+    """
+    stdin, stdout, stderr = ssh.exec_command(cmd)
+    stdin.close()
+    output = stdout.read()
+    return stdout.channel.recv_exit_status(), output
+
+
+def _remove_inventory(hosts):
+    """
+    Deletes the temporary inventory directory holding the `hosts`
+    file built by `AnsibleSetupProvider._build_inventory`.
+    """
+    path = os.path.dirname(hosts)
+    try:
+        shutil.rmtree(path)
+    except OSError, ex:
+        elasticluster.log.warning(
+            "AnsibileProvider: Ignoring error while deleting inventory "
+            "directory %s: %s", path, ex)
+
+
+# patterns matching the output of `ansible-playbook` run by a relay node
+_TASK_RE = re.compile(r'^(?:TASK: \[(?P<name>.*)\]|GATHERING FACTS)')
+_RESULT_RE = re.compile(
+    r'^(?P<result>ok|changed|skipping|failed|fatal): \[(?P<host>[^\]]+)\]')
+_RECAP_RE = re.compile(
+    r'^(?P<host>\S+)\s+:\s+ok=(?P<ok>\d+)\s+changed=(?P<changed>\d+)\s+'
+    r'unreachable=(?P<unreachable>\d+)\s+failed=(?P<failed>\d+)')
+_RESULT_STATUS = {'changed': 'ok', 'skipping': 'skipped', 'fatal': 'failed'}
+
+
+def _has_failed(hoststatus):
+    """
+    Returns `True` if Ansible's `hoststatus` summary records failures
+    or unreachability.
+    """
+    return bool(hoststatus and (hoststatus['unreachable'] or
+                                hoststatus['failures']))
+
+
 class ElasticlusterPbCallbacks(ansible.callbacks.PlaybookCallbacks):
     def on_no_hosts_matched(self):
         call_callback_module('playbook_on_no_hosts_matched')
@@ -74,10 +136,163 @@ class ElasticlusterPbCallbacks(ansible.callbacks.PlaybookCallbacks):
         call_callback_module('playbook_on_stats', stats)
 
 
+class _ProfilingCallbacks(object):
+    """
+    Wraps Ansible playbook callbacks, forwarding every event to them
+    and timestamping the start of plays and tasks into a
+    `SetupProfile`; per-host results are recorded by `_ProfilingStats`.
+
+    Ansible sets attributes (e.g. `playbook`) on the callback
+    objects, so attribute writes are forwarded too.
+    """
+
+    def __init__(self, callbacks, profile):
+        object.__setattr__(self, '_callbacks', callbacks)
+        object.__setattr__(self, '_profile', profile)
+
+    def __getattr__(self, name):
+        return getattr(self._callbacks, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._callbacks, name, value)
+
+    def on_play_start(self, pattern):
+        self._profile.play_start(pattern)
+        return self._callbacks.on_play_start(pattern)
+
+    def on_setup(self):
+        self._profile.task_start('GATHERING FACTS')
+        return self._callbacks.on_setup()
+
+    def on_task_start(self, name, is_conditional):
+        self._profile.task_start(name)
+        return self._callbacks.on_task_start(name, is_conditional)
+
+
+class _ProfilingRunnerCallbacks(object):
+    """
+    Wraps Ansible runner callbacks, appending the time at which each
+    host returned its result to file `path`: with more than one fork,
+    these callbacks run in the worker processes, and the file is how
+    the times reach `_ProfilingStats` in this process.
+    """
+
+    def __init__(self, callbacks, path):
+        object.__setattr__(self, '_callbacks', callbacks)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, name):
+        return getattr(self._callbacks, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._callbacks, name, value)
+
+    def _record(self, host):
+        # one short line per `write`, so that the lines of different
+        # workers do not mix
+        with open(self._path, 'a') as fd:
+            fd.write(json.dumps({'host': host, 'end': time.time()}) + '\n')
+
+    def on_ok(self, host, res):
+        self._record(host)
+        return self._callbacks.on_ok(host, res)
+
+    def on_failed(self, host, res, ignore_errors=False):
+        self._record(host)
+        return self._callbacks.on_failed(host, res, ignore_errors)
+
+    def on_skipped(self, host, item=None):
+        self._record(host)
+        return self._callbacks.on_skipped(host, item)
+
+    def on_unreachable(self, host, res):
+        self._record(host)
+        return self._callbacks.on_unreachable(host, res)
+
+
+class _ProfilingStats(ansible.callbacks.AggregateStats):
+    """
+    Ansible statistics which also record the per-host results of
+    each task into a `SetupProfile`.
+
+    The playbook calls `compute` in this process with the results of
+    each task, once all the hosts are done; the time at which each
+    host finished is read from the file written by
+    `_ProfilingRunnerCallbacks`.
+    """
+
+    def __init__(self, profile, path):
+        ansible.callbacks.AggregateStats.__init__(self)
+        self._profile = profile
+        self._path = path
+
+    def _read_end_times(self):
+        """
+        Returns the latest end time recorded for each host since the
+        last call, and empties the file.
+        """
+        ends = {}
+        try:
+            with open(self._path, 'r+') as fd:
+                for line in fd:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    ends[event['host']] = max(event['end'],
+                                              ends.get(event['host'], 0))
+                fd.truncate(0)
+        except IOError, ex:
+            elasticluster.log.debug(
+                "Cannot read task end times from `%s`: %s", self._path, ex)
+        return ends
+
+    def compute(self, runner_results, setup=False, poll=False,
+                ignore_errors=False):
+        ansible.callbacks.AggregateStats.compute(
+            self, runner_results, setup, poll, ignore_errors)
+        ends = self._read_end_times()
+        for host, result in runner_results.get('contacted', {}).iteritems():
+            self._profile.host_done(
+                host, _get_result_status(result, ignore_errors),
+                ends.get(host))
+        for host in runner_results.get('dark', {}):
+            self._profile.host_done(host, 'unreachable', ends.get(host))
+
+
+def _get_result_status(result, ignore_errors=False):
+    """
+    Returns the profile status (`ok`, `failed` or `skipped`) of the
+    result of a task on one host, judged like Ansible's own
+    statistics do.
+    """
+    failed = bool(result.get('failed')) or bool(
+        result.get('failed_when_result', result.get('rc', 0) != 0))
+    if failed and not ignore_errors:
+        return 'failed'
+    if result.get('skipped'):
+        return 'skipped'
+    return 'ok'
+
+
 class AnsibleSetupProvider(AbstractSetupProvider):
     """
+    Configures the cluster by running an Ansible playbook against all
+    its nodes.
     """
 
+    #: number of parallel Ansible processes to run per local CPU
+    forks_per_cpu = 10
+
+    #: default upper bound on the number of parallel Ansible processes
+    default_forks_max = 50
+
+    #: default validity of cached facts, in seconds
+    default_fact_caching_timeout = 24*60*60
+
+    #: valid values for the `ansible_transport` option
+    transports = ('ssh', 'paramiko', 'smart')
+
     def __init__(self, private_key_file, remote_user,
                  sudo_user, sudo, playbook_path, **extra_conf):
         self._private_key_file = os.path.expanduser(
@@ -86,20 +301,134 @@ class AnsibleSetupProvider(AbstractSetupProvider):
         self._sudo_user = sudo_user
         self._sudo = sudo
         self._playbook_path = playbook_path
+        self._refresh_playbook_path = extra_conf.get('refresh_playbook_path')
+        if self._refresh_playbook_path:
+            self._refresh_playbook_path = os.path.expanduser(
+                self._refresh_playbook_path)
         self.groups = dict((k[:-7], v.split(',')) for k, v in extra_conf.items() if k.endswith('_groups'))
 
         self.inventory_path = None
+        self.profile = None
+
+        # parallelism: `ansible_forks` can be a fixed number or
+        # `auto` (default) to derive it from the cluster size
+        forks = extra_conf.get('ansible_forks', 'auto')
+        try:
+            self._forks = (None if forks == 'auto' else int(forks))
+            self._forks_max = int(extra_conf.get('ansible_forks_max',
+                                                 self.default_forks_max))
+        except ValueError:
+            # reported below, like non-positive values
+            self._forks = self._forks_max = 0
+        if self._forks_max < 1 or (self._forks is not None
+                                   and self._forks < 1):
+            raise ConfigurationError(
+                "Invalid value for `ansible_forks` or `ansible_forks_max`: "
+                "expected a positive integer or `auto`.")
+
+        # SSH transport tuning
+        self._transport = extra_conf.get('ansible_transport',
+                                         ansible_constants.DEFAULT_TRANSPORT)
+        if self._transport not in self.transports:
+            raise ConfigurationError(
+                "Invalid value `%s` for `ansible_transport`: must be one "
+                "of %s." % (self._transport, str.join(', ', self.transports)))
+        self._ssh_pipelining = parse_bool(
+            extra_conf.get('ansible_ssh_pipelining', False))
+        self._ssh_control_persist = extra_conf.get(
+            'ansible_ssh_control_persist', '60s')
+
+        try:
+            self._retries = int(extra_conf.get('setup_retries', 0))
+        except ValueError:
+            raise ConfigurationError(
+                "Invalid value for `setup_retries`: expected an integer.")
+
+        # run the setup of the other nodes from the first node of
+        # this type, over the private network
+        self._relay_via = extra_conf.get('ansible_relay_via')
+
+        # persistent fact cache, kept in the cluster data directory
+        self._fact_caching = parse_bool(
+            extra_conf.get('ansible_fact_caching', False))
+        try:
+            self._fact_caching_timeout = int(
+                extra_conf.get('ansible_fact_caching_timeout',
+                               self.default_fact_caching_timeout))
+        except ValueError:
+            raise ConfigurationError(
+                "Invalid value for `ansible_fact_caching_timeout`: expected "
+                "a number of seconds.")
+
         module_dir = extra_conf.get('ansible_module_dir', None)
+        self._module_dirs = []
         if module_dir:
             for mdir in module_dir.split(','):
                 ansible.utils.module_finder.add_directory(mdir.strip())
+                if os.path.isdir(mdir.strip()):
+                    self._module_dirs.append(mdir.strip())
 
         ansible_constants.DEFAULT_PRIVATE_KEY_FILE = self._private_key_file
         ansible_constants.DEFAULT_REMOTE_USER = self._remote_user
         ansible_constants.DEFAULT_SUDO_USER = self._sudo_user
+        ansible_constants.ANSIBLE_SSH_PIPELINING = self._ssh_pipelining
 
-    def setup_cluster(self, cluster):
+    def _setup_ssh_args(self, cluster):
+        """
+        Sets the options of the SSH connections to the nodes of
+        `cluster`: master connections are kept open for
+        `ansible_ssh_control_persist`, with their sockets in the
+        cluster data directory. Options given by the user come first,
+        so that they take precedence.
+        """
+        args = []
+        if _USER_SSH_ARGS:
+            args.append(_USER_SSH_ARGS)
+        if self._ssh_control_persist.lower() in ('', 'no', 'false'):
+            args.append("-o ControlMaster=no")
+        else:
+            control_dir = cluster.get_data_dir()
+            if not os.path.exists(control_dir):
+                os.makedirs(control_dir)
+            args.append("-o ControlMaster=auto -o ControlPersist=%s -o %s" % (
+                self._ssh_control_persist,
+                pipes.quote('ControlPath=' +
+                            os.path.join(control_dir, '%h-%r'))))
+        ansible_constants.ANSIBLE_SSH_ARGS = str.join(' ', args)
+
+    def _get_forks(self, nhosts):
+        """
+        Returns the number of parallel Ansible processes to use for
+        configuring `nhosts` hosts: either the configured
+        `ansible_forks` value, or one process per host up to
+        `forks_per_cpu` processes per local CPU, never exceeding
+        `ansible_forks_max`.
+        """
+        if self._forks is not None:
+            return self._forks
+        try:
+            ncpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            ncpus = 1
+        return max(1, min(nhosts, ncpus * self.forks_per_cpu,
+                          self._forks_max))
+
+    def setup_cluster(self, cluster, incremental=False, force=False,
+                      retry_failed=False):
+        self.profile = SetupProfile(
+            cluster.name, playbook=self._playbook_path,
+            incremental=incremental, force=force, retry_failed=retry_failed)
+        try:
+            return self._setup_cluster(cluster, incremental, force,
+                                       retry_failed)
+        finally:
+            self.profile.finish()
+            if self.profile.tasks:
+                self.profile.save(cluster.get_data_dir())
+
+    def _setup_cluster(self, cluster, incremental, force, retry_failed):
         self.inventory_path = self._build_inventory(cluster)
+        self._setup_ssh_args(cluster)
 
         # check paths
         if not self.inventory_path:
@@ -113,16 +442,393 @@ class AnsibleSetupProvider(AbstractSetupProvider):
                 "inventory file `%s` could not be found" % self.inventory_path)
         # ANTONIO: These should probably be configuration error
         # instead, and should probably checked inside __init__().
-        if not os.path.exists(self._playbook_path):
-            raise AnsibleError(
-                "playbook `%s` could not be found" % self._playbook_path)
-        if not os.path.isfile(self._playbook_path):
-            raise AnsibleError(
-                "the playbook `%s` is not a file" % self._playbook_path)
+        for playbook in [self._playbook_path, self._refresh_playbook_path]:
+            if not playbook:
+                continue
+            if not os.path.exists(playbook):
+                raise AnsibleError(
+                    "playbook `%s` could not be found" % playbook)
+            if not os.path.isfile(playbook):
+                raise AnsibleError(
+                    "the playbook `%s` is not a file" % playbook)
+
+        # the fingerprint of what a node should look like after
+        # setup (see `get_fingerprint`), plus the inventory (i.e.,
+        # which other nodes it should know about)
+        config_digest = self._config_digest()
+        inventory_digest = fingerprint(
+            [os.path.dirname(self.inventory_path)])
+        states = dict(
+            (node_type, {
+                'playbook': self.get_fingerprint(node_type, config_digest),
+                'inventory': inventory_digest,
+            })
+            for node_type in self.groups)
+        nodes = [node for node in cluster.get_all_nodes()
+                 if node.type in self.groups]
+
+        if retry_failed:
+            failed = [node for node in nodes
+                      if node.setup_state and node.setup_state.get('failed')]
+            if not failed:
+                self.cleanup()
+                elasticluster.log.info("No failed nodes to retry.")
+                return True
+            runs = [(self._playbook_path, failed)]
+        elif force:
+            runs = [(self._playbook_path, None)]
+        else:
+            # nodes which never completed this playbook get the full
+            # play; in incremental mode, nodes which only need to
+            # learn about the new cluster membership, or started from
+            # an image baked with this playbook, get the (cheaper)
+            # refresh play; nodes whose fingerprint matches are
+            # skipped altogether
+            full, refresh = [], []
+            for node in nodes:
+                state = states[node.type]
+                if not node.setup_state and \
+                        node.baked_from == state['playbook']:
+                    refresh.append(node)
+                elif not node.setup_state or \
+                        node.setup_state.get('failed') or \
+                        node.setup_state.get('playbook') != state['playbook']:
+                    full.append(node)
+                elif node.setup_state.get('inventory') != state['inventory']:
+                    refresh.append(node)
+            elasticluster.log.info(
+                "Setup: %d node(s) to configure, %d node(s) to refresh, "
+                "%d node(s) up to date.", len(full), len(refresh),
+                len(nodes) - len(full) - len(refresh))
+            if not (incremental and self._refresh_playbook_path):
+                full, refresh = full + refresh, []
+            if not (full or refresh):
+                self.cleanup()
+                elasticluster.log.info(
+                    "Cluster configuration is up to date, nothing to do. "
+                    "Use `elasticluster setup --force` to re-run the "
+                    "setup anyway.")
+                return True
+            runs = [(playbook, subset) for playbook, subset
+                    in [(self._playbook_path, full),
+                        (self._refresh_playbook_path, refresh)] if subset]
+
+        if self._fact_caching:
+            # facts of nodes getting the full play are likely to
+            # change (or belong to a former node with the same name)
+            stale = set()
+            for playbook, subset in runs:
+                if playbook == self._playbook_path:
+                    stale.update(node.name for node in
+                                 (nodes if subset is None else subset))
+            self._setup_fact_cache(cluster, stale)
+
+        status = dict()
+        attempt = 0
+        while True:
+            for playbook, subset in runs:
+                run_status = self._run_playbook(cluster, playbook, subset)
+                if run_status is None:
+                    self.cleanup()
+                    return False
+                status.update(run_status)
+
+            # run again the same playbooks only on the failed hosts,
+            # up to `setup_retries` times
+            failed_runs = []
+            for playbook, subset in runs:
+                failed = [node for node in (nodes if subset is None
+                                            else subset)
+                          if _has_failed(status.get(node.name))]
+                if failed:
+                    failed_runs.append((playbook, failed))
+            if not failed_runs or attempt >= self._retries:
+                break
+            attempt += 1
+            elasticluster.log.warning(
+                "Retrying setup on %d failed node(s) (attempt %d of %d).",
+                sum(len(failed) for _, failed in failed_runs),
+                attempt, self._retries)
+            runs = failed_runs
 
-        elasticluster.log.debug("Using playbook file %s.", self._playbook_path)
+        # delete inventory file
+        self.cleanup()
+
+        # Check ansible status.
+        for host, hoststatus in sorted(status.items()):
+            if hoststatus['unreachable']:
+                elasticluster.log.error("Host `%s` is unreachable.", host)
+            if hoststatus['failures']:
+                elasticluster.log.error(
+                    "Host `%s` had %d failures: please check the Ansible "
+                    "playbook `%s`" % (
+                        host, hoststatus['failures'], self._playbook_path))
+
+        # remember what has been applied to each node, so that
+        # later runs can tell new, changed and failed nodes apart.
+        failed_nodes = []
+        for node in nodes:
+            hoststatus = status.get(node.name)
+            if _has_failed(hoststatus):
+                node.setup_state = dict(node.setup_state or {}, failed=True)
+                failed_nodes.append(node.name)
+            elif hoststatus:
+                node.setup_state = states[node.type].copy()
+
+        if not failed_nodes:
+            elasticluster.log.info("Cluster correctly configured.")
+            # ANTONIO: TODO: We should return an object to identify if
+            # the cluster was correctly configured, if we had
+            # temporary errors or permanent errors.
+            return True
+
+        elasticluster.log.error(
+            "Setup failed on %d node(s): %s. Run `elasticluster setup "
+            "--retry-failed %s` to retry the setup on these nodes only.",
+            len(failed_nodes), str.join(', ', failed_nodes), cluster.name)
+        return False
 
-        stats = ansible.callbacks.AggregateStats()
+    def _config_digest(self):
+        """
+        Returns the digest of the playbook tree, the modules and the
+        login settings.
+        """
+        return fingerprint(
+            [os.path.dirname(os.path.abspath(self._playbook_path))] +
+            self._module_dirs,
+            self._remote_user, self._sudo, self._sudo_user)
+
+    def get_fingerprint(self, node_type, config_digest=None):
+        """
+        Returns the fingerprint of the configuration of nodes of type
+        `node_type`: it covers the playbook tree, the modules, the
+        login settings and the groups of `node_type`.
+        """
+        if node_type not in self.groups:
+            return None
+        if config_digest is None:
+            config_digest = self._config_digest()
+        return fingerprint(
+            [], config_digest, str.join(',', sorted(self.groups[node_type])))
+
+    def _setup_fact_cache(self, cluster, stale_hosts):
+        """
+        Points Ansible's `jsonfile` fact cache to the cluster data
+        directory and drops the cached facts of `stale_hosts`.
+        """
+        facts_dir = os.path.join(cluster.get_data_dir(), 'facts')
+        if not os.path.exists(facts_dir):
+            os.makedirs(facts_dir)
+        for host in stale_hosts:
+            path = os.path.join(facts_dir, host)
+            if os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except OSError, ex:
+                    elasticluster.log.warning(
+                        "Ignoring error while deleting cached facts "
+                        "`%s`: %s", path, ex)
+
+        ansible_constants.CACHE_PLUGIN = 'jsonfile'
+        ansible_constants.CACHE_PLUGIN_CONNECTION = facts_dir
+        ansible_constants.CACHE_PLUGIN_TIMEOUT = self._fact_caching_timeout
+        # `ansible.playbook` creates its cache when imported, and the
+        # cache plugin only reads the settings above when created
+        ansible.playbook.SETUP_CACHE = ansible.cache.FactCache()
+        # only gather facts of hosts which are not in the cache
+        ansible_constants.DEFAULT_GATHERING = 'smart'
+
+    def _run_playbook(self, cluster, playbook, nodes=None):
+        """
+        Runs `playbook` against the current inventory, limited to
+        `nodes` if given, and returns Ansible's per-host status, or
+        `None` if the playbook could not be executed at all.
+
+        In relay mode, the nodes of the relay type are configured
+        from here, and all the other nodes by the relay node itself.
+        """
+        relay = self._get_relay_node(cluster)
+        if relay is None:
+            return self._run_playbook_locally(cluster, playbook, nodes)
+
+        if nodes is None:
+            nodes = [node for node in cluster.get_all_nodes()
+                     if node.type in self.groups]
+        local = [node for node in nodes if node.type == self._relay_via]
+        relayed = [node for node in nodes if node.type != self._relay_via]
+
+        status = dict()
+        if local:
+            local_status = self._run_playbook_locally(cluster, playbook, local)
+            if local_status is None:
+                return None
+            status.update(local_status)
+        if relayed:
+            if _has_failed(status.get(relay.name)):
+                elasticluster.log.error(
+                    "Relay node %s is not configured: not running the setup "
+                    "on the other nodes.", relay.name)
+                relayed_status = None
+            else:
+                relayed_status = self._run_playbook_relayed(
+                    cluster, playbook, relay, relayed)
+            if relayed_status is None:
+                # mark the nodes as unreachable, so that they are
+                # retried with `--retry-failed`
+                relayed_status = dict(
+                    (node.name, {'ok': 0, 'changed': 0, 'skipped': 0,
+                                 'unreachable': 1, 'failures': 0})
+                    for node in relayed)
+            status.update(relayed_status)
+        return status
+
+    def _get_relay_node(self, cluster):
+        """
+        Returns the node running the setup of the others, or `None` if
+        relay mode is not enabled.
+        """
+        if not self._relay_via:
+            return None
+        if not cluster.nodes.get(self._relay_via):
+            elasticluster.log.warning(
+                "No `%s` node to relay the setup through: configuring all "
+                "the nodes directly.", self._relay_via)
+            return None
+        return cluster.nodes[self._relay_via][0]
+
+    def _run_playbook_relayed(self, cluster, playbook, relay, nodes):
+        """
+        Copies the playbook, the modules, a private-network inventory
+        and the private key to the `relay` node, and runs
+        `ansible-playbook` there against `nodes`, streaming its output
+        back. Returns the per-host status parsed from the play recap,
+        or `None` if the playbook could not be run.
+        """
+        ssh = relay.connect()
+        if not ssh:
+            elasticluster.log.error(
+                "Unable to connect to relay node %s.", relay.name)
+            return None
+
+        playbook_dir = os.path.dirname(os.path.abspath(playbook))
+        inventory = self._build_inventory(cluster, address='ip_private')
+        (fd, bundle) = tempfile.mkstemp(suffix='.tgz')
+        os.close(fd)
+        remote_dir = None
+        try:
+            archive = tarfile.open(bundle, 'w:gz')
+            archive.add(playbook_dir, 'playbook')
+            for i, module_dir in enumerate(self._module_dirs):
+                archive.add(module_dir, 'modules/%d' % i)
+            archive.add(os.path.dirname(inventory), 'inventory')
+            archive.close()
+
+            remote_dir = _exec(ssh, 'mktemp -d')[1].strip()
+            sftp = ssh.open_sftp()
+            sftp.put(bundle, remote_dir + '/bundle.tgz')
+            sftp.put(self._private_key_file, remote_dir + '/id')
+            sftp.chmod(remote_dir + '/id', 0600)
+            sftp.close()
+
+            cmd = [
+                'ansible-playbook',
+                '-i', 'inventory/hosts',
+                '--private-key', 'id',
+                '-u', self._remote_user,
+                '-f', str(self._forks or min(len(nodes), self._forks_max)),
+                '-l', str.join(':', [node.name for node in nodes]),
+            ]
+            if parse_bool(self._sudo):
+                cmd += ['--sudo', '-U', self._sudo_user]
+            for i in range(len(self._module_dirs)):
+                cmd += ['-M', 'modules/%d' % i]
+            cmd.append(os.path.join('playbook', os.path.basename(playbook)))
+            env = 'ANSIBLE_HOST_KEY_CHECKING=False'
+            if self._ssh_pipelining:
+                env += ' ANSIBLE_SSH_PIPELINING=1'
+
+            elasticluster.log.info(
+                "Relaying setup of %d node(s) through %s.",
+                len(nodes), relay.name)
+            stdin, stdout, stderr = ssh.exec_command(
+                "cd %s && tar xzf bundle.tgz && %s %s 2>&1" % (
+                    remote_dir, env, str.join(' ', [pipes.quote(arg)
+                                                    for arg in cmd])))
+            stdin.close()
+            status = dict()
+            for line in stdout:
+                line = line.rstrip()
+                elasticluster.log.info("[%s] %s", relay.name, line)
+                self._parse_relayed_output(line, status)
+            exit_code = stdout.channel.recv_exit_status()
+            if not status:
+                elasticluster.log.error(
+                    "Relayed ansible-playbook on %s exited with code %d. "
+                    "Is Ansible installed on the relay node?",
+                    relay.name, exit_code)
+                return None
+            return status
+        finally:
+            if remote_dir:
+                _exec(ssh, 'rm -rf %s' % pipes.quote(remote_dir))
+            ssh.close()
+            if os.path.exists(bundle):
+                os.unlink(bundle)
+            if inventory:
+                _remove_inventory(inventory)
+
+    def _parse_relayed_output(self, line, status):
+        """
+        Updates the profile and `status` with the events reported in
+        one `line` of `ansible-playbook` output.
+        """
+        match = _TASK_RE.match(line)
+        if match:
+            if self.profile:
+                self.profile.task_start(
+                    match.group('name') or 'GATHERING FACTS')
+            return
+        match = _RESULT_RE.match(line)
+        if match:
+            if self.profile:
+                result = match.group('result')
+                self.profile.host_done(match.group('host'),
+                                       _RESULT_STATUS.get(result, result))
+            return
+        match = _RECAP_RE.match(line)
+        if match:
+            status[match.group('host')] = {
+                'ok': int(match.group('ok')),
+                'changed': int(match.group('changed')),
+                'skipped': 0,
+                'unreachable': int(match.group('unreachable')),
+                'failures': int(match.group('failed')),
+            }
+
+    def _run_playbook_locally(self, cluster, playbook, nodes=None):
+        """
+        Runs `playbook` against the current inventory, limited to
+        `nodes` if given, and returns Ansible's per-host status, or
+        `None` if the playbook could not be executed at all.
+        """
+        elasticluster.log.debug("Using playbook file %s.", playbook)
+        if nodes is None:
+            nodes = [node for node in cluster.get_all_nodes()
+                     if node.type in self.groups]
+            subset = None
+        else:
+            subset = str.join(':', [node.name for node in nodes])
+        forks = self._get_forks(len(nodes))
+        elasticluster.log.debug("Running Ansible with %d forks over `%s`.",
+                                forks, self._transport)
+
+        events_path = None
+        if self.profile:
+            fd, events_path = tempfile.mkstemp(prefix='elasticluster-profile.')
+            os.close(fd)
+            stats = _ProfilingStats(self.profile, events_path)
+        else:
+            stats = ansible.callbacks.AggregateStats()
         playbook_cb = ElasticlusterPbCallbacks(verbose=0)
         runner_cb = ansible.callbacks.DefaultRunnerCallbacks()
 
@@ -130,13 +836,19 @@ class AnsibleSetupProvider(AbstractSetupProvider):
             playbook_cb = ansible.callbacks.PlaybookCallbacks()
             runner_cb = ansible.callbacks.PlaybookRunnerCallbacks(stats)
 
+        if self.profile:
+            playbook_cb = _ProfilingCallbacks(playbook_cb, self.profile)
+            runner_cb = _ProfilingRunnerCallbacks(runner_cb, events_path)
+
         pb = PlayBook(
-            playbook=self._playbook_path,
+            playbook=playbook,
             host_list=self.inventory_path,
+            subset=subset,
             remote_user=self._remote_user,
             callbacks=playbook_cb,
             runner_callbacks=runner_cb,
-            forks=10,
+            forks=forks,
+            transport=self._transport,
             stats=stats,
             sudo=self._sudo,
             sudo_user=self._sudo_user,
@@ -144,79 +856,34 @@ class AnsibleSetupProvider(AbstractSetupProvider):
         )
 
         try:
-            status = pb.run()
+            return pb.run()
         except AnsibleError as e:
             elasticluster.log.error(
                 "could not execute ansible playbooks. message=`%s`", str(e))
-            self.cleanup()
-            return False
-
-        # delete inventory file
-        self.cleanup()
+            return None
+        finally:
+            if events_path:
+                os.unlink(events_path)
 
-        # Check ansible status.
-        cluster_failures = False
-        for host, hoststatus in status.items():
-            if hoststatus['unreachable']:
-                elasticluster.log.error(
-                    "Host `%s` is unreachable, "
-                    "please re-run elasticluster setup", host)
-                cluster_failures = True
-            if hoststatus['failures']:
-                elasticluster.log.error(
-                    "Host `%s` had %d failures: please re-run elasticluster "
-                    "setup or check the Ansible playbook `%s`" % (
-                        host, hoststatus['failures'], self._playbook_path))
-                cluster_failures = True
-
-        if not cluster_failures:
-            elasticluster.log.info("Cluster correctly configured.")
-            # ANTONIO: TODO: We should return an object to identify if
-            # the cluster was correctly configured, if we had
-            # temporary errors or permanent errors.
-            return True
-        return False
-
-    def _build_inventory(self, cluster):
+    def _build_inventory(self, cluster, address='ip_public'):
         """
-        Builds the inventory for the given cluster and returns its path
+        Builds the inventory for the given cluster in a temporary
+        directory and returns the path of its hosts file, or `None` if
+        no node needs to be configured. Nodes are reached through the
+        IP in their `address` attribute.
         """
-        inventory = dict()
-        for node in cluster.get_all_nodes():
-            if node.type in self.groups:
-                for group in self.groups[node.type]:
-                    if group not in inventory:
-                        inventory[group] = []
-                    inventory[group].append((node.name, node.ip_public))
-
-        if inventory:
-            # create a temporary file to pass to ansible, since the
-            # api is not stable yet...
-            (fd, fname) = tempfile.mkstemp()
-            fd = os.fdopen(fd, 'w+')
-            elasticluster.log.debug("Writing invenetory file `%s`",
-                                    fname)
-
-            for section, hosts in inventory.items():
-                fd.write("\n["+section+"]\n")
-                if hosts:
-                    for host in hosts:
-                        hostline = "%s ansible_ssh_host=%s\n" % host
-                        fd.write(hostline)
-
-            fd.close()
-
-            return fname
+        path = tempfile.mkdtemp(prefix='elasticluster-inventory.')
+        elasticluster.log.debug("Writing inventory in `%s`", path)
+        hosts = write_inventory(path, cluster.get_all_nodes(), self.groups,
+                                address)
+        if hosts is None:
+            shutil.rmtree(path)
+        return hosts
 
     def cleanup(self):
         """
-        Delete inventory file.
+        Delete inventory directory.
         """
         if self.inventory_path:
-            if os.path.exists(self.inventory_path):
-                try:
-                    os.unlink(self.inventory_path)
-                except OSError, ex:
-                    log.warning(
-                        "AnsibileProvider: Ignoring error while deleting "
-                        "inventory file %s: %s", self.inventory_path, ex)
+            _remove_inventory(self.inventory_path)
+            self.inventory_path = None
@@ -0,0 +1,407 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Pull-mode variant of the Ansible setup provider.
+
+The nodes of the *server* type (usually the frontend) are configured
+from the machine running elasticluster, as with the `ansible`
+provider. All the other nodes are started with a bootstrap script as
+userdata: when they boot, they download the playbook bundle from a
+small HTTP server running on the server node, run `ansible-playbook`
+locally and report their exit code back to the server, from where
+elasticluster collects it.
+"""
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# system imports
+import os
+import tarfile
+import tempfile
+import time
+import uuid
+
+# local imports
+from elasticluster.exceptions import ConfigurationError
+from elasticluster.providers.ansible_provider import AnsibleSetupProvider, \
+    _exec, _remove_inventory
+import elasticluster
+
+
+#: directory, in the home of the login user of the server node, where
+#: the bundle, the HTTP server and the status reports are kept
+PULL_DIR = '.elasticluster-pull'
+
+
+# Served from the server node. Only nodes listed in the `nodes` file
+# can download the bundle, and every request needs the cluster token.
+_SERVER_SCRIPT = r'''
+import os
+import re
+import sys
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+DIR = os.path.abspath(sys.argv[1])
+PORT = int(sys.argv[2])
+TOKEN = open(sys.argv[3]).read().strip()
+NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def _parse(self):
+        url = urlparse(self.path)
+        if parse_qs(url.query).get('token', [''])[0] != TOKEN:
+            self.send_error(403)
+            return None
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or not NAME.match(parts[1]):
+            self.send_error(404)
+            return None
+        return parts
+
+    def do_GET(self):
+        parts = self._parse()
+        if not parts:
+            return
+        try:
+            nodes = open(os.path.join(DIR, 'nodes')).read().split()
+        except IOError:
+            nodes = []
+        bundle = os.path.join(DIR, 'bundle.tgz')
+        if parts[0] != 'bundle' or parts[1] not in nodes \
+                or not os.path.exists(bundle):
+            self.send_error(404)
+            return
+        data = open(bundle, 'rb').read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        parts = self._parse()
+        if not parts:
+            return
+        if parts[0] != 'status':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        with open(os.path.join(DIR, 'status', parts[1]), 'wb') as fd:
+            fd.write(data)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+Server(('', PORT), Handler).serve_forever()
+'''
+
+
+_BOOTSTRAP_SCRIPT = '''#!/bin/sh
+# elasticluster pull-mode bootstrap for %(node_type)s node %(node_name)s
+SERVER='http://%(server)s:%(port)d'
+TOKEN='%(token)s'
+NODE='%(node_name)s'
+WORKDIR=/var/lib/elasticluster
+LOG=/var/log/elasticluster-pull.log
+
+mkdir -p $WORKDIR
+cd $WORKDIR
+if ! command -v ansible-playbook >/dev/null 2>&1; then
+    (apt-get update && apt-get install -y ansible) >>$LOG 2>&1 \\
+        || yum install -y ansible >>$LOG 2>&1 \\
+        || pip install ansible >>$LOG 2>&1
+fi
+# wait for the configuration to be published
+until curl -sf -o bundle.tgz "$SERVER/bundle/$NODE?token=$TOKEN"; do
+    sleep 10
+done
+tar xzf bundle.tgz
+ansible-playbook -c local -i inventory/hosts -l "$NODE" %(module_args)s \\
+    "playbook/%(playbook)s" >>$LOG 2>&1
+echo $? > status
+until curl -sf -X PUT --data-binary @status \\
+        "$SERVER/status/$NODE?token=$TOKEN"; do
+    sleep 10
+done
+'''
+
+
+class AnsiblePullSetupProvider(AnsibleSetupProvider):
+    """
+    Configures the server nodes like `AnsibleSetupProvider`, and lets
+    all the other nodes configure themselves in parallel as they boot.
+    """
+
+    #: default port of the bundle HTTP server on the server node
+    default_pull_port = 8199
+
+    #: default number of seconds to wait for the nodes' reports
+    default_pull_timeout = 60*60
+
+    def __init__(self, private_key_file, remote_user,
+                 sudo_user, sudo, playbook_path, **extra_conf):
+        AnsibleSetupProvider.__init__(
+            self, private_key_file, remote_user, sudo_user, sudo,
+            playbook_path, **extra_conf)
+        self._pull_server = extra_conf.get('pull_server', 'frontend')
+        try:
+            self._pull_port = int(extra_conf.get('pull_port',
+                                                 self.default_pull_port))
+            self._pull_timeout = int(extra_conf.get(
+                'pull_timeout', self.default_pull_timeout))
+        except ValueError:
+            raise ConfigurationError(
+                "Invalid value for `pull_port` or `pull_timeout`: expected "
+                "an integer.")
+
+    def startup_phases(self, cluster):
+        others = [cls for cls in sorted(cluster.nodes)
+                  if cls != self._pull_server]
+        return [[self._pull_server], others]
+
+    def prepare_node(self, cluster, node):
+        """
+        Sets the bootstrap script as userdata of all but the server
+        nodes.
+        """
+        server = self._get_server_node(cluster)
+        if node.type == self._pull_server or node.type not in self.groups \
+                or server is None:
+            return
+        if node.image_userdata:
+            elasticluster.log.warning(
+                "Replacing the configured `image_userdata` of node %s with "
+                "the pull-mode bootstrap script.", node.name)
+        node.image_userdata = _BOOTSTRAP_SCRIPT % {
+            'node_type': node.type,
+            'node_name': node.name,
+            'server': server.ip_private,
+            'port': self._pull_port,
+            'token': self._get_token(cluster),
+            'playbook': os.path.basename(self._playbook_path),
+            'module_args': str.join(' ', ['-M modules/%d' % i for i
+                                          in range(len(self._module_dirs))]),
+        }
+
+    def _get_server_node(self, cluster):
+        if not cluster.nodes.get(self._pull_server):
+            return None
+        return cluster.nodes[self._pull_server][0]
+
+    def _get_token(self, cluster):
+        """
+        Returns the secret shared by the nodes of `cluster` and the
+        bundle server, creating it on first use.
+        """
+        path = os.path.join(cluster.get_data_dir(), 'pull-token')
+        if not os.path.exists(path):
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0600)
+            os.write(fd, uuid.uuid4().hex)
+            os.close(fd)
+        with open(path) as fd:
+            return fd.read().strip()
+
+    def _run_playbook(self, cluster, playbook, nodes=None):
+        """
+        Configures the server nodes from here, and collects the
+        results of the other nodes from the server.
+        """
+        server = self._get_server_node(cluster)
+        if server is None:
+            elasticluster.log.warning(
+                "No `%s` node to serve the configuration: configuring all "
+                "the nodes directly.", self._pull_server)
+            return AnsibleSetupProvider._run_playbook(
+                self, cluster, playbook, nodes)
+
+        if nodes is None:
+            nodes = [node for node in cluster.get_all_nodes()
+                     if node.type in self.groups]
+        local = [node for node in nodes if node.type == self._pull_server]
+        pulling = [node for node in nodes if node.type != self._pull_server]
+
+        status = dict()
+        if local:
+            local_status = AnsibleSetupProvider._run_playbook(
+                self, cluster, playbook, local)
+            if local_status is None:
+                return None
+            status.update(local_status)
+        if pulling:
+            pulled_status = self._collect_pulled(cluster, playbook, server,
+                                                 pulling)
+            if pulled_status is None:
+                return None
+            status.update(pulled_status)
+        return status
+
+    def _collect_pulled(self, cluster, playbook, server, nodes):
+        """
+        Publishes the bundle on the `server` node and waits for the
+        reports of `nodes`. Nodes which already reported in a
+        previous run will not run their bootstrap again, so they are
+        configured from here instead.
+        """
+        ssh = server.connect()
+        if not ssh:
+            elasticluster.log.error(
+                "Unable to connect to server node %s.", server.name)
+            return None
+        try:
+            reported = self._read_reports(ssh)
+            pushed = [node for node in nodes if node.name in reported]
+            waiting = [node for node in nodes if node.name not in reported]
+
+            status = dict()
+            if waiting and playbook == self._playbook_path:
+                self._publish(cluster, ssh, waiting)
+                status.update(self._wait_for_reports(ssh, waiting))
+            else:
+                pushed += waiting
+            if pushed:
+                pushed_status = AnsibleSetupProvider._run_playbook(
+                    self, cluster, playbook, pushed)
+                if pushed_status is None:
+                    return None
+                status.update(pushed_status)
+            return status
+        finally:
+            ssh.close()
+
+    def _publish(self, cluster, ssh, nodes):
+        """
+        Uploads the bundle for `nodes` to the server node and starts
+        the HTTP server there, if not yet running.
+        """
+        inventory = self._build_inventory(cluster, address='ip_private')
+        (fd, bundle) = tempfile.mkstemp(suffix='.tgz')
+        os.close(fd)
+        (fd, token) = tempfile.mkstemp()
+        os.write(fd, self._get_token(cluster))
+        os.close(fd)
+        try:
+            archive = tarfile.open(bundle, 'w:gz')
+            archive.add(os.path.dirname(os.path.abspath(self._playbook_path)),
+                        'playbook')
+            for i, module_dir in enumerate(self._module_dirs):
+                archive.add(module_dir, 'modules/%d' % i)
+            archive.add(os.path.dirname(inventory), 'inventory')
+            archive.close()
+
+            _exec(ssh, 'mkdir -p %s/status' % PULL_DIR)
+            sftp = ssh.open_sftp()
+            sftp.put(bundle, PULL_DIR + '/bundle.tgz.new')
+            sftp.put(token, PULL_DIR + '/token')
+            sftp.chmod(PULL_DIR + '/token', 0600)
+            with sftp.open(PULL_DIR + '/server.py', 'w') as remote:
+                remote.write(_SERVER_SCRIPT)
+            with sftp.open(PULL_DIR + '/nodes.new', 'w') as remote:
+                remote.write(str.join('\n', [node.name for node in nodes]))
+            sftp.close()
+        finally:
+            for path in [bundle, token]:
+                os.unlink(path)
+            _remove_inventory(inventory)
+
+        _exec(ssh, (
+            "cd {dir} && mv -f bundle.tgz.new bundle.tgz "
+            "&& mv -f nodes.new nodes "
+            "&& (test -f pid && kill -0 $(cat pid) 2>/dev/null "
+            "|| (nohup python server.py . {port} token >server.log 2>&1 "
+            "</dev/null & echo $! > pid))").format(
+                dir=PULL_DIR, port=self._pull_port))
+        elasticluster.log.info(
+            "Published configuration for %d node(s) on port %d.",
+            len(nodes), self._pull_port)
+
+    def _read_reports(self, ssh):
+        """
+        Returns a dictionary mapping node names to the exit code they
+        reported.
+        """
+        exit_code, output = _exec(ssh, (
+            "cd %s/status 2>/dev/null && for f in *; do "
+            "test -f \"$f\" && echo \"$f $(cat \"$f\")\"; done"
+            % PULL_DIR))
+        reports = dict()
+        for line in output.splitlines():
+            try:
+                name, code = line.split()
+                reports[name] = int(code)
+            except ValueError:
+                continue
+        return reports
+
+    def _wait_for_reports(self, ssh, nodes):
+        """
+        Polls the server until all `nodes` reported, or the timeout
+        expires, and returns their status in the same format as
+        Ansible's.
+        """
+        names = set(node.name for node in nodes)
+        deadline = time.time() + self._pull_timeout
+        elasticluster.log.info(
+            "Waiting for %d node(s) to configure themselves...", len(names))
+        reports = dict()
+        while time.time() < deadline:
+            reports = dict((name, code) for name, code
+                           in self._read_reports(ssh).items()
+                           if name in names)
+            if len(reports) == len(names):
+                break
+            elasticluster.log.debug("%d of %d node(s) reported.",
+                                    len(reports), len(names))
+            time.sleep(10)
+
+        status = dict()
+        for name in names:
+            code = reports.get(name)
+            if code is None:
+                elasticluster.log.error(
+                    "Node %s did not report within %d seconds.",
+                    name, self._pull_timeout)
+            elif code != 0:
+                elasticluster.log.error(
+                    "Setup of node %s failed with exit code %d: see "
+                    "/var/log/elasticluster-pull.log on the node.",
+                    name, code)
+            status[name] = {
+                'ok': int(code == 0),
+                'changed': 0,
+                'skipped': 0,
+                'unreachable': int(code is None),
+                'failures': int(code is not None and code != 0),
+            }
+        return status
+
@@ -18,6 +18,7 @@
 __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
 import os
+import time
 import urllib
 
 from boto import ec2
@@ -134,6 +135,34 @@ class BotoCloudProvider(AbstractCloudProvider):
         instance = self._load_instance(instance_id)
         instance.terminate()
 
+    def create_image(self, instance_id, image_name, reboot=True):
+        """
+        Creates an image (AMI) from the given instance and waits until
+        it is available.
+        """
+        connection = self._connect()
+        log.debug("Creating image `%s` from instance %s.",
+                  image_name, instance_id)
+        image_id = connection.create_image(
+            instance_id, image_name,
+            description="created by elasticluster from %s" % instance_id,
+            no_reboot=not reboot)
+
+        while True:
+            try:
+                image = connection.get_image(image_id)
+            except Exception, ex:
+                # the image may not be visible right away
+                log.debug("Ignoring error while looking for image %s: %s",
+                          image_id, ex)
+                image = None
+            if image and image.state == 'available':
+                return image_id
+            if image and image.state == 'failed':
+                raise ImageError("creation of image `%s` (%s) failed"
+                                 % (image_name, image_id))
+            time.sleep(10)
+
     def get_ips(self, instance_id):
         self._load_instance(instance_id)
         instance = self._load_instance(instance_id)
@@ -153,6 +182,23 @@ class BotoCloudProvider(AbstractCloudProvider):
         else:
             return False
 
+    def get_instance_states(self, instance_ids):
+        """
+        Returns the states of the given instances, fetched from the
+        cloud with a single request.
+        """
+        connection = self._connect()
+        self._cached_instances = []
+        for res in connection.get_all_instances():
+            self._cached_instances.extend(res.instances)
+        found = dict((inst.id, inst) for inst in self._cached_instances)
+        self._instances.update((instance_id, found[instance_id])
+                               for instance_id in instance_ids
+                               if instance_id in found)
+        return dict((instance_id, found[instance_id].state
+                     if instance_id in found else None)
+                    for instance_id in instance_ids)
+
     def _load_instance(self, instance_id):
         """
         Checks if an instance with the given id is cached. If not it
@@ -32,12 +32,14 @@ import uuid
 
 # 3rd party imports
 from apiclient.discovery import build
+from apiclient.errors import HttpError
 from oauth2client.file import Storage
 from oauth2client.client import AccessTokenRefreshError
 from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.tools import run
 
 # local imports
+from elasticluster.exceptions import ImageError
 from elasticluster.providers import AbstractCloudProvider
 
 
@@ -181,8 +183,8 @@ class GoogleCloudProvider(AbstractCloudProvider):
 
         """
         # construct URLs
-        image_url = '%s%s/global/images/%s' % (GCE_URL, 'google', image_name)
-        project_url = '%s%s' % (GCE_URL, PROJECT_ID)
+        image_url = self._get_image_url(image_name)
+        project_url = '%s%s' % (GCE_URL, self._project_id)
         machine_type_url = '%s/global/machineTypes/%s' % (project_url, flavor)
         # it does not make much sense to set different zone and
         # network for each cluster machine, so we set them
@@ -213,6 +215,11 @@ class GoogleCloudProvider(AbstractCloudProvider):
                  'scopes': GCE_DEFAULT_SCOPES
                  }]
         }
+        if image_userdata:
+            # GCE runs this script at every boot
+            instance['metadata'] = {
+                'items': [{'key': 'startup-script',
+                           'value': image_userdata}]}
 
         # create the instance
         gce = self._connect()
@@ -226,6 +233,26 @@ class GoogleCloudProvider(AbstractCloudProvider):
         # instance name, so let us return that.
         return instance_name
 
+    def _get_image_url(self, image_name):
+        """
+        Returns the URL of image `image_name`, which can be a full URL,
+        an image of the project (e.g. one made by `elasticluster
+        bake`) or one of the public images of Google.
+        """
+        if image_name.startswith(('http://', 'https://')):
+            return image_name
+        gce = self._connect()
+        request = gce.images().get(project=self._project_id,
+                                   image=image_name)
+        try:
+            request.execute(self._auth_http)
+            project = self._project_id
+        except HttpError, ex:
+            if ex.resp.status != 404:
+                raise
+            project = 'google'
+        return '%s%s/global/images/%s' % (GCE_URL, project, image_name)
+
     def stop_instance(self, instance_id):
         """
         Stops the instance with the given id gracefully.
@@ -239,6 +266,38 @@ class GoogleCloudProvider(AbstractCloudProvider):
         response = self._wait_until_done(response)
         # XXX: check for errors!
 
+    def create_image(self, instance_id, image_name, reboot=True):
+        """
+        Creates an image from the boot disk of the given instance and
+        waits until it is ready. GCE images are named, so the image
+        name is returned as its id.
+        """
+        gce = self._connect()
+        request = gce.instances().get(
+            project=self._project_id, instance=instance_id, zone=self._zone)
+        instance = request.execute(self._auth_http)
+        disks = [disk for disk in instance.get('disks', [])
+                 if disk.get('boot', True)]
+        if not disks or 'source' not in disks[0]:
+            # e.g. instances booted from an image, with no persistent
+            # disk to make the new image from
+            raise ImageError("instance `%s` has no persistent boot disk: "
+                             "it cannot be baked"
+                             % instance_id)
+
+        image = {
+            'name': image_name,
+            'description': 'created by elasticluster from %s' % instance_id,
+            'sourceDisk': disks[0]['source'],
+        }
+        request = gce.images().insert(project=self._project_id, body=image)
+        response = request.execute(self._auth_http)
+        response = self._wait_until_done(response)
+        if response and 'error' in response:
+            raise ImageError("creation of image `%s` failed: %s"
+                             % (image_name, response['error']))
+        return image_name
+
     def list_instances(self, filter=None):
         """
         List instances on GCE, optionally filtering the results.
@@ -246,14 +305,31 @@ class GoogleCloudProvider(AbstractCloudProvider):
         :param str filter: Filter specification; see https://developers.google.com/compute/docs/reference/latest/instances/list for details.
         """
         gce = self._connect()
-        request = gce.instances().list(
-            project=self._project_id, filter=filter, zone=self._zone)
-        response = request.execute(self._auth_http)
-        if response and 'items' in response:
-            return response['items']
-        else:
-            # return new empty list
-            return list()
+        items = []
+        page_token = None
+        # GCE returns at most 500 instances per page
+        while True:
+            request = gce.instances().list(
+                project=self._project_id, filter=filter, zone=self._zone,
+                pageToken=page_token)
+            response = request.execute(self._auth_http)
+            if not response:
+                break
+            items.extend(response.get('items', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        return items
+
+    def get_instance_states(self, instance_ids):
+        """
+        Returns the states of the given instances, fetched from the
+        cloud with a single request.
+        """
+        found = dict((item['name'], item['status'].lower())
+                     for item in self.list_instances())
+        return dict((instance_id, found.get(instance_id))
+                    for instance_id in instance_ids)
 
     def is_instance_running(self, instance_id):
         """
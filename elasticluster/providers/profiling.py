@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Timing profiles of setup runs.
+
+A `SetupProfile` is fed by the setup provider with task start and
+per-host task completion events; the resulting report is appended to
+a JSON file in the cluster data directory, so that timings of
+successive runs can be compared.
+"""
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# stdlib imports
+import json
+import os
+import time
+
+# local imports
+from elasticluster import log
+
+
+#: name of the file, in the cluster data directory, holding the profiles
+PROFILE_FILENAME = 'setup-profile.json'
+
+#: number of runs kept in the profile file
+MAX_RUNS = 50
+
+
+class SetupProfile(object):
+    """
+    Records start and end time of each task, for each host.
+    """
+
+    def __init__(self, cluster_name, **info):
+        self.cluster_name = cluster_name
+        self.info = info
+        self.started = time.time()
+        self.ended = None
+        self.tasks = []
+        self._current = None
+
+    def play_start(self, pattern):
+        self._current = None
+
+    def task_start(self, name):
+        self._current = {
+            'name': name,
+            'start': time.time(),
+            'end': None,
+            'hosts': {},
+        }
+        self.tasks.append(self._current)
+
+    def host_done(self, host, status, end=None):
+        """
+        Records that `host` completed the current task with `status`
+        (one of `ok`, `failed`, `skipped`, `unreachable`) at time
+        `end`, by default now.
+        """
+        if self._current is None:
+            return
+        now = time.time()
+        if end is None:
+            end = now
+        self._current['end'] = now
+        self._current['hosts'][host] = {
+            'duration': end - self._current['start'],
+            'status': status,
+        }
+
+    def finish(self):
+        self.ended = time.time()
+
+    def report(self):
+        """
+        Returns the profile as a JSON-serializable dictionary.
+        """
+        tasks = []
+        for task in self.tasks:
+            end = task['end'] or task['start']
+            tasks.append({'name': task['name'],
+                          'duration': end - task['start'],
+                          'hosts': task['hosts']})
+        return {
+            'cluster': self.cluster_name,
+            'started': self.started,
+            'duration': (self.ended or time.time()) - self.started,
+            'info': self.info,
+            'tasks': tasks,
+        }
+
+    def save(self, data_dir):
+        """
+        Appends this profile to the profile file in `data_dir`,
+        keeping only the last `MAX_RUNS` runs.
+        """
+        runs = load_profiles(data_dir)
+        runs.append(self.report())
+        path = os.path.join(data_dir, PROFILE_FILENAME)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as fd:
+                json.dump({'runs': runs[-MAX_RUNS:]}, fd)
+            os.rename(tmp_path, path)
+        except (IOError, OSError), ex:
+            log.warning("Unable to save setup profile to `%s`: %s",
+                        path, ex)
+
+
+def load_profiles(data_dir):
+    """
+    Returns the list of profiles saved in `data_dir`, oldest first.
+    """
+    path = os.path.join(data_dir, PROFILE_FILENAME)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r') as fd:
+            return json.load(fd).get('runs', [])
+    except (IOError, ValueError), ex:
+        log.warning("Ignoring invalid setup profile `%s`: %s", path, ex)
+        return []
+
+
+def slowest(run, top=5):
+    """
+    Returns two lists of `(name, seconds)` tuples: the `top` slowest
+    tasks of profile `run` and the `top` hosts which spent the most
+    time in the setup.
+    """
+    hosts = {}
+    for task in run['tasks']:
+        for host, info in task['hosts'].items():
+            hosts[host] = hosts.get(host, 0.0) + info['duration']
+    tasks = sorted(((task['name'], task['duration'])
+                    for task in run['tasks']),
+                   key=lambda item: item[1], reverse=True)
+    hosts = sorted(hosts.items(), key=lambda item: item[1], reverse=True)
+    return tasks[:top], hosts[:top]
+
+
+def format_summary(run, top=5):
+    """
+    Returns a human readable summary of profile `run`.
+    """
+    tasks, hosts = slowest(run, top)
+    lines = ["Setup took %.1f seconds." % run['duration']]
+    if tasks:
+        lines.append("Slowest tasks:")
+        lines.extend("  %8.1fs  %s" % (secs, name) for name, secs in tasks)
+    if hosts:
+        lines.append("Slowest hosts:")
+        lines.extend("  %8.1fs  %s" % (secs, name) for name, secs in hosts)
+    return str.join('\n', lines)
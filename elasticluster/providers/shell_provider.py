@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# system imports
+import os
+import pipes
+import re
+import threading
+
+# local imports
+from elasticluster.providers import AbstractSetupProvider
+from elasticluster.providers.profiling import SetupProfile
+from elasticluster.exceptions import ConfigurationError
+from elasticluster.helpers import fingerprint, parse_bool
+from elasticluster.remote import ConnectionPool, OutputPrinter, \
+    run_command, run_parallel
+import elasticluster
+
+
+class ShellSetupProvider(AbstractSetupProvider):
+    """
+    Configures the cluster by running one shell script per group on
+    all the nodes of that group, in parallel.
+
+    The scripts are read from the directory given as `playbook_path`:
+    group `foo` is configured by script `foo.sh`. Groups are set up
+    one after the other, in the order given by `shell_order` (or in
+    the order they are first listed in the `<type>_groups` options,
+    frontend first); a node failing one script is not set up any
+    further. Scripts must be idempotent, as they are run again
+    whenever their contents or the list of cluster nodes change.
+    """
+
+    #: default number of nodes set up at the same time
+    default_forks = 100
+
+    def __init__(self, private_key_file, remote_user,
+                 sudo_user, sudo, playbook_path, **extra_conf):
+        self._remote_user = remote_user
+        self._sudo_user = sudo_user
+        self._sudo = sudo
+        self._script_dir = playbook_path
+        self.groups = dict((k[:-7], [g.strip() for g in v.split(',')])
+                           for k, v in extra_conf.items()
+                           if k.endswith('_groups'))
+        try:
+            self._forks = int(extra_conf.get('shell_forks',
+                                             self.default_forks))
+            self._timeout = int(extra_conf.get('shell_timeout', 0)) or None
+        except ValueError:
+            raise ConfigurationError(
+                "Invalid value for `shell_forks` or `shell_timeout`: "
+                "expected an integer.")
+        order = extra_conf.get('shell_order')
+        if order:
+            self._order = [group.strip() for group in order.split(',')]
+        else:
+            self._order = []
+            types = sorted(self.groups,
+                           key=lambda t: (t != 'frontend', t))
+            for node_type in types:
+                for group in self.groups[node_type]:
+                    if group not in self._order:
+                        self._order.append(group)
+        self.profile = None
+
+    def _get_script(self, group):
+        return os.path.join(self._script_dir, group + '.sh')
+
+    def _get_stages(self, node_types):
+        """
+        Returns the ordered list of groups which have a script and
+        are used by any of `node_types`.
+        """
+        used = set()
+        for node_type in node_types:
+            used.update(self.groups.get(node_type, []))
+        return [group for group in self._order
+                if group in used and os.path.isfile(self._get_script(group))]
+
+    def get_fingerprint(self, node_type):
+        """
+        Returns the fingerprint of the scripts applied to nodes of
+        type `node_type`, in the order they are run.
+        """
+        if node_type not in self.groups:
+            return None
+        stages = self._get_stages([node_type])
+        return fingerprint(
+            [self._get_script(group) for group in stages],
+            str.join(',', stages),
+            self._remote_user, self._sudo, self._sudo_user)
+
+    def setup_cluster(self, cluster, incremental=False, force=False,
+                      retry_failed=False):
+        self.profile = SetupProfile(
+            cluster.name, playbook=self._script_dir,
+            incremental=incremental, force=force, retry_failed=retry_failed)
+        try:
+            return self._setup_cluster(cluster, force, retry_failed)
+        finally:
+            self.profile.finish()
+            if self.profile.tasks:
+                self.profile.save(cluster.get_data_dir())
+
+    def _setup_cluster(self, cluster, force, retry_failed):
+        if not os.path.isdir(self._script_dir):
+            raise ConfigurationError(
+                "script directory `%s` could not be found" % self._script_dir)
+
+        nodes = [node for node in cluster.get_all_nodes()
+                 if node.type in self.groups]
+        if not nodes:
+            elasticluster.log.info("No setup required for this cluster.")
+            return True
+        hosts = self._get_hosts(nodes)
+        inventory_digest = fingerprint([], hosts)
+        states = dict(
+            (node_type, {
+                'playbook': self.get_fingerprint(node_type),
+                'inventory': inventory_digest,
+            })
+            for node_type in self.groups)
+
+        if retry_failed:
+            todo = [node for node in nodes
+                    if node.setup_state and node.setup_state.get('failed')]
+        elif force:
+            todo = nodes
+        else:
+            todo = [node for node in nodes
+                    if node.setup_state != states[node.type]]
+        if not todo:
+            elasticluster.log.info(
+                "Cluster configuration is up to date, nothing to do.")
+            return True
+        elasticluster.log.info("Setup: %d node(s) to configure, %d node(s) "
+                               "up to date.", len(todo),
+                               len(nodes) - len(todo))
+
+        pool = ConnectionPool()
+        printer = OutputPrinter()
+        lock = threading.Lock()
+        failed = set()
+        try:
+            for group in self._get_stages(node.type for node in todo):
+                targets = [node for node in todo
+                           if group in self.groups[node.type]
+                           and node.name not in failed]
+                if not targets:
+                    continue
+                with open(self._get_script(group)) as fd:
+                    script = fd.read()
+                self.profile.task_start(group)
+                elasticluster.log.info("Running `%s` on %d node(s).",
+                                       group, len(targets))
+
+                def run(node):
+                    ssh = pool.get(node)
+                    if ssh is None:
+                        return None
+                    code, _ = run_command(
+                        ssh, self._get_command(),
+                        self._get_preamble(node, hosts) + script,
+                        timeout=self._timeout,
+                        on_line=lambda line: printer(node.name, line))
+                    return code
+
+                for node, code in run_parallel(run, targets, self._forks):
+                    with lock:
+                        if code is None:
+                            elasticluster.log.error(
+                                "Node %s is unreachable or timed out "
+                                "running `%s`.", node.name, group)
+                            self.profile.host_done(node.name, 'unreachable')
+                            failed.add(node.name)
+                        elif code != 0:
+                            elasticluster.log.error(
+                                "Script `%s` failed on node %s with exit "
+                                "code %d.", group, node.name, code)
+                            self.profile.host_done(node.name, 'failed')
+                            failed.add(node.name)
+                        else:
+                            self.profile.host_done(node.name, 'ok')
+        finally:
+            pool.close()
+
+        for node in todo:
+            if node.name in failed:
+                node.setup_state = dict(node.setup_state or {}, failed=True)
+            else:
+                node.setup_state = states[node.type].copy()
+
+        if not failed:
+            elasticluster.log.info("Cluster correctly configured.")
+            return True
+        elasticluster.log.error(
+            "Setup failed on %d node(s): %s. Run `elasticluster setup "
+            "--retry-failed %s` to retry the setup on these nodes only.",
+            len(failed), str.join(', ', sorted(failed)), cluster.name)
+        return False
+
+    def _get_command(self):
+        # the configuration gives strings, e.g. `False`
+        if parse_bool(self._sudo):
+            return "sudo -n -H -u %s /bin/sh -s" % pipes.quote(
+                self._sudo_user)
+        return "/bin/sh -s"
+
+    def _get_hosts(self, nodes):
+        """
+        Returns the list of cluster nodes, one per line, as `name
+        private_ip group...`.
+        """
+        return str.join('\n', [
+            "%s %s %s" % (node.name, node.ip_private,
+                          str.join(' ', self.groups[node.type]))
+            for node in sorted(nodes, key=lambda node: node.name)])
+
+    def _get_preamble(self, node, hosts):
+        """
+        Returns the shell code exporting the variables available to
+        the scripts run on `node`.
+        """
+        variables = [
+            ('ELASTICLUSTER_NODE', node.name),
+            ('ELASTICLUSTER_NODE_TYPE', node.type),
+            ('ELASTICLUSTER_GROUPS', str.join(' ', self.groups[node.type])),
+            ('ELASTICLUSTER_HOSTS', hosts),
+        ]
+        members = dict()
+        for line in hosts.splitlines():
+            fields = line.split()
+            for group in fields[2:]:
+                members.setdefault(group, []).append(fields[0])
+        for group, names in sorted(members.items()):
+            variables.append(
+                ('ELASTICLUSTER_GROUP_' + re.sub(r'\W', '_', group),
+                 str.join(' ', names)))
+        return str.join('', ["export %s=%s\n" % (name, pipes.quote(value))
+                             for name, value in variables])
+
+    def cleanup(self):
+        pass
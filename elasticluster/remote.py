@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Running commands on many nodes at once over SSH.
+"""
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# stdlib imports
+from multiprocessing.pool import ThreadPool
+import os
+import pipes
+import socket
+import sys
+import threading
+import time
+
+# local imports
+from elasticluster import log
+
+
+class ConnectionPool(object):
+    """
+    Keeps one SSH connection (as returned by `Node.connect()`) open
+    per node, so that several commands can be run on a node without
+    connecting again. Safe to use from several threads, as long as
+    each node is handled by one thread at a time.
+
+    New connections are given up after `timeout` seconds.
+    """
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self._connections = dict()
+        self._lock = threading.Lock()
+
+    def get(self, node):
+        """
+        Returns the connection to `node`, connecting if needed, or
+        `None` if the node is unreachable.
+        """
+        with self._lock:
+            ssh = self._connections.get(node.name)
+        if ssh is not None and ssh.get_transport() is not None \
+                and ssh.get_transport().is_active():
+            return ssh
+        ssh = node.connect(timeout=self._timeout)
+        if ssh is not None:
+            with self._lock:
+                self._connections[node.name] = ssh
+        return ssh
+
+    def close(self):
+        with self._lock:
+            connections = self._connections.values()
+            self._connections = dict()
+        for ssh in connections:
+            try:
+                ssh.close()
+            except Exception, ex:
+                log.debug("Ignoring error closing SSH connection: %s", ex)
+
+
+class OutputPrinter(object):
+    """
+    Prints lines of output of several nodes, prefixed by the node
+    name, without mixing up lines coming from different threads.
+    """
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def __call__(self, name, line):
+        with self._lock:
+            self._stream.write("%s: %s\n" % (name, line))
+            self._stream.flush()
+
+
+def run_command(ssh, command, stdin_data=None, timeout=None,
+                on_line=None):
+    """
+    Runs `command` through the paramiko connection `ssh` and returns
+    a tuple `(exit_code, output)`, with stdout and stderr merged in
+    `output`. If given, `stdin_data` is written to the command's
+    standard input, and `on_line` is called with each line of output
+    as soon as it is received.
+
+    If the command does not complete within `timeout` seconds, it is
+    abandoned and `exit_code` is `None`.
+    """
+    deadline = (time.time() + timeout) if timeout else None
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.set_combine_stderr(True)
+        if timeout:
+            channel.settimeout(timeout)
+        channel.exec_command(command)
+        if stdin_data:
+            channel.sendall(stdin_data)
+        channel.shutdown_write()
+
+        output = []
+        pending = ''
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                    channel.settimeout(remaining)
+                data = channel.recv(32768)
+                if not data:
+                    break
+                lines = (pending + data).split('\n')
+                pending = lines.pop()
+                output.extend(lines)
+                if on_line:
+                    for line in lines:
+                        on_line(line)
+        except socket.timeout:
+            return None, str.join('\n', output + [pending])
+        if pending:
+            output.append(pending)
+            if on_line:
+                on_line(pending)
+        return channel.recv_exit_status(), str.join('\n', output)
+    finally:
+        channel.close()
+
+
+def run_parallel(func, items, max_workers):
+    """
+    Calls `func` on each of `items`, in at most `max_workers`
+    threads, and yields `(item, result)` tuples as soon as each call
+    completes. Exceptions raised by `func` are logged and yield `None`
+    as result.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    def call(item):
+        try:
+            return item, func(item)
+        except Exception, ex:
+            log.error("Error processing %s: %s", item, ex)
+            return item, None
+
+    pool = ThreadPool(max(1, min(max_workers, len(items))))
+    try:
+        for item, result in pool.imap_unordered(call, items):
+            yield item, result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_scp_command(key_file, path, user, host):
+    """
+    Returns the shell command copying file `path` to the same path on
+    `host`. The remote path is quoted twice: `scp` has it interpreted
+    again by the shell on `host`.
+    """
+    return ("scp -q -i {key} -o BatchMode=yes -o StrictHostKeyChecking=no "
+            "-o UserKnownHostsFile=/dev/null {path} {target}").format(
+                key=pipes.quote(key_file), path=pipes.quote(path),
+                target=pipes.quote('%s@%s:%s' % (user, host,
+                                                  pipes.quote(path))))
+
+
+def scatter(pool, seed, targets, path, key_file, forks=50, timeout=None):
+    """
+    Copies file `path` from node `seed` to the same path on all the
+    `targets` nodes, over their private network. In each round,
+    every node which already has the file sends it to one node which
+    does not, so the number of rounds grows with the logarithm of the
+    number of targets.
+
+    A copy of the private `key_file` is kept on the sending nodes
+    while they send; it is removed at the end.
+
+    Returns the list of the targets which did not get the file.
+    """
+    remote_key = '.elasticluster-scatter-%d.key' % os.getpid()
+    holders = [seed]
+    missing = list(targets)
+    keyed = set()
+    keyed_lock = threading.Lock()
+
+    def send(transfer):
+        sender, target = transfer
+        ssh = pool.get(sender)
+        if ssh is None:
+            return None
+        with keyed_lock:
+            needs_key = sender.name not in keyed
+        if needs_key:
+            sftp = ssh.open_sftp()
+            try:
+                sftp.put(key_file, remote_key)
+                sftp.chmod(remote_key, 0600)
+            finally:
+                sftp.close()
+            with keyed_lock:
+                keyed.add(sender.name)
+        exit_code, output = run_command(
+            ssh, _get_scp_command(remote_key, path, target.image_user,
+                                  target.ip_private),
+            timeout=timeout)
+        if exit_code != 0:
+            log.warning("Copy from %s to %s failed: %s",
+                        sender.name, target.name, output.strip())
+        return exit_code
+
+    try:
+        while missing:
+            transfers = zip(holders, missing)
+            log.info("Copying `%s` to %d more node(s).", path, len(transfers))
+            received = []
+            for (sender, target), exit_code in run_parallel(send, transfers,
+                                                            forks):
+                if exit_code == 0:
+                    received.append(target)
+            if not received:
+                # no progress: the remaining nodes are unreachable
+                break
+            holders.extend(received)
+            missing = [node for node in missing if node not in received]
+    finally:
+        def remove_key(node):
+            ssh = pool.get(node)
+            if ssh is not None:
+                run_command(ssh, 'rm -f %s' % remote_key, timeout=timeout)
+        for node, _ in run_parallel(remove_key, [node for node in holders
+                                                 if node.name in keyed],
+                                    forks):
+            pass
+    return missing
@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+#
+# Copyright (C) 2013 GC3, University of Zurich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Cluster storage in a SQLite database.
+"""
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+# stdlib imports
+import json
+import os
+import sqlite3
+import time
+
+# local imports
+from elasticluster import log
+from elasticluster.cluster import AbstractClusterStorage, ClusterStorage, \
+    SQLITE_DATABASE_FILENAME, get_cluster_state, get_setup_summary
+from elasticluster.exceptions import ClusterNotFound
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    name TEXT PRIMARY KEY,
+    template TEXT,
+    cloud TEXT,
+    images TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    cluster TEXT NOT NULL REFERENCES clusters (name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    instance_id TEXT,
+    type TEXT,
+    ip_public TEXT,
+    ip_private TEXT,
+    setup_state TEXT,
+    state TEXT,
+    baked_from TEXT,
+    PRIMARY KEY (cluster, name)
+);
+CREATE INDEX IF NOT EXISTS nodes_instance_id ON nodes (instance_id);
+CREATE INDEX IF NOT EXISTS nodes_type ON nodes (cluster, type);
+CREATE INDEX IF NOT EXISTS nodes_state ON nodes (state);
+"""
+
+_NODE_COLUMNS = ['instance_id', 'type', 'ip_public', 'ip_private',
+                 'setup_state', 'state', 'baked_from']
+
+# columns of the node records, see `_get_node_record`
+_RECORD_COLUMNS = ("instance_id, name, type, ip_public, ip_private, "
+                   "setup_state, baked_from")
+
+
+def get_database_path(storage_dir):
+    return os.path.join(storage_dir, SQLITE_DATABASE_FILENAME)
+
+
+class SqliteClusterStorage(AbstractClusterStorage):
+    """
+    Saves clusters to a SQLite database in the storage directory,
+    with one row per cluster and one per node. Saving a cluster only
+    writes the rows of the nodes which changed, and several
+    `elasticluster` processes can safely use the same database.
+    """
+
+    #: seconds to wait for another process to finish writing
+    timeout = 60
+
+    def __init__(self, storage_dir, database_path=None):
+        AbstractClusterStorage.__init__(self, storage_dir)
+        self._database_path = database_path or get_database_path(storage_dir)
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            if not os.path.exists(self._storage_dir):
+                os.makedirs(self._storage_dir)
+            # transactions are started explicitly, see `_transaction`
+            self._db = sqlite3.connect(self._database_path,
+                                       timeout=self.timeout,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA foreign_keys=ON")
+            self._db.executescript(_SCHEMA)
+            # databases created before nodes were baked
+            columns = [row[1] for row in
+                       self._db.execute("PRAGMA table_info(nodes)")]
+            if 'baked_from' not in columns:
+                self._db.execute(
+                    "ALTER TABLE nodes ADD COLUMN baked_from TEXT")
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _transaction(self):
+        """
+        Returns a context manager running a write transaction: the
+        database is locked for writing from the start, so that
+        concurrent updates of the same cluster are serialized.
+        """
+        return _Transaction(self._connect())
+
+    def dump_cluster(self, cluster):
+        """
+        Saves `cluster`, only updating the rows of the nodes which
+        changed since it was last saved.
+        """
+        self.save_record(self._get_record(cluster))
+
+    def save_record(self, record, created=None):
+        """
+        Saves a cluster record (see `AbstractClusterStorage`). If the
+        cluster is new, its creation time is set to `created` or to
+        the current time.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO clusters (name, created) "
+                       "VALUES (?, ?)", (record['name'], created or now))
+            db.execute("UPDATE clusters SET template = ?, cloud = ?, "
+                       "images = ?, updated = ? WHERE name = ?",
+                       (record.get('template'), record.get('cloud'),
+                        json.dumps(record.get('images', {})), now,
+                        record['name']))
+
+            saved = dict(
+                (row[0], tuple(row[1:])) for row in db.execute(
+                    "SELECT name, %s FROM nodes WHERE cluster = ?"
+                    % str.join(', ', _NODE_COLUMNS), (record['name'],)))
+            for node in record['nodes']:
+                # records saved by older versions lack the newer keys
+                setup_state = node.get('setup_state')
+                values = (
+                    node['instance_id'], node['type'], node.get('ip_public'),
+                    node.get('ip_private'),
+                    json.dumps(setup_state, sort_keys=True),
+                    get_setup_summary(setup_state), node.get('baked_from'))
+                previous = saved.pop(node['name'], None)
+                if previous is None:
+                    db.execute(
+                        "INSERT INTO nodes (cluster, name, %s) "
+                        "VALUES (?, ?, %s)"
+                        % (str.join(', ', _NODE_COLUMNS),
+                           str.join(', ', ['?'] * len(_NODE_COLUMNS))),
+                        (record['name'], node['name']) + values)
+                elif previous != values:
+                    db.execute(
+                        "UPDATE nodes SET %s WHERE cluster = ? AND name = ?"
+                        % str.join(', ', ['%s = ?' % column
+                                          for column in _NODE_COLUMNS]),
+                        values + (record['name'], node['name']))
+            # nodes which are no longer part of the cluster
+            db.executemany("DELETE FROM nodes WHERE cluster = ? AND name = ?",
+                           [(record['name'], name) for name in saved])
+
+    def load_cluster(self, cluster_name):
+        db = self._connect()
+        row = db.execute("SELECT template, cloud, images FROM clusters "
+                         "WHERE name = ?", (cluster_name,)).fetchone()
+        if row is None:
+            raise ClusterNotFound("Cluster `%s` not found in %s" % (
+                cluster_name, self._database_path))
+        record = {'name': cluster_name, 'template': row[0],
+                  'cloud': row[1], 'images': json.loads(row[2] or '{}'),
+                  'nodes': []}
+        # rows are returned in the order the nodes were added
+        for row in db.execute(
+                "SELECT %s FROM nodes WHERE cluster = ? ORDER BY rowid"
+                % _RECORD_COLUMNS, (cluster_name,)):
+            node = self._get_node_record(row)
+            record['nodes'].append(node)
+            key = node['type'] + '_nodes'
+            record[key] = record.get(key, 0) + 1
+        return record
+
+    def iter_nodes(self, cluster_name, types=None, names=None):
+        """
+        Yields the records of the nodes of cluster `cluster_name` as
+        they are read from the database, which does the filtering.
+        """
+        db = self._connect()
+        if db.execute("SELECT 1 FROM clusters WHERE name = ?",
+                      (cluster_name,)).fetchone() is None:
+            raise ClusterNotFound("Cluster `%s` not found in %s" % (
+                cluster_name, self._database_path))
+        query = "SELECT %s FROM nodes WHERE cluster = ?" % _RECORD_COLUMNS
+        args = [cluster_name]
+        for column, patterns in [('type', types), ('name', names)]:
+            if patterns:
+                query += " AND (%s)" % str.join(
+                    ' OR ', ["%s GLOB ?" % column] * len(patterns))
+                args.extend(patterns)
+        for row in db.execute(query + " ORDER BY rowid", args):
+            yield self._get_node_record(row)
+
+    @staticmethod
+    def _get_node_record(row):
+        return {'instance_id': row[0], 'name': row[1], 'type': row[2],
+                'ip_public': row[3], 'ip_private': row[4],
+                'setup_state': json.loads(row[5] or 'null'),
+                'baked_from': row[6]}
+
+    def delete_cluster(self, cluster_name):
+        with self._transaction() as db:
+            db.execute("DELETE FROM nodes WHERE cluster = ?", (cluster_name,))
+            db.execute("DELETE FROM clusters WHERE name = ?", (cluster_name,))
+        self._delete_data_dir(cluster_name)
+
+    def get_cluster_summaries(self):
+        db = self._connect()
+        summaries = dict()
+        for name, template, cloud, created, updated in db.execute(
+                "SELECT name, template, cloud, created, updated "
+                "FROM clusters"):
+            summaries[name] = {'template': template, 'cloud': cloud,
+                               'nodes': {}, 'state': set(),
+                               'created': created, 'updated': updated}
+        for cluster, node_type, state, count in db.execute(
+                "SELECT cluster, type, state, COUNT(*) FROM nodes "
+                "GROUP BY cluster, type, state"):
+            summary = summaries[cluster]
+            summary['nodes'][node_type] = \
+                summary['nodes'].get(node_type, 0) + count
+            summary['state'].add(state)
+        for summary in summaries.values():
+            summary['state'] = get_cluster_state(summary['state'])
+        return summaries
+
+
+class _Transaction(object):
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        return self._db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._db.execute("COMMIT")
+        else:
+            self._db.execute("ROLLBACK")
+
+
+def migrate_json_storage(storage_dir):
+    """
+    Copies all the clusters saved in JSON files in `storage_dir` into
+    the SQLite database, then moves the JSON files to subdirectory
+    `.migrated`. Files saved by early versions, with one list of
+    nodes per type, are converted as well.
+
+    A new database is filled under a temporary name, and only put in
+    place once all the clusters are copied: if the migration fails,
+    the JSON files stay in use.
+
+    Returns the names of the migrated clusters.
+    """
+    json_storage = ClusterStorage(storage_dir)
+    database_path = get_database_path(storage_dir)
+    if os.path.exists(database_path):
+        tmp_path = None
+        sqlite_storage = SqliteClusterStorage(storage_dir)
+    else:
+        tmp_path = os.path.join(storage_dir, '.%s.%d.tmp' % (
+            SQLITE_DATABASE_FILENAME, os.getpid()))
+        sqlite_storage = SqliteClusterStorage(storage_dir, tmp_path)
+
+    # scan the files, in case some were copied by hand
+    clusters = sorted(json_storage._build_index().items())
+    try:
+        for name, summary in clusters:
+            sqlite_storage.save_record(json_storage.load_cluster(name),
+                                       created=summary['created'])
+        sqlite_storage.close()
+        if tmp_path is not None:
+            os.rename(tmp_path, database_path)
+    except:
+        sqlite_storage.close()
+        if tmp_path is not None:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(tmp_path + suffix):
+                    os.unlink(tmp_path + suffix)
+        raise
+
+    backup_dir = os.path.join(storage_dir, '.migrated')
+    migrated = []
+    for name, _ in clusters:
+        if not os.path.exists(backup_dir):
+            os.makedirs(backup_dir)
+        os.rename(json_storage._get_json_path(name),
+                  os.path.join(backup_dir, name + '.json'))
+        log.info("Cluster `%s` migrated to %s.", name, database_path)
+        migrated.append(name)
+    for fname in os.listdir(storage_dir):
+        if fname.startswith(ClusterStorage.index_filename):
+            os.unlink(os.path.join(storage_dir, fname))
+    return migrated
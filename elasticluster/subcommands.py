@@ -19,17 +19,55 @@ __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
 # stdlib imports
 from abc import ABCMeta, abstractmethod
+import argparse
+from collections import OrderedDict
+import ConfigParser
+import csv
 from fnmatch import fnmatch
+import hashlib
+import itertools
+import json
 import os
+import pipes
+import signal
+import subprocess
 import sys
+import time
 
 # local imports
 from elasticluster.conf import Configurator
 from elasticluster.conf import Configuration
-from elasticluster import log
+from elasticluster import daemon, log
 from elasticluster.exceptions import ClusterNotFound, ConfigurationError
+from elasticluster.exceptions import ClusterLockTimeout
 from elasticluster.exceptions import ImageError, SecurityGroupError
 from elasticluster.exceptions import NodeNotFound
+from elasticluster.cluster import get_setup_summary
+from elasticluster.helpers import matches_any, parse_bool
+from elasticluster.inventory import compress_names, dynamic_inventory
+from elasticluster.providers.profiling import format_summary, load_profiles
+from elasticluster.remote import ConnectionPool, OutputPrinter, \
+    run_command, run_parallel, scatter
+
+
+class CommandParser(argparse.ArgumentParser):
+    """
+    Parser of the command line of a subcommand. If `rest_dest` is
+    set, everything after the first `--` is stored unparsed into that
+    attribute: argparse alone cannot tell a trailing command from the
+    other positional arguments when options come in between.
+    """
+    rest_dest = None
+
+    def parse_known_args(self, args=None, namespace=None):
+        if self.rest_dest is None or args is None or '--' not in args:
+            return argparse.ArgumentParser.parse_known_args(
+                self, args, namespace)
+        split = args.index('--')
+        namespace, extras = argparse.ArgumentParser.parse_known_args(
+            self, args[:split], namespace)
+        setattr(namespace, self.rest_dest, args[split + 1:])
+        return namespace, extras
 
 
 class AbstractCommand():
@@ -69,7 +107,18 @@ class AbstractCommand():
         pass
 
     def __call__(self):
-        return self.execute()
+        lock = self.get_cluster_lock()
+        if lock is None:
+            return self.execute()
+        cluster_name, exclusive = lock
+        storage = Configurator().create_cluster_storage()
+        try:
+            with storage.lock_cluster(cluster_name, exclusive,
+                                      timeout=self.params.lock_timeout):
+                return self.execute()
+        except ClusterLockTimeout, ex:
+            log.error(str(ex))
+            return 1
 
     def pre_run(self):
         """
@@ -78,6 +127,23 @@ class AbstractCommand():
         """
         pass
 
+    def can_run_in_daemon(self):
+        """
+        Returns `True` if the command can be passed on to a running
+        `elasticluster daemon`, i.e., if it does not interact with the
+        user.
+        """
+        return False
+
+    def get_cluster_lock(self):
+        """
+        Returns `(cluster_name, exclusive)` if the command must hold a
+        lock on a cluster while it runs, `None` otherwise. Commands
+        which save the cluster need an exclusive lock, commands which
+        only read it a shared one.
+        """
+        return None
+
 
 def cluster_summary(cluster):
     try:
@@ -139,6 +205,12 @@ class Start(AbstractCommand):
             raise ConfigurationError(
                 "Invalid argument for option --nodes: %s" % self.params.nodes)
 
+    def can_run_in_daemon(self):
+        return True
+
+    def get_cluster_lock(self):
+        return self.params.cluster_name or self.params.cluster, True
+
     def execute(self):
         """
         Starts a new cluster.
@@ -176,7 +248,7 @@ class Start(AbstractCommand):
             else:
                 print("Configuring the cluster.")
                 print("(this too may take a while...)")
-                ret = cluster.setup()
+                ret = cluster.setup(incremental=True)
                 if ret:
                     print("Your cluster is ready!")
             print(cluster_summary(cluster))
@@ -205,6 +277,13 @@ class Stop(AbstractCommand):
         parser.add_argument('--yes', action="store_true", default=False,
                             help="Assume `yes` to all queries and do not prompt.")
 
+    def can_run_in_daemon(self):
+        # the confirmation prompt needs a terminal
+        return self.params.yes
+
+    def get_cluster_lock(self):
+        return self.params.cluster, True
+
     def execute(self):
         """
         Stops the cluster if it's running.
@@ -242,6 +321,10 @@ class ResizeCluster(AbstractCommand):
                             help="Increase verbosity.")
         parser.add_argument('--no-setup', action="store_true", default=False,
                             help="Only start the cluster, do not configure it")
+        parser.add_argument('--full-setup', action="store_true",
+                            default=False,
+                            help="Run the whole setup on all the nodes, "
+                            "instead of only on the new ones.")
 
     def pre_run(self):
         self.params.nodes_to_add = {}
@@ -259,6 +342,12 @@ class ResizeCluster(AbstractCommand):
             raise ConfigurationError(
                 "Invalid syntax for argument: %s" % self.params.nodes)
 
+    def can_run_in_daemon(self):
+        return True
+
+    def get_cluster_lock(self):
+        return self.params.cluster, True
+
     def execute(self):
         # Get current cluster configuration
         cluster_name = self.params.cluster
@@ -287,7 +376,8 @@ class ResizeCluster(AbstractCommand):
             print("NOT configuring the cluster as requested.")
         else:
             print("Reconfiguring the cluster.")
-            cluster.setup()
+            cluster.setup(incremental=not self.params.full_setup,
+                          force=self.params.full_setup)
         print(cluster_summary(cluster))
 
 
@@ -302,33 +392,110 @@ class ListClusters(AbstractCommand):
         parser.set_defaults(func=self)
         parser.add_argument('-v', '--verbose', action='count', default=0,
                             help="Increase verbosity.")
+        parser.add_argument('--refresh', action='store_true', default=False,
+                            help="Ask the clouds about the state of the "
+                            "nodes, instead of only reading the saved "
+                            "information.")
+
+    def can_run_in_daemon(self):
+        return True
 
     def execute(self):
         storage = Configurator().create_cluster_storage()
-        cluster_names = storage.get_stored_clusters()
+        summaries = storage.get_cluster_summaries()
 
-        if not cluster_names:
+        if not summaries:
             print("No clusters found.")
-        else:
-            print("""
+            return
+        print("""
 The following clusters have been started.
 Please note that there's no guarantee that they are fully configured:
 """)
-            for name in sorted(cluster_names):
+        if not self.params.refresh:
+            for name in sorted(summaries):
+                print(self._format(name, summaries[name]))
+            return
+
+        # ask each cloud about all of its clusters at once
+        clouds = dict()
+        for name in sorted(summaries):
+            clouds.setdefault(self._get_cloud(summaries[name]),
+                              []).append(name)
+
+        def get_states(cloud):
+            if cloud is None:
+                raise ConfigurationError("unknown cloud")
+            nodes = dict()
+            for name in clouds[cloud]:
                 try:
-                    cluster = Configurator().load_cluster(name)
-                except ConfigurationError, ex:
-                    log.error("gettin information from cluster `%s`: %s",
+                    nodes[name] = storage.load_cluster(name)['nodes']
+                except (ClusterNotFound, ValueError), ex:
+                    log.error("getting information from cluster `%s`: %s",
                               name, ex)
-                    continue
-                print("%s " % name)
-                print("-"*len(name))
-                print("  name:           %s" % cluster.name)
-                print("  template:       %s" % cluster.template)
-                print("  cloud:          %s " % cluster._cloud)
-                for cls in cluster.nodes:
-                    print("  - %s nodes: %d" % (cls, len(cluster.nodes[cls])))
-                print("")
+            provider = Configurator().create_cloud_provider(cloud)
+            states = provider.get_instance_states(
+                [node['instance_id'] for records in nodes.values()
+                 for node in records])
+            # count the nodes of each type by state
+            counts = dict()
+            for name, records in nodes.items():
+                for node in records:
+                    state = states.get(node['instance_id']) or 'missing'
+                    by_state = counts.setdefault(
+                        name, {}).setdefault(node['type'], {})
+                    by_state[state] = by_state.get(state, 0) + 1
+            return counts
+
+        for cloud, counts in run_parallel(get_states, clouds, len(clouds)):
+            for name in clouds[cloud]:
+                print(self._format(name, summaries[name],
+                                   (counts or {}).get(name, {})))
+                sys.stdout.flush()
+
+    def _get_cloud(self, summary):
+        """
+        Returns the name of the cloud of a stored cluster; clusters
+        saved by older versions do not record it, so it is read from
+        their template.
+        """
+        if summary.get('cloud'):
+            return summary['cloud']
+        try:
+            return Configuration.Instance().read_cluster_section(
+                summary['template'])['cloud']
+        except (ConfigurationError, KeyError), ex:
+            log.debug("Unable to find the cloud of template `%s`: %s",
+                      summary['template'], ex)
+            return None
+
+    def _format(self, name, summary, counts=None):
+        """
+        Returns the description of a stored cluster. If `counts` is
+        given, the nodes of each type are also counted by their state
+        on the cloud.
+        """
+        lines = [
+            name,
+            "-" * len(name),
+            "  name:           %s" % name,
+            "  template:       %s" % summary['template'],
+            "  cloud:          %s" % self._get_cloud(summary),
+            "  setup:          %s" % summary['state'],
+            "  last change:    %s" % time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(summary['updated'])),
+        ]
+        for node_type, count in sorted(summary['nodes'].items()):
+            line = "  - %s nodes: %d" % (node_type, count)
+            if self.params.refresh:
+                by_state = (counts or {}).get(node_type)
+                if by_state:
+                    line += " (%s)" % str.join(', ', [
+                        "%d %s" % (n, state)
+                        for state, n in sorted(by_state.items())])
+                else:
+                    line += " (state unknown)"
+            lines.append(line)
+        return str.join('\n', lines) + '\n'
 
 
 class ListTemplates(AbstractCommand):
@@ -386,6 +553,30 @@ class ListNodes(AbstractCommand):
             help="By default `elasticluster list-nodes` will not contact the "
             "EC2 provider to get up-to-date information, unless `-u` option "
             "is given.")
+        parser.add_argument(
+            '--format', choices=['text', 'json', 'jsonl', 'csv'],
+            default='text',
+            help="Print the nodes as text (default), as a JSON list, as one "
+            "JSON object per line, or as CSV with a header line.")
+        parser.add_argument(
+            '--type', dest='types', metavar='PATTERN', action='append',
+            help="Only list the nodes whose type matches PATTERN (which "
+            "may contain shell-style wildcards). Can be repeated.")
+        parser.add_argument(
+            '--name', dest='names', metavar='PATTERN', action='append',
+            help="Only list the nodes whose name matches PATTERN (which "
+            "may contain shell-style wildcards). Can be repeated.")
+
+    #: fields of the nodes printed with `--format json|jsonl|csv`
+    fields = ['name', 'type', 'instance_id', 'ip_public', 'ip_private',
+              'setup']
+
+    def can_run_in_daemon(self):
+        return True
+
+    def get_cluster_lock(self):
+        # `--update` saves the cluster
+        return self.params.cluster, self.params.update
 
     def execute(self):
         """
@@ -394,6 +585,10 @@ class ListNodes(AbstractCommand):
         """
         Configuration.Instance().cluster_name = self.params.cluster
         cluster_name = self.params.cluster
+        if self.params.format != 'text' and not self.params.update:
+            # no need to build the cluster
+            return self._print_records(cluster_name)
+
         try:
             cluster = Configurator().load_cluster(cluster_name)
             if self.params.update:
@@ -402,16 +597,72 @@ class ListNodes(AbstractCommand):
             log.error("Listing nodes from cluster %s: %s\n" %
                       (cluster_name, ex))
             return
+        if self.params.format != 'text':
+            return self._print_records(cluster_name)
 
         print(cluster_summary(cluster))
         for cls in cluster.nodes:
+            nodes = [node for node in cluster.nodes[cls]
+                     if matches_any(node.type, self.params.types)
+                     and matches_any(node.name, self.params.names)]
+            if not nodes:
+                continue
             print("%s nodes:" % cls)
             print("")
-            for node in cluster.nodes[cls]:
+            for node in nodes:
                 txt = ["    " + i for i in node.pprint().splitlines()]
                 print('  - ' + str.join("\n", txt)[4:])
                 print("")
 
+    def _print_records(self, cluster_name):
+        """
+        Prints the nodes saved in the storage in the format given by
+        option `--format`, reading and printing them one at a time.
+        """
+        storage = Configurator().create_cluster_storage()
+        records = storage.iter_nodes(cluster_name, self.params.types,
+                                     self.params.names)
+        # read the first record now, to report a missing cluster
+        # before printing anything
+        try:
+            first = next(records, None)
+        except ClusterNotFound, ex:
+            log.error("Listing nodes from cluster %s: %s\n" %
+                      (cluster_name, ex))
+            return 1
+        if first is not None:
+            records = itertools.chain([first], records)
+
+        out = sys.stdout
+        if self.params.format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(self.fields)
+        elif self.params.format == 'json':
+            out.write('[')
+        separator = '\n'
+        for record in records:
+            row = self._get_row(record)
+            if self.params.format == 'csv':
+                writer.writerow([
+                    '' if value is None else unicode(value).encode('utf-8')
+                    for value in row.values()])
+            elif self.params.format == 'jsonl':
+                out.write(json.dumps(row) + '\n')
+            else:
+                out.write(separator + json.dumps(row))
+                separator = ',\n'
+        if self.params.format == 'json':
+            out.write('\n]\n')
+
+    def _get_row(self, record):
+        row = OrderedDict()
+        for field in self.fields:
+            if field == 'setup':
+                row[field] = get_setup_summary(record.get('setup_state'))
+            else:
+                row[field] = record.get(field)
+        return row
+
 
 class SetupCluster(AbstractCommand):
     """
@@ -425,6 +676,23 @@ class SetupCluster(AbstractCommand):
         parser.add_argument('cluster', help='name of the cluster')
         parser.add_argument('-v', '--verbose', action='count', default=0,
                             help="Increase verbosity.")
+        parser.add_argument('--force', action="store_true", default=False,
+                            help="Run the setup on all the nodes, even if "
+                            "their configuration is up to date.")
+        parser.add_argument('--retry-failed', action="store_true",
+                            default=False,
+                            help="Only run the setup on the nodes where the "
+                            "last setup failed.")
+        parser.add_argument('--profile-top', metavar='N', type=int,
+                            default=5,
+                            help="After the setup, print the N slowest "
+                            "tasks and hosts. Use 0 to disable. Default: 5")
+
+    def can_run_in_daemon(self):
+        return True
+
+    def get_cluster_lock(self):
+        return self.params.cluster, True
 
     def execute(self):
         Configuration.Instance().cluster_name = self.params.cluster
@@ -438,52 +706,477 @@ class SetupCluster(AbstractCommand):
             return
 
         print("Configuring cluster `%s`..." % cluster_name)
-        cluster.setup()
+        started = time.time()
+        cluster.setup(force=self.params.force,
+                      retry_failed=self.params.retry_failed)
+        runs = load_profiles(cluster.get_data_dir())
+        if runs and runs[-1]['started'] >= started and \
+                self.params.profile_top > 0:
+            print(format_summary(runs[-1], self.params.profile_top))
         print("Your cluster is ready!")
         print(cluster_summary(cluster))
 
 
-class SshFrontend(AbstractCommand):
+class BakeImage(AbstractCommand):
     """
-    Connect to the frontend of the cluster using `ssh`.
+    Create a private image from a configured node of the cluster.
+    Nodes of the same type added later to the cluster (e.g. with
+    `elasticluster resize`) start from this image and only need a
+    minimal setup.
     """
     def setup(self, subparsers):
         parser = subparsers.add_parser(
-            "ssh", help="Connect to the frontend of the cluster using the "
-            "`ssh` command", description=self.__doc__)
+            "bake", help="Create an image from a configured node.",
+            description=self.__doc__)
         parser.set_defaults(func=self)
         parser.add_argument('cluster', help='name of the cluster')
+        parser.add_argument('nodetype', help='type of the node to save, '
+                            'e.g. `compute`')
         parser.add_argument('-v', '--verbose', action='count', default=0,
                             help="Increase verbosity.")
-        parser.add_argument('ssh_args', metavar='args', nargs='*',
-                            help="Execute the following command on the remote "
-                            "machine instead of opening an interactive shell.")
+        parser.add_argument('--name', dest='image_name',
+                            help="Name of the image. Default: "
+                            "CLUSTER-NODETYPE-TIMESTAMP")
+        parser.add_argument('--no-reboot', action="store_true",
+                            default=False,
+                            help="Do not reboot the node before taking the "
+                            "snapshot. The consistency of the filesystem "
+                            "is not guaranteed.")
+
+    def get_cluster_lock(self):
+        return self.params.cluster, True
 
     def execute(self):
-        Configuration.Instance().cluster_name = self.params.cluster
         cluster_name = self.params.cluster
         try:
             cluster = Configurator().load_cluster(cluster_name)
-            cluster.update()
         except (ClusterNotFound, ConfigurationError), ex:
-            log.error("Setting up cluster %s: %s\n" %
+            log.error("Baking image from cluster %s: %s\n" %
                       (cluster_name, ex))
             return
 
+        print("Creating image from a %s node of cluster `%s`..." % (
+            self.params.nodetype, cluster_name))
+        print("(this may take a while...)")
+        try:
+            image_id = cluster.bake(self.params.nodetype,
+                                    image_name=self.params.image_name,
+                                    reboot=not self.params.no_reboot)
+        except (NodeNotFound, ImageError, NotImplementedError), ex:
+            log.error("Unable to create image: %s", ex)
+            sys.exit(1)
+        print("Image `%s` created: new %s nodes of cluster `%s` will start "
+              "from it." % (image_id, self.params.nodetype, cluster_name))
+
+
+class Inventory(AbstractCommand):
+    """
+    Print the Ansible inventory of a cluster in the JSON format of
+    dynamic inventory scripts. Only the information saved in the
+    storage directory and the configuration file is used: the cloud
+    is never contacted.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "inventory", help="Print the Ansible inventory of a cluster.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('cluster', help='name of the cluster')
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+        parser.add_argument('--list', action="store_true", default=False,
+                            help="Print the whole inventory (default).")
+        parser.add_argument('--host', metavar='HOST',
+                            help="Only print the variables of node HOST.")
+        parser.add_argument('--private', action="store_true", default=False,
+                            help="Reach the nodes through their private IP "
+                            "address instead of the public one.")
+
+    def get_cluster_lock(self):
+        return self.params.cluster, False
+
+    def execute(self):
+        cluster_name = self.params.cluster
+        storage = Configurator().create_cluster_storage()
+        try:
+            information = storage.load_cluster(cluster_name)
+            config = Configuration.Instance()
+            template = information['template']
+            setup_name = config.read_cluster_section(template)[
+                'setup_provider']
+            setup_conf = config.read_setup_section(setup_name, template)
+        except (ClusterNotFound, ConfigurationError, KeyError,
+                ConfigParser.Error), ex:
+            log.error("Building inventory of cluster %s: %s\n" %
+                      (cluster_name, ex))
+            sys.exit(1)
+
+        groups = dict((key[:-7], [group.strip()
+                                  for group in value.split(',')])
+                      for key, value in setup_conf.items()
+                      if key.endswith('_groups'))
+        # the same login settings as the ansible setup provider
+        host_vars = {
+            'ansible_ssh_user': setup_conf['image_user'],
+            'ansible_ssh_private_key_file': setup_conf['user_key_private'],
+            'ansible_sudo': parse_bool(setup_conf.get('image_sudo')),
+        }
+        if host_vars['ansible_sudo']:
+            host_vars['ansible_sudo_user'] = setup_conf['image_user_sudo']
+        inventory = dynamic_inventory(
+            information.get('nodes', []), groups,
+            'ip_private' if self.params.private else 'ip_public', host_vars)
+
+        if self.params.host:
+            print(json.dumps(
+                inventory['_meta']['hostvars'].get(self.params.host, {})))
+        else:
+            print(json.dumps(inventory))
+
+
+class ExecCommand(AbstractCommand):
+    """
+    Run a command on all the nodes of a cluster (or only on the nodes
+    of some types) in parallel, and report the exit code of each.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "exec", help="Run a command on the nodes of a cluster.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('cluster', help='name of the cluster')
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+        parser.add_argument('-g', '--group', metavar='TYPE',
+                            action='append', dest='node_types',
+                            help="Only run on nodes of type TYPE (e.g. "
+                            "`compute`). Can be repeated.")
+        parser.add_argument('-f', '--forks', metavar='N', type=int,
+                            default=50,
+                            help="Run on at most N nodes at the same "
+                            "time. Default: 50")
+        parser.add_argument('-t', '--timeout', metavar='SECONDS', type=int,
+                            default=60,
+                            help="Give up on nodes which did not connect "
+                            "or complete the command within SECONDS. Use 0 "
+                            "to wait forever. Default: 60")
+        parser.add_argument('-a', '--aggregate', action="store_true",
+                            default=False,
+                            help="Instead of printing output as it arrives, "
+                            "print it at the end, once for all the nodes "
+                            "with the same output.")
+        parser.add_argument('command', nargs='*',
+                            help="Command to run, after `--`.")
+        parser.rest_dest = 'command'
+
+    def get_cluster_lock(self):
+        return self.params.cluster, False
+
+    def execute(self):
+        cluster_name = self.params.cluster
+        command = self.params.command
+        if not command:
+            log.error("No command given.")
+            sys.exit(1)
+        command = str.join(' ', command)
+
+        try:
+            cluster = Configurator().load_cluster(cluster_name)
+        except (ClusterNotFound, ConfigurationError), ex:
+            log.error("Running command on cluster %s: %s\n" %
+                      (cluster_name, ex))
+            sys.exit(1)
+        nodes = [node for node in cluster.get_all_nodes()
+                 if not self.params.node_types
+                 or node.type in self.params.node_types]
+        if not nodes:
+            log.error("No nodes to run the command on.")
+            sys.exit(1)
+
+        timeout = self.params.timeout or None
+        pool = ConnectionPool(timeout=timeout)
+        printer = OutputPrinter()
+
+        def run(node):
+            ssh = pool.get(node)
+            if ssh is None:
+                return None, "unreachable"
+            on_line = None
+            if not self.params.aggregate:
+                on_line = lambda line: printer(node.name, line)
+            return run_command(ssh, command, timeout=timeout,
+                               on_line=on_line)
+
+        exit_codes = dict()
+        outputs = dict()
         try:
+            for node, result in run_parallel(run, nodes, self.params.forks):
+                exit_code, output = result or (None, "error")
+                exit_codes.setdefault(exit_code, []).append(node.name)
+                outputs.setdefault(output, []).append(node.name)
+        finally:
+            pool.close()
+
+        if self.params.aggregate:
+            for output, names in sorted(outputs.items(),
+                                        key=lambda item: -len(item[1])):
+                print("==> %s (%d node(s)) <==" % (
+                    str.join(', ', compress_names(names)), len(names)))
+                print(output)
+
+        print("")
+        for exit_code, names in sorted(exit_codes.items()):
+            if exit_code is None:
+                label = "unreachable or timed out"
+            else:
+                label = "exit code %d" % exit_code
+            print("%s: %d node(s): %s" % (
+                label, len(names), str.join(', ', compress_names(names))))
+        if set(exit_codes) != set([0]):
+            sys.exit(1)
+
+
+class Scatter(AbstractCommand):
+    """
+    Copy a file to all the nodes of a cluster. The file is uploaded
+    once to the frontend node, and then copied from node to node over
+    the private network, so that the time needed grows only with the
+    logarithm of the number of nodes. Checksums are verified on all
+    nodes at the end.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "scatter", help="Copy a file to all the nodes of a cluster.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('cluster', help='name of the cluster')
+        parser.add_argument('source', help='local file to copy')
+        parser.add_argument('destination', nargs='?',
+                            help="Path of the copies on the nodes; relative "
+                            "paths are relative to the home directory. The "
+                            "parent directory must exist. Default: the "
+                            "name of the source file.")
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+        parser.add_argument('-g', '--group', metavar='TYPE',
+                            action='append', dest='node_types',
+                            help="Only copy to nodes of type TYPE (e.g. "
+                            "`compute`). Can be repeated. The frontend "
+                            "always gets a copy.")
+        parser.add_argument('-f', '--forks', metavar='N', type=int,
+                            default=50,
+                            help="Run at most N copies at the same time. "
+                            "Default: 50")
+        parser.add_argument('-t', '--timeout', metavar='SECONDS', type=int,
+                            default=0,
+                            help="Give up on copies which did not complete "
+                            "within SECONDS. Default: no timeout")
+
+    def get_cluster_lock(self):
+        return self.params.cluster, False
+
+    def execute(self):
+        cluster_name = self.params.cluster
+        source = self.params.source
+        destination = self.params.destination or os.path.basename(source)
+        if not os.path.isfile(source):
+            log.error("`%s` is not a file.", source)
+            sys.exit(1)
+
+        try:
+            cluster = Configurator().load_cluster(cluster_name)
             frontend = cluster.get_frontend_node()
-        except NodeNotFound, ex:
-            log.error("Unable to connect to the frontend node: %s" % str(ex))
+        except (ClusterNotFound, ConfigurationError, NodeNotFound), ex:
+            log.error("Copying to cluster %s: %s\n" % (cluster_name, ex))
+            sys.exit(1)
+        targets = [node for node in cluster.get_all_nodes()
+                   if node is not frontend and (
+                       not self.params.node_types
+                       or node.type in self.params.node_types)]
+
+        digest = hashlib.sha256()
+        with open(source, 'rb') as fd:
+            for block in iter(lambda: fd.read(1024*1024), ''):
+                digest.update(block)
+        checksum = digest.hexdigest()
+
+        timeout = self.params.timeout or None
+        pool = ConnectionPool(timeout=timeout)
+        try:
+            ssh = pool.get(frontend)
+            if ssh is None:
+                log.error("Unable to connect to the frontend node %s.",
+                          frontend.name)
+                sys.exit(1)
+            print("Uploading `%s` to %s..." % (source, frontend.name))
+            sftp = ssh.open_sftp()
+            try:
+                sftp.put(source, destination)
+            finally:
+                sftp.close()
+
+            print("Copying to %d node(s)..." % len(targets))
+            missing = scatter(pool, frontend, targets, destination,
+                              frontend.user_key_private,
+                              forks=self.params.forks, timeout=timeout)
+
+            def verify(node):
+                ssh = pool.get(node)
+                if ssh is None:
+                    return None
+                exit_code, output = run_command(
+                    ssh, "sha256sum %s" % pipes.quote(destination),
+                    timeout=timeout)
+                if exit_code != 0 or not output.strip():
+                    return None
+                return output.split()[0]
+
+            corrupted = []
+            copied = [frontend] + [node for node in targets
+                                   if node not in missing]
+            for node, node_checksum in run_parallel(verify, copied,
+                                                    self.params.forks):
+                if node_checksum != checksum:
+                    corrupted.append(node.name)
+        finally:
+            pool.close()
+
+        missing = [node.name for node in missing]
+        if missing:
+            log.error("Copy failed on %d node(s): %s", len(missing),
+                      str.join(', ', compress_names(missing)))
+        if corrupted:
+            log.error("Checksum mismatch on %d node(s): %s", len(corrupted),
+                      str.join(', ', compress_names(corrupted)))
+        if missing or corrupted:
             sys.exit(1)
-        host = frontend.ip_public
-        username = frontend.image_user
-        ssh_cmdline = [
-            "ssh",
-            "-i", frontend.user_key_private,
-        ] + (['-v'] * self.params.verbose) + [
-            '%s@%s' % (username, host),
-        ] + self.params.ssh_args
-        os.execlp("ssh", *ssh_cmdline)
+        print("`%s` copied to %d node(s), checksum %s verified." % (
+            destination, len(copied), checksum))
+
+
+#: how long SSH master connections to the frontend stay open after
+#: the last `elasticluster ssh` or `sftp` session ended
+SSH_CONTROL_PERSIST = '10m'
+
+
+def ssh_multiplexing_options(cluster, node):
+    """
+    Returns the `ssh` options to share one master connection to
+    `node` among all sessions, through a socket in the cluster data
+    directory.
+    """
+    control_path = os.path.join(cluster.get_data_dir(), 'ssh-%r@%h:%p')
+    # UNIX socket paths are limited to about 100 characters
+    expanded = control_path.replace('%r', node.image_user) \
+        .replace('%h', str(node.ip_public)).replace('%p', '65535')
+    if len(expanded) > 100:
+        log.debug("Not sharing SSH connections: socket path `%s` is too "
+                  "long.", expanded)
+        return []
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=' + control_path,
+            '-o', 'ControlPersist=' + SSH_CONTROL_PERSIST]
+
+
+def _call(cmdline):
+    """
+    Runs `cmdline` and returns its exit code. Interrupting it with
+    Ctrl+C only stops the command, not elasticluster.
+    """
+    handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        return subprocess.call(
+            cmdline,
+            preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+    finally:
+        signal.signal(signal.SIGINT, handler)
+
+
+def run_on_frontend(cluster_name, build_cmdline, connection_failed,
+                    lock_timeout=None):
+    """
+    Runs the command line returned by `build_cmdline(cluster, node)`
+    to connect to the frontend node of cluster `cluster_name`, using
+    the IP address saved in the storage. If the command fails, as
+    told by `connection_failed(exit_code)`, the address is refreshed
+    from the cloud and, if it changed, the command is run again.
+    Never returns: exits with the exit code of the command.
+
+    The cluster is not locked while the command runs, as sessions can
+    last long: it is loaded again before saving a new address.
+    """
+    Configuration.Instance().cluster_name = cluster_name
+    storage = Configurator().create_cluster_storage()
+
+    def load(refresh):
+        # refreshing saves the cluster, which needs an exclusive lock
+        with storage.lock_cluster(cluster_name, exclusive=refresh,
+                                  timeout=lock_timeout):
+            cluster = Configurator().load_cluster(cluster_name)
+            frontend = cluster.get_frontend_node()
+            if refresh:
+                address = frontend.ip_public
+                try:
+                    frontend.update_ips(force=True)
+                except Exception, ex:
+                    log.debug("Unable to refresh the address of %s: %s",
+                              frontend.name, ex)
+                if frontend.ip_public != address:
+                    cluster.update()
+        return cluster, frontend
+
+    try:
+        cluster, frontend = load(False)
+        if not frontend.ip_public:
+            cluster, frontend = load(True)
+        exit_code = _call(build_cmdline(cluster, frontend))
+        if connection_failed(exit_code):
+            address = frontend.ip_public
+            cluster, frontend = load(True)
+            if frontend.ip_public and frontend.ip_public != address:
+                log.warning("The address of %s changed from %s to %s: "
+                            "trying again.", frontend.name, address,
+                            frontend.ip_public)
+                exit_code = _call(build_cmdline(cluster, frontend))
+    except (ClusterNotFound, ConfigurationError, ClusterLockTimeout), ex:
+        log.error("Connecting to cluster %s: %s\n" % (cluster_name, ex))
+        sys.exit(1)
+    except NodeNotFound, ex:
+        log.error("Unable to connect to the frontend node: %s" % str(ex))
+        sys.exit(1)
+    sys.exit(exit_code)
+
+
+class SshFrontend(AbstractCommand):
+    """
+    Connect to the frontend of the cluster using `ssh`.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "ssh", help="Connect to the frontend of the cluster using the "
+            "`ssh` command", description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('cluster', help='name of the cluster')
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+        parser.add_argument('ssh_args', metavar='args', nargs='*',
+                            help="Execute the following command on the remote "
+                            "machine instead of opening an interactive shell.")
+
+    def execute(self):
+        def cmdline(cluster, frontend):
+            return [
+                "ssh",
+                "-i", frontend.user_key_private,
+            ] + ssh_multiplexing_options(cluster, frontend) + (
+                ['-v'] * self.params.verbose) + [
+                '%s@%s' % (frontend.image_user, frontend.ip_public),
+            ] + self.params.ssh_args
+
+        # `ssh` exits with 255 if the connection fails
+        run_on_frontend(self.params.cluster, cmdline,
+                        lambda exit_code: exit_code == 255,
+                        self.params.lock_timeout)
 
 
 class SftpFrontend(AbstractCommand):
@@ -504,27 +1197,117 @@ class SftpFrontend(AbstractCommand):
                             "opening an interactive shell.")
 
     def execute(self):
-        Configuration.Instance().cluster_name = self.params.cluster
-        cluster_name = self.params.cluster
-        try:
-            cluster = Configurator().load_cluster(cluster_name)
-            cluster.update()
-        except (ClusterNotFound, ConfigurationError), ex:
-            log.error("Setting up cluster %s: %s\n" %
-                      (cluster_name, ex))
-            return
+        def cmdline(cluster, frontend):
+            return [
+                "sftp",
+                "-i", frontend.user_key_private,
+            ] + ssh_multiplexing_options(cluster, frontend) + (
+                ['-v'] * self.params.verbose) + self.params.sftp_args + [
+                '%s@%s' % (frontend.image_user, frontend.ip_public),
+            ]
+
+        # `sftp` passes on the exit code 255 of `ssh` if the
+        # connection fails; other failures are not worth a refresh
+        run_on_frontend(self.params.cluster, cmdline,
+                        lambda exit_code: exit_code == 255,
+                        self.params.lock_timeout)
+
+
+class MigrateStorage(AbstractCommand):
+    """
+    Move the clusters saved in JSON files in the storage directory
+    into a SQLite database, which is used from then on.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "migrate-storage", help="Save clusters in a SQLite database.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+
+    def execute(self):
+        # imported here, to load `sqlite3` only if needed
+        from elasticluster.sqlite_storage import get_database_path, \
+            migrate_json_storage
+        migrated = migrate_json_storage(self.params.storage)
+        print("%d cluster(s) migrated to %s." % (
+            len(migrated), get_database_path(self.params.storage)))
+
+
+class RunDaemon(AbstractCommand):
+    """
+    Run a server keeping the configuration and the cloud and setup
+    libraries loaded; while it runs, the `start`, `stop`, `resize`,
+    `list`, `list-nodes` and `setup` commands are passed on to it.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "daemon", help="Run commands from a long-running server.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
 
+    def execute(self):
+        server = daemon.Daemon(self.params.config, self.params.storage)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         try:
-            frontend = cluster.get_frontend_node()
-        except NodeNotFound, ex:
-            log.error("Unable to connect to the frontend node: %s" % str(ex))
+            server.serve_forever()
+        except RuntimeError, ex:
+            log.error(str(ex))
             sys.exit(1)
-        host = frontend.ip_public
-        username = frontend.image_user
-        sftp_cmdline = [
-            "sftp",
-            "-i", frontend.user_key_private,
-        ] + (['-v'] * self.params.verbose) + self.params.sftp_args + [
-            '%s@%s' % (username, host),
-        ]
-        os.execlp("sftp", *sftp_cmdline)
+        except KeyboardInterrupt:
+            pass
+
+
+class ListJobs(AbstractCommand):
+    """
+    List the commands run by `elasticluster daemon`.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "jobs", help="List the commands run by the daemon.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+
+    def execute(self):
+        jobs = daemon.list_jobs(self.params.storage)
+        if jobs is None:
+            log.error("No elasticluster daemon is running.")
+            sys.exit(1)
+        if not jobs:
+            print("No jobs.")
+            return
+        for job in jobs:
+            if job['ended'] is None:
+                state = 'running'
+            else:
+                state = 'exit %d' % job['exit']
+            print("%4d  %-8s  %s  elasticluster %s" % (
+                job['job'], state,
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(job['started'])),
+                str.join(' ', job['argv'])))
+
+
+class AttachJob(AbstractCommand):
+    """
+    Print the output of a command run by `elasticluster daemon`,
+    following it until the command ends.
+    """
+    def setup(self, subparsers):
+        parser = subparsers.add_parser(
+            "attach", help="Follow a command run by the daemon.",
+            description=self.__doc__)
+        parser.set_defaults(func=self)
+        parser.add_argument('job', type=int,
+                            help="Job number, as shown by `elasticluster "
+                            "jobs`.")
+        parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity.")
+
+    def execute(self):
+        sys.exit(daemon.attach(self.params.storage, self.params.job))
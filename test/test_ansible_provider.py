@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import ansible.constants as ansible_constants
+
+from elasticluster.cluster import Node
+from elasticluster.exceptions import ConfigurationError
+from elasticluster.providers import ansible_provider
+from elasticluster.providers.ansible_provider import AnsibleSetupProvider
+from elasticluster.providers.profiling import SetupProfile
+
+
+class _Cluster(object):
+
+    name = 'test'
+
+    def __init__(self, data_dir, nodes=()):
+        self.data_dir = data_dir
+        self.nodes = list(nodes)
+
+    def get_data_dir(self):
+        return self.data_dir
+
+    def get_all_nodes(self):
+        return self.nodes
+
+
+class _RecordingProvider(AnsibleSetupProvider):
+    """
+    Records which playbook would run on which nodes.
+    """
+
+    def _run_playbook(self, cluster, playbook, nodes=None):
+        self.runs.append((playbook, [node.name for node in nodes]))
+        return dict((node.name, {'ok': 1, 'changed': 0, 'skipped': 0,
+                                 'unreachable': 0, 'failures': 0})
+                    for node in nodes)
+
+
+class TestAnsibleSetupProvider(unittest.TestCase):
+
+    hosts = ['node001', 'node002']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cluster = _Cluster(os.path.join(self.tmpdir, 'data'))
+        self.inventory = os.path.join(self.tmpdir, 'hosts')
+        with open(self.inventory, 'w') as fd:
+            for host in self.hosts:
+                fd.write("%s ansible_connection=local "
+                         "ansible_python_interpreter=%s\n"
+                         % (host, sys.executable))
+        self.playbook = os.path.join(self.tmpdir, 'site.yml')
+        with open(self.playbook, 'w') as fd:
+            fd.write("""
+- hosts: all
+  tasks:
+    - name: hostname
+      command: echo {{ ansible_hostname }}
+""")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, provider):
+        provider.inventory_path = self.inventory
+        provider.profile = SetupProfile('test')
+        nodes = [Node(host, 'compute', None, None, None, None, None, None,
+                      None, None) for host in self.hosts]
+        status = provider._run_playbook_locally(self.cluster, self.playbook,
+                                                nodes)
+        assert not any(hoststatus['failures']
+                       for hoststatus in status.values())
+        return [task['name'] for task in provider.profile.report()['tasks']]
+
+    def test_fact_caching(self):
+        provider = AnsibleSetupProvider(
+            '~/.ssh/id_rsa', 'root', 'root', False, self.playbook,
+            ansible_fact_caching='yes')
+
+        provider._setup_fact_cache(self.cluster, [])
+        assert self._run(provider) == ['GATHERING FACTS', 'hostname']
+        facts_dir = os.path.join(self.cluster.get_data_dir(), 'facts')
+        assert sorted(os.listdir(facts_dir)) == self.hosts
+        with open(os.path.join(facts_dir, 'node001')) as fd:
+            assert 'ansible_hostname' in json.load(fd)
+
+        # facts are read back from the cluster data directory, except
+        # for the stale hosts
+        provider._setup_fact_cache(self.cluster, ['node002'])
+        assert os.listdir(facts_dir) == ['node001']
+        assert self._run(provider) == ['GATHERING FACTS', 'hostname']
+        assert sorted(os.listdir(facts_dir)) == self.hosts
+
+        provider._setup_fact_cache(self.cluster, [])
+        assert self._run(provider) == ['hostname']
+
+    def test_baked_nodes(self):
+        refresh = os.path.join(self.tmpdir, 'refresh.yml')
+        shutil.copy(self.playbook, refresh)
+        provider = _RecordingProvider(
+            '~/.ssh/id_rsa', 'root', 'root', False, self.playbook,
+            refresh_playbook_path=refresh, compute_groups='clients')
+        nodes = [Node(host, 'compute', None, None, None, None, None, None,
+                      None, None) for host in self.hosts]
+        nodes[0].baked_from = provider.get_fingerprint('compute')
+        nodes[1].baked_from = 'obsolete'
+
+        provider.runs = []
+        assert provider.setup_cluster(_Cluster(self.cluster.data_dir, nodes),
+                                      incremental=True)
+        assert provider.runs == [(self.playbook, ['node002']),
+                                 (refresh, ['node001'])]
+        # the nodes are configured once the setup succeeded
+        assert all(node.setup_state['playbook'] ==
+                   provider.get_fingerprint('compute') for node in nodes)
+
+    def test_ssh_args(self):
+        user_ssh_args = ansible_provider._USER_SSH_ARGS
+        ansible_provider._USER_SSH_ARGS = '-o ControlPersist=5m'
+        try:
+            provider = AnsibleSetupProvider(
+                '~/.ssh/id_rsa', 'root', 'root', False, self.playbook)
+            provider._setup_ssh_args(self.cluster)
+            args = ansible_constants.ANSIBLE_SSH_ARGS.split()
+            assert args[:2] == ['-o', 'ControlPersist=5m']
+            assert 'ControlMaster=auto' in args
+            assert ('ControlPath=%s/%%h-%%r' % self.cluster.get_data_dir()
+                    in args)
+
+            provider = AnsibleSetupProvider(
+                '~/.ssh/id_rsa', 'root', 'root', False, self.playbook,
+                ansible_ssh_control_persist='no')
+            provider._setup_ssh_args(self.cluster)
+            assert ansible_constants.ANSIBLE_SSH_ARGS == \
+                '-o ControlPersist=5m -o ControlMaster=no'
+        finally:
+            ansible_provider._USER_SSH_ARGS = user_ssh_args
+
+    def test_forks(self):
+        provider = AnsibleSetupProvider(
+            '~/.ssh/id_rsa', 'root', 'root', False, self.playbook,
+            ansible_forks='4')
+        assert provider._get_forks(100) == 4
+        provider = AnsibleSetupProvider(
+            '~/.ssh/id_rsa', 'root', 'root', False, self.playbook,
+            ansible_forks_max='3')
+        assert provider._get_forks(100) == 3
+        for forks in ['0', '-2', 'many']:
+            self.assertRaises(
+                ConfigurationError, AnsibleSetupProvider,
+                '~/.ssh/id_rsa', 'root', 'root', False, self.playbook,
+                ansible_forks=forks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from elasticluster.conf import Configuration, Configurator
+
+
+class TestConfigurationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'config')
+        self._write("[cloud/test]\nprovider=ec2_boto\n")
+        self.config = Configuration.Instance()
+        self.saved = (self.config.file_path, self.config._config,
+                      self.config._config_key)
+        self.config.file_path = self.path
+
+    def tearDown(self):
+        (self.config.file_path, self.config._config,
+         self.config._config_key) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, content):
+        with open(self.path, 'w') as fd:
+            fd.write(content)
+
+    def test_parsed_once(self):
+        assert self.config.read_cloud_section('test')['provider'] == \
+            'ec2_boto'
+        parser = self.config._config
+        self.config.read_cloud_section('test')
+        self.config.list_cluster_templates()
+        assert self.config._config is parser
+
+    def test_reparsed_on_change(self):
+        self.config.read_cloud_section('test')
+        self._write("[cloud/test]\nprovider=google\n\n")
+        assert self.config.read_cloud_section('test')['provider'] == 'google'
+
+    def test_node_template_shared(self):
+        self._write(
+            "[login/test]\nimage_user=test\nimage_user_sudo=root\n"
+            "image_sudo=True\nuser_key_name=test\n"
+            "user_key_private=%(dir)s/id\nuser_key_public=%(dir)s/id.pub\n"
+            "[cluster/test]\nlogin=test\nsecurity_group=default\n"
+            "image_id=ami-1\nflavor=m1.tiny\n"
+            "[cluster/test/compute]\nflavor=m1.large\n"
+            % {'dir': self.tmpdir})
+        template = Configurator().get_node_template('test', 'compute')
+        assert template.flavor == 'm1.large'
+        assert Configurator().get_node_template('test', 'compute') \
+            is template
+
+        self._write("[login/test]\n" + open(self.path).read()[13:] + "\n")
+        assert Configurator().get_node_template('test', 'compute') \
+            is not template
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from elasticluster import daemon
+from elasticluster.conf import Configuration
+
+
+class TestJob(unittest.TestCase):
+
+    def test_follow(self):
+        job = daemon.Job(1, ['list'])
+        job.append('first\n')
+
+        def finish():
+            time.sleep(0.1)
+            job.append('second\n')
+            job.finish(0)
+        threading.Thread(target=finish).start()
+
+        assert list(job.follow()) == ['first\n', 'second\n']
+        assert job.exit_code == 0
+        # following a finished job replays all its output
+        assert list(job.follow()) == ['first\n', 'second\n']
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = os.path.join(self.path, 'config')
+        self.storage = os.path.join(self.path, 'storage')
+        os.mkdir(self.storage)
+        open(self.config, 'w').close()
+        Configuration.Instance().file_path = self.config
+        Configuration.Instance().storage_path = self.storage
+        self.daemon = daemon.Daemon(self.config, self.storage)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        while not os.path.exists(daemon.get_socket_path(self.storage)):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def test_no_daemon(self):
+        assert daemon.forward(self.config, self.path, ['list']) is None
+
+    def test_other_configuration(self):
+        assert daemon.forward(self.storage, self.storage, ['list']) is None
+
+    def test_jobs(self):
+        assert daemon.forward(self.config, self.storage, ['list']) == 0
+        assert daemon.forward(self.config, self.storage,
+                              ['list-nodes', 'missing']) == 0
+        jobs = daemon.list_jobs(self.storage)
+        assert [job['argv'] for job in jobs] == [
+            ['list'], ['list-nodes', 'missing']]
+        assert [job['exit'] for job in jobs] == [0, 0]
+        assert daemon.attach(self.storage, 1) == 0
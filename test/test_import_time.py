@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+# modules which take long to import, and that must only be imported
+# by the commands actually using them
+HEAVY_MODULES = ['ansible', 'apiclient', 'boto', 'httplib2',
+                 'oauth2client', 'paramiko', 'pkg_resources', 'sqlite3']
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = (
+            "import shutil, sys, tempfile\n"
+            "import elasticluster.conf, elasticluster.subcommands\n"
+            "from elasticluster.conf import Configuration, Configurator\n"
+            "path = tempfile.mkdtemp()\n"
+            "Configuration.Instance().storage_path = path\n"
+            "Configurator().create_cluster_storage()\n"
+            "shutil.rmtree(path)\n"
+            "print(str.join(' ', sorted(set(name.split('.')[0] "
+            "for name in sys.modules) & set(%r))))\n" % HEAVY_MODULES)
+        env = dict(os.environ, PYTHONPATH=root)
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        assert output.strip() == '', \
+            "Modules imported at startup: %s" % output.strip()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from elasticluster.inventory import compress_names, dynamic_inventory, \
+    write_inventory
+
+
+class _Node(object):
+
+    def __init__(self, name, node_type, ip_public):
+        self.name = name
+        self.type = node_type
+        self.ip_public = ip_public
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_compress_names(self):
+        names = ['compute%03d' % i for i in range(1, 501)
+                 if i != 250] + ['frontend001', 'gateway']
+        assert compress_names(names) == [
+            'compute[001:249]', 'compute[251:500]', 'frontend001', 'gateway']
+
+    def test_compress_names_keeps_widths_apart(self):
+        names = ['compute%03d' % i for i in range(998, 1003)]
+        assert compress_names(names) == ['compute[1000:1002]',
+                                         'compute[998:999]']
+
+    def test_write_inventory(self):
+        nodes = [_Node('frontend001', 'frontend', '1.2.3.4'),
+                 _Node('compute001', 'compute', '1.2.3.5'),
+                 _Node('compute002', 'compute', '1.2.3.6')]
+        groups = {'frontend': ['master', 'ganglia'],
+                  'compute': ['clients', 'ganglia']}
+        hosts = write_inventory(self.path, nodes, groups)
+
+        assert open(hosts).read() == (
+            "\n[clients]\ncompute[001:002]\n"
+            "\n[ganglia]\ncompute[001:002]\nfrontend001\n"
+            "\n[master]\nfrontend001\n")
+        assert open(os.path.join(self.path, 'host_vars', 'compute002')) \
+            .read() == "ansible_ssh_host: 1.2.3.6\n"
+
+    def test_write_empty_inventory(self):
+        assert write_inventory(self.path, [], {'frontend': ['master']}) is None
+
+    def test_dynamic_inventory(self):
+        nodes = [{'name': 'compute002', 'type': 'compute',
+                  'ip_public': '1.2.3.6', 'ip_private': '10.0.0.6'},
+                 {'name': 'compute001', 'type': 'compute',
+                  'ip_public': '1.2.3.5', 'ip_private': '10.0.0.5'},
+                 {'name': 'storage001', 'type': 'storage',
+                  'ip_public': '1.2.3.7', 'ip_private': '10.0.0.7'}]
+        inventory = dynamic_inventory(nodes, {'compute': ['clients']},
+                                      'ip_private',
+                                      {'ansible_ssh_user': 'test'})
+        assert inventory['clients'] == {'hosts': ['compute001',
+                                                  'compute002']}
+        assert inventory['_meta']['hostvars'] == {
+            'compute001': {'ansible_ssh_host': '10.0.0.5',
+                           'ansible_ssh_user': 'test'},
+            'compute002': {'ansible_ssh_host': '10.0.0.6',
+                           'ansible_ssh_user': 'test'}}
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from elasticluster.cluster import Node
+from elasticluster.providers import profiling
+from elasticluster.providers.ansible_provider import AnsibleSetupProvider
+from elasticluster.providers.profiling import SetupProfile
+
+
+class TestSetupProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_record(self):
+        profile = SetupProfile('test')
+        profile.task_start('install')
+        profile.host_done('compute001', 'ok')
+        profile.host_done('compute002', 'failed')
+        profile.finish()
+
+        report = profile.report()
+        assert report['cluster'] == 'test'
+        assert len(report['tasks']) == 1
+        assert report['tasks'][0]['hosts']['compute002']['status'] == 'failed'
+
+    def test_slowest(self):
+        run = {'duration': 10.0, 'tasks': [
+            {'name': 'fast', 'duration': 1.0,
+             'hosts': {'a': {'duration': 1.0}, 'b': {'duration': 0.5}}},
+            {'name': 'slow', 'duration': 8.0,
+             'hosts': {'a': {'duration': 2.0}, 'b': {'duration': 8.0}}},
+        ]}
+        tasks, hosts = profiling.slowest(run, top=1)
+        assert tasks == [('slow', 8.0)]
+        assert hosts == [('b', 8.5)]
+
+    def test_save_keeps_previous_runs(self):
+        for i in range(profiling.MAX_RUNS + 2):
+            profile = SetupProfile('test', run=i)
+            profile.task_start('task')
+            profile.finish()
+            profile.save(self.data_dir)
+
+        runs = profiling.load_profiles(self.data_dir)
+        assert len(runs) == profiling.MAX_RUNS
+        assert runs[-1]['info']['run'] == profiling.MAX_RUNS + 1
+
+
+class TestAnsibleProfiling(unittest.TestCase):
+
+    hosts = ['node001', 'node002', 'node003']
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_forked_results(self):
+        inventory = os.path.join(self.data_dir, 'hosts')
+        with open(inventory, 'w') as fd:
+            for host in self.hosts:
+                fd.write("%s ansible_connection=local "
+                         "ansible_python_interpreter=%s\n"
+                         % (host, sys.executable))
+        playbook = os.path.join(self.data_dir, 'site.yml')
+        with open(playbook, 'w') as fd:
+            fd.write("""
+- hosts: all
+  gather_facts: false
+  tasks:
+    - name: first
+      command: sleep {{ 1 if inventory_hostname == 'node001' else 0 }}
+    - name: second
+      command: /bin/false
+      when: inventory_hostname == 'node003'
+""")
+
+        provider = AnsibleSetupProvider(
+            '~/.ssh/id_rsa', 'root', 'root', False, playbook,
+            ansible_forks='3')
+        provider.inventory_path = inventory
+        provider.profile = SetupProfile('test')
+        nodes = [Node(host, 'compute', None, None, None, None, None, None,
+                      None, None) for host in self.hosts]
+        status = provider._run_playbook_locally(None, playbook, nodes)
+        assert status['node003']['failures'] == 1
+
+        tasks = provider.profile.report()['tasks']
+        assert [task['name'] for task in tasks] == ['first', 'second']
+        assert sorted(tasks[0]['hosts']) == self.hosts
+        # each host has its own duration, not that of the whole task
+        durations = dict((host, info['duration'])
+                         for host, info in tasks[0]['hosts'].items())
+        assert durations['node001'] >= 1.0
+        assert durations['node002'] < 0.8
+        assert tasks[1]['hosts']['node001']['status'] == 'skipped'
+        assert tasks[1]['hosts']['node003']['status'] == 'failed'
+
+
+if __name__ == "__main__":
+    unittest.main()
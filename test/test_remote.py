@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import shlex
+import unittest
+
+from elasticluster.remote import _get_scp_command
+
+
+class TestScatter(unittest.TestCase):
+
+    def test_scp_command_quoting(self):
+        path = "/home/user/my data/$HOME;x"
+        argv = shlex.split(_get_scp_command('.key', path, 'user', '10.0.0.2'))
+        assert argv[0] == 'scp'
+        assert argv[-2] == path
+        # the remote path is split again by the shell on the target
+        host, remote_path = argv[-1].split(':', 1)
+        assert host == 'user@10.0.0.2'
+        assert shlex.split(remote_path) == [path]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from elasticluster.helpers import fingerprint
+from elasticluster.providers.shell_provider import ShellSetupProvider
+
+
+class _Node(object):
+
+    def __init__(self, name, node_type, setup_state=None):
+        self.name = name
+        self.type = node_type
+        self.ip_private = '10.0.0.%d' % (len(name) + 1)
+        self.setup_state = setup_state
+
+
+class _Cluster(object):
+
+    def __init__(self, nodes):
+        self.name = 'test'
+        self.nodes = nodes
+
+    def get_all_nodes(self):
+        return list(self.nodes)
+
+
+class TestShellSetupProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.script_dir = tempfile.mkdtemp()
+        for group in ['master', 'clients']:
+            with open(os.path.join(self.script_dir, group + '.sh'), 'w') as fd:
+                fd.write('echo %s\n' % group)
+        self.provider = ShellSetupProvider(
+            '~/test.prv', 'test', 'root', 'False', self.script_dir,
+            frontend_groups='master', compute_groups='clients')
+
+    def tearDown(self):
+        shutil.rmtree(self.script_dir)
+
+    def test_frontend_groups_run_first(self):
+        assert self.provider._get_stages(['compute', 'frontend']) == \
+            ['master', 'clients']
+
+    def test_fingerprint_changes_with_script(self):
+        before = self.provider.get_fingerprint('compute')
+        unchanged = self.provider.get_fingerprint('frontend')
+        with open(os.path.join(self.script_dir, 'clients.sh'), 'a') as fd:
+            fd.write('echo again\n')
+        assert self.provider.get_fingerprint('compute') != before
+        assert self.provider.get_fingerprint('frontend') == unchanged
+
+    def test_command(self):
+        assert self.provider._get_command() == "/bin/sh -s"
+        provider = ShellSetupProvider(
+            '~/test.prv', 'test', 'root', 'True', self.script_dir)
+        assert provider._get_command().startswith("sudo -n -H -u root ")
+
+    def test_preamble(self):
+        nodes = [_Node('frontend001', 'frontend'), _Node('compute001', 'compute')]
+        hosts = self.provider._get_hosts(nodes)
+        preamble = self.provider._get_preamble(nodes[1], hosts)
+        assert "export ELASTICLUSTER_NODE=compute001\n" in preamble
+        assert "export ELASTICLUSTER_GROUP_master=frontend001\n" in preamble
+
+    def test_up_to_date_cluster_is_skipped(self):
+        nodes = [_Node('frontend001', 'frontend'), _Node('compute001', 'compute')]
+        hosts = self.provider._get_hosts(nodes)
+        for node in nodes:
+            node.setup_state = {
+                'playbook': self.provider.get_fingerprint(node.type),
+                'inventory': fingerprint([], hosts),
+            }
+        # no connection is attempted: `_Node` cannot connect
+        assert self.provider._setup_cluster(_Cluster(nodes), False, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
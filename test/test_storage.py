@@ -0,0 +1,299 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from elasticluster.cluster import ClusterStorage
+from elasticluster.exceptions import ClusterLockTimeout, ClusterNotFound
+from elasticluster import sqlite_storage
+from elasticluster.sqlite_storage import SqliteClusterStorage, \
+    migrate_json_storage
+
+
+class _Node(object):
+
+    def __init__(self, name, node_type, setup_state=None, baked_from=None):
+        self.instance_id = 'i-' + name
+        self.name = name
+        self.type = node_type
+        self.ip_public = self.ip_private = None
+        self.setup_state = setup_state
+        self.baked_from = baked_from
+
+
+class _Cluster(object):
+
+    def __init__(self, name, nodes):
+        self.name = name
+        self.template = 'mycluster'
+        self._cloud = 'hobbes'
+        self.images = {}
+        self.nodes = dict()
+        for node in nodes:
+            self.nodes.setdefault(node.type, []).append(node)
+
+    def get_all_nodes(self):
+        return [node for nodes in self.nodes.values() for node in nodes]
+
+
+class TestClusterStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = ClusterStorage(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_index(self):
+        self.storage.dump_cluster(_Cluster('c1', [
+            _Node('frontend001', 'frontend', {'playbook': 'x'}),
+            _Node('compute001', 'compute', {'failed': True})]))
+        self.storage.dump_cluster(_Cluster('c2', [
+            _Node('frontend001', 'frontend')]))
+
+        summaries = self.storage.get_cluster_summaries()
+        assert sorted(summaries) == ['c1', 'c2']
+        assert summaries['c1']['nodes'] == {'frontend': 1, 'compute': 1}
+        assert summaries['c1']['cloud'] == 'hobbes'
+        assert summaries['c1']['state'] == 'setup failed'
+        assert summaries['c2']['state'] == 'not configured'
+
+        self.storage.delete_cluster('c2')
+        assert self.storage.get_stored_clusters() == ['c1']
+        assert sorted(os.listdir(self.path)) == [
+            '.index.json', '.index.json.lock', 'c1.json']
+
+    def test_lock_cluster(self):
+        with self.storage.lock_cluster('c1', exclusive=True):
+            # locks held by this process can be taken again
+            with self.storage.lock_cluster('c1', timeout=0):
+                pass
+        path = os.path.join(self.path, '.c1.lock')
+        assert os.path.exists(path)
+
+        # a lock held by somebody else
+        with open(path) as fd:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            with self.storage.lock_cluster('c1', timeout=0.1):
+                pass
+            try:
+                with self.storage.lock_cluster('c1', exclusive=True,
+                                               timeout=0.1):
+                    assert False
+            except ClusterLockTimeout:
+                pass
+
+    def _can_lock(self, path, kind):
+        with open(path) as fd:
+            try:
+                fcntl.flock(fd, kind | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                return False
+
+    def test_lock_upgrade(self):
+        path = os.path.join(self.path, '.c1.lock')
+        with self.storage.lock_cluster('c1'):
+            # somebody else holds a shared lock too
+            with open(path) as fd:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                try:
+                    with self.storage.lock_cluster('c1', exclusive=True,
+                                                   timeout=0.1):
+                        assert False
+                except ClusterLockTimeout:
+                    pass
+            # the shared lock is still held
+            assert not self._can_lock(path, fcntl.LOCK_EX)
+
+            with self.storage.lock_cluster('c1', exclusive=True, timeout=0):
+                assert not self._can_lock(path, fcntl.LOCK_SH)
+            assert self._can_lock(path, fcntl.LOCK_SH)
+            assert not self._can_lock(path, fcntl.LOCK_EX)
+        assert self._can_lock(path, fcntl.LOCK_EX)
+
+    def test_lock_threads(self):
+        errors = []
+
+        def lock():
+            try:
+                with self.storage.lock_cluster('c1', exclusive=True,
+                                               timeout=0.1):
+                    pass
+            except ClusterLockTimeout, ex:
+                errors.append(ex)
+
+        with self.storage.lock_cluster('c1', exclusive=True):
+            # another thread does not share the locks of this one
+            locker = threading.Thread(target=lock)
+            locker.start()
+            locker.join()
+        assert len(errors) == 1
+
+    def test_iter_nodes(self):
+        self.storage.dump_cluster(_Cluster('c1', [
+            _Node('frontend001', 'frontend'),
+            _Node('compute001', 'compute'),
+            _Node('compute002', 'compute')]))
+        nodes = self.storage.iter_nodes('c1', types=['comp*'],
+                                        names=['*2', 'frontend*'])
+        assert [node['name'] for node in nodes] == ['compute002']
+
+    def test_rebuild_index(self):
+        self.storage.dump_cluster(_Cluster('c1', [
+            _Node('frontend001', 'frontend', {'playbook': 'x'})]))
+        os.unlink(os.path.join(self.path, ClusterStorage.index_filename))
+
+        summaries = self.storage.get_cluster_summaries()
+        assert summaries.keys() == ['c1']
+        assert summaries['c1']['state'] == 'configured'
+        assert os.path.exists(
+            os.path.join(self.path, ClusterStorage.index_filename))
+
+
+class TestSqliteClusterStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = SqliteClusterStorage(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_dump_and_load(self):
+        cluster = _Cluster('c1', [
+            _Node('frontend001', 'frontend', {'playbook': 'x'}),
+            _Node('compute001', 'compute'),
+            _Node('compute002', 'compute')])
+        self.storage.dump_cluster(cluster)
+        record = self.storage.load_cluster('c1')
+        assert record['cloud'] == 'hobbes'
+        assert [node['name'] for node in record['nodes']] == [
+            node.name for node in cluster.get_all_nodes()]
+        assert record['nodes'][0]['setup_state'] == \
+            cluster.get_all_nodes()[0].setup_state
+
+        # only the rows of the nodes which changed are written
+        db = self.storage._connect()
+        cluster.nodes['compute'][0].setup_state = {'playbook': 'x'}
+        del cluster.nodes['compute'][1]
+        changes = db.total_changes
+        self.storage.dump_cluster(cluster)
+        # one cluster row, one node updated, one node deleted
+        assert db.total_changes - changes == 3
+
+        summary = self.storage.get_cluster_summaries()['c1']
+        assert summary['nodes'] == {'frontend': 1, 'compute': 1}
+        assert summary['state'] == 'configured'
+
+        self.storage.delete_cluster('c1')
+        assert self.storage.get_stored_clusters() == []
+
+    def test_baked_nodes(self):
+        # a database created before nodes were baked
+        db = sqlite3.connect(os.path.join(self.path, 'clusters.sqlite'))
+        db.executescript(sqlite_storage._SCHEMA.replace(
+            "    baked_from TEXT,\n", ""))
+        db.close()
+
+        self.storage.dump_cluster(_Cluster('c1', [
+            _Node('compute001', 'compute', baked_from='x')]))
+        record = self.storage.load_cluster('c1')
+        assert record['nodes'][0]['baked_from'] == 'x'
+        # baked nodes are only configured once the setup ran on them
+        summary = self.storage.get_cluster_summaries()['c1']
+        assert summary['state'] == 'not configured'
+
+    def test_iter_nodes(self):
+        self.storage.dump_cluster(_Cluster('c1', [
+            _Node('frontend001', 'frontend'),
+            _Node('compute001', 'compute'),
+            _Node('compute002', 'compute')]))
+        nodes = self.storage.iter_nodes('c1', types=['comp*'],
+                                        names=['*2', 'frontend*'])
+        assert [node['name'] for node in nodes] == ['compute002']
+        try:
+            list(self.storage.iter_nodes('c2'))
+            assert False
+        except ClusterNotFound:
+            pass
+
+    def test_migrate_baseline_file(self):
+        # as saved before clusters had images, cloud and setup states
+        with open(os.path.join(self.path, 'old.json'), 'w') as fd:
+            json.dump({'name': 'old', 'template': 'mycluster',
+                       'frontend_nodes': 1,
+                       'nodes': [{'instance_id': 'i-1',
+                                  'name': 'frontend001', 'type': 'frontend',
+                                  'ip_public': '1.2.3.4',
+                                  'ip_private': '10.0.0.1'}]}, fd)
+
+        assert migrate_json_storage(self.path) == ['old']
+        record = self.storage.load_cluster('old')
+        assert record['nodes'][0]['ip_public'] == '1.2.3.4'
+        assert record['nodes'][0]['setup_state'] is None
+        assert self.storage.get_cluster_summaries()['old']['state'] == \
+            'not configured'
+
+    def test_failed_migration(self):
+        ClusterStorage(self.path).dump_cluster(_Cluster('a', [
+            _Node('frontend001', 'frontend')]))
+        # fails after cluster `a` is copied
+        with open(os.path.join(self.path, 'broken.json'), 'w') as fd:
+            json.dump({'name': 'broken', 'template': 'mycluster',
+                       'nodes': [{'name': 'frontend001',
+                                  'type': 'frontend'}]}, fd)
+        try:
+            migrate_json_storage(self.path)
+            assert False
+        except KeyError:
+            pass
+        # the JSON files are still in use
+        assert not os.path.exists(sqlite_storage.get_database_path(self.path))
+        assert [fname for fname in sorted(os.listdir(self.path))
+                if not fname.startswith('.index.json')] == [
+            'a.json', 'broken.json']
+
+    def test_migrate(self):
+        ClusterStorage(self.path).dump_cluster(_Cluster('c1', [
+            _Node('frontend001', 'frontend')]))
+        # format saved by early versions
+        with open(os.path.join(self.path, 'c2.json'), 'w') as fd:
+            json.dump({'name': 'c2', 'template': 'mycluster',
+                       'frontend': [{'instance_id': 'i-1',
+                                     'name': 'frontend001',
+                                     'ip_public': None, 'ip_private': None,
+                                     'setup_state': None}],
+                       'compute': []}, fd)
+
+        assert migrate_json_storage(self.path) == ['c1', 'c2']
+        assert os.path.exists(sqlite_storage.get_database_path(self.path))
+        assert sorted(self.storage.get_stored_clusters()) == ['c1', 'c2']
+        record = self.storage.load_cluster('c2')
+        assert record['nodes'][0]['type'] == 'frontend'
+        assert not [fname for fname in os.listdir(self.path)
+                    if fname.endswith('.json')]
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+#
+#   Copyright (C) 2013 GC3, University of Zurich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from elasticluster.conf import Configuration
+from elasticluster.subcommands import CommandParser, ExecCommand, Inventory
+
+
+class TestExecCommand(unittest.TestCase):
+
+    def parse(self, argv):
+        params = argparse.Namespace()
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(parser_class=CommandParser)
+        ExecCommand(params).setup(subparsers)
+        return parser.parse_args(argv, namespace=params)
+
+    def test_options_after_cluster(self):
+        # as in README.rst
+        params = self.parse(['exec', 'my-other-cluster', '--group',
+                             'compute', '--', 'uptime'])
+        assert params.cluster == 'my-other-cluster'
+        assert params.node_types == ['compute']
+        assert params.command == ['uptime']
+
+    def test_command_options(self):
+        params = self.parse(['exec', 'mycl', '-a', '-f', '5', '-t', '10',
+                             '--', 'ls', '-l', '--', '-g'])
+        assert params.aggregate
+        assert (params.forks, params.timeout) == (5, 10)
+        assert params.node_types is None
+        assert params.command == ['ls', '-l', '--', '-g']
+
+    def test_without_double_dash(self):
+        params = self.parse(['exec', '-g', 'compute', 'mycl', 'uptime'])
+        assert params.node_types == ['compute']
+        assert params.command == ['uptime']
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config_path = os.path.join(self.tmpdir, 'config')
+        with open(config_path, 'w') as fd:
+            fd.write("""
+[login/ubuntu]
+image_user=ubuntu
+image_user_sudo=root
+image_sudo=True
+user_key_name=test
+user_key_private=~/.ssh/id_rsa
+user_key_public=~/.ssh/id_rsa.pub
+
+[setup/ansible]
+provider=ansible
+playbook_path=site.yml
+compute_groups=clients
+
+[cluster/test]
+login=ubuntu
+setup_provider=ansible
+""")
+        with open(os.path.join(self.tmpdir, 'mycl.json'), 'w') as fd:
+            json.dump({'name': 'mycl', 'template': 'test', 'nodes': [
+                {'name': 'compute001', 'type': 'compute',
+                 'instance_id': 'i-1', 'ip_public': '10.0.0.1',
+                 'ip_private': '192.168.0.1'}]}, fd)
+
+        self.config = Configuration.Instance()
+        self.saved = (self.config.file_path, self.config.storage_path,
+                      self.config._config, self.config._config_key)
+        self.config.file_path = config_path
+        self.config.storage_path = self.tmpdir
+
+    def tearDown(self):
+        (self.config.file_path, self.config.storage_path,
+         self.config._config, self.config._config_key) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_sudo(self):
+        params = argparse.Namespace(cluster='mycl', host='compute001',
+                                    private=False)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            Inventory(params).execute()
+            host_vars = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        assert host_vars['ansible_ssh_host'] == '10.0.0.1'
+        assert host_vars['ansible_sudo'] is True
+        assert host_vars['ansible_sudo_user'] == 'root'